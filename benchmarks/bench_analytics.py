@@ -0,0 +1,98 @@
+"""Benchmark of the history export and the vectorized analytics
+
+Fills a temporary database with a synthetic availability history, every product
+changing its availability entries-per-product times over the given number of days,
+exports it with export.py and runs every function of analytics.py on the export.
+
+Run the benchmark from the project root:
+
+    python -m benchmarks.bench_analytics --products 2000 --entries 500 --days 1095
+"""
+
+import argparse
+import datetime
+import pathlib
+import tempfile
+import time
+import numpy as np
+from scrapy.settings import Settings
+from lego import analytics
+from lego.database import Base, db_connect, dispose_engines
+from lego.export import export_history
+
+
+def fill_history(engine, products: int, entries: int, days: int, seed: int = 0):
+    """Inserts products and their availability entries with raw executemany"""
+    rng = np.random.default_rng(seed)
+    start = datetime.datetime(2020, 1, 1)
+    raw_connection = engine.raw_connection()
+    try:
+        cursor = raw_connection.cursor()
+        cursor.executemany(
+            "INSERT INTO products (product_id, name, price, url) VALUES (?, ?, ?, ?)",
+            [
+                (10000 + i, f"Product {i}", int(rng.integers(999, 49999)), f"url{i}")
+                for i in range(products)
+            ],
+        )
+        for product in range(products):
+            offsets = np.sort(rng.integers(0, days * 86400, entries))
+            codes = rng.choice([1, 2, 3, 4], entries, p=[0.4, 0.3, 0.2, 0.1])
+            cursor.executemany(
+                "INSERT INTO availability (product_id, availability, timestamp, "
+                "last_seen) VALUES (?, ?, ?, ?)",
+                [
+                    (
+                        10000 + product,
+                        int(code),
+                        str(start + datetime.timedelta(seconds=int(offset))),
+                        str(start + datetime.timedelta(seconds=int(offset) + 3600)),
+                    )
+                    for offset, code in zip(offsets, codes)
+                ],
+            )
+        raw_connection.commit()
+    finally:
+        raw_connection.close()
+
+
+def timed(label: str, function, *args):
+    """Runs the function, prints its duration and returns its result"""
+    start = time.perf_counter()
+    result = function(*args)
+    print(f"{label:<26} {time.perf_counter() - start:8.3f}s")
+    return result
+
+
+def main():
+    """Run the benchmark and print the duration of every step"""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n", maxsplit=1)[0])
+    parser.add_argument("--products", type=int, default=2000)
+    parser.add_argument("--entries", type=int, default=500)
+    parser.add_argument("--days", type=int, default=1095)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        directory = pathlib.Path(directory)
+        engine = db_connect(
+            Settings({"CONNECTION_STRING": f"sqlite:///{directory / 'bench.db'}"})
+        )
+        Base.metadata.create_all(engine)
+        fill_history(engine, args.products, args.entries, args.days)
+        print(
+            f"{args.products * args.entries} availability entries of "
+            f"{args.products} products over {args.days} days"
+        )
+        path = directory / "history"
+        timed("export", export_history, str(path), engine)
+        dispose_engines()
+
+        history = timed("load", analytics.load_history, str(path))
+        timed("status_periods", analytics.status_periods, history)
+        timed("time_to_restock", analytics.time_to_restock, history)
+        timed("restocks_by_weekday_hour", analytics.restocks_by_weekday_hour, history)
+        timed("availability_ratios", analytics.availability_ratios, history)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+# pylint: disable=E1101
+"""End to end benchmark of the spiders against a synthetic local shop
+
+Serves a SyntheticShop (see benchmarks/shop.py) and crawls it with the real spiders
+and pipelines into a temporary database:
+
+1. products: the LegoProductSpider crawls the catalog from the themes page
+2. seed: the AvailabilitySpider checks every product for the first time
+3. restock: a fraction of the unavailable products is restocked and the
+   AvailabilitySpider checks every product again
+
+Reports pages/sec, items/sec and the database write time of every phase, the peak RSS
+of the process and the time from the start of the restock sweep until the first
+restock notification is queued in the notification outbox.
+
+Run the benchmark from the project root:
+
+    python -m benchmarks.bench_crawl --products 1000 --latency 0.05
+"""
+
+import argparse
+import pathlib
+import resource
+import sys
+import tempfile
+import time
+from scrapy.crawler import CrawlerRunner
+from scrapy.utils.log import configure_logging
+from scrapy.utils.project import get_project_settings
+from twisted.internet import defer, reactor, task
+from benchmarks.shop import SyntheticShop
+from lego.database import count_notifications, db_connect
+from lego.spiders.product_spider import AvailabilitySpider, LegoProductSpider
+
+
+def crawl_settings(shop: SyntheticShop, database: pathlib.Path, concurrency: int):
+    """Returns the project settings pointed at the synthetic shop and database"""
+    settings = get_project_settings()
+    settings.setdict(
+        {
+            "CONNECTION_STRING": f"sqlite:///{database}",
+            "SHOP_URL": shop.url,
+            "DOWNLOAD_DELAY": 0,
+            "CONCURRENT_REQUESTS": concurrency,
+            "CONCURRENT_REQUESTS_PER_DOMAIN": concurrency,
+            "AUTOTHROTTLE_ENABLED": False,
+            "AVAILABILITY_SCHEDULER_ENABLED": False,
+            "TELNETCONSOLE_ENABLED": False,
+            "LOG_LEVEL": "WARNING",
+        },
+        priority="cmdline",
+    )
+    return settings
+
+
+def peak_rss_mb() -> float:
+    """Returns the peak resident set size of the process in MiB"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in KiB on Linux
+    return peak / 2**20 if sys.platform == "darwin" else peak / 2**10
+
+
+class FirstNotification:
+    """Polls the notification outbox until the first notification shows up"""
+
+    def __init__(self, engine, interval: float = 0.1) -> None:
+        self.engine = engine
+        self.start = time.perf_counter()
+        self.elapsed = None
+        self.loop = task.LoopingCall(self.poll)
+        self.loop.start(interval)
+
+    def poll(self):
+        """Check for changes and stop polling once one is found"""
+        if self.elapsed is None and count_notifications(self.engine):
+            self.elapsed = time.perf_counter() - self.start
+            self.stop()
+
+    def stop(self):
+        """Stop polling"""
+        if self.loop.running:
+            self.loop.stop()
+
+
+@defer.inlineCallbacks
+def crawl(runner: CrawlerRunner, spider, results: list, phase: str):
+    """Runs a spider to completion and appends the statistics of the phase"""
+    crawler = runner.create_crawler(spider)
+    start = time.perf_counter()
+    yield runner.crawl(crawler)
+    elapsed = time.perf_counter() - start
+    stats = crawler.stats.get_stats()
+    results.append(
+        {
+            "phase": phase,
+            "seconds": elapsed,
+            "pages": stats.get("response_received_count", 0),
+            "items": stats.get("item_scraped_count", 0),
+            "write_time": stats.get("database/write_time", 0.0),
+            "write_count": stats.get("database/write_count", 0),
+        }
+    )
+
+
+@defer.inlineCallbacks
+def run(args, shop: SyntheticShop, database: pathlib.Path, results: list):
+    """Runs the phases of the benchmark in one reactor"""
+    settings = crawl_settings(shop, database, args.concurrency)
+    runner = CrawlerRunner(settings)
+    try:
+        yield crawl(runner, LegoProductSpider, results, "products")
+        yield crawl(runner, AvailabilitySpider, results, "seed")
+
+        restocked = shop.restock(args.restock)
+        notification = FirstNotification(db_connect(settings))
+        yield crawl(runner, AvailabilitySpider, results, "restock")
+        notification.poll()
+        notification.stop()
+        results.append(
+            {"restocked": len(restocked), "first_notification": notification.elapsed}
+        )
+    finally:
+        reactor.stop()
+
+
+def main():
+    """Run the benchmark and print the results of every phase"""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n", maxsplit=1)[0])
+    parser.add_argument("--products", type=int, default=1000)
+    parser.add_argument(
+        "--latency", type=float, default=0.0, help="seconds added to every response"
+    )
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument(
+        "--restock", type=float, default=0.1, help="fraction of unavailable products"
+    )
+    args = parser.parse_args()
+
+    configure_logging(install_root_handler=False)
+    shop = SyntheticShop(products=args.products, latency=args.latency)
+    shop.start()
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        reactor.callWhenRunning(
+            run, args, shop, pathlib.Path(directory) / "bench.db", results
+        )
+        reactor.run()
+    shop.stop()
+
+    print(f"{args.products} products, {args.latency * 1000:.0f} ms latency")
+    print(
+        f"{'phase':<10}{'seconds':>10}{'pages/s':>10}{'items/s':>10}{'db write s':>12}"
+    )
+    for result in (result for result in results if "phase" in result):
+        seconds = result["seconds"] or float("nan")
+        print(
+            f"{result['phase']:<10}{seconds:>10.2f}"
+            f"{result['pages'] / seconds:>10.1f}{result['items'] / seconds:>10.1f}"
+            f"{result['write_time']:>12.3f}"
+        )
+    print(f"peak RSS: {peak_rss_mb():.1f} MiB")
+    if results and "first_notification" in results[-1]:
+        first = results[-1]["first_notification"]
+        print(
+            f"restocked {results[-1]['restocked']} products, time to first "
+            "notification: " + (f"{first:.2f} s" if first is not None else "none")
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""Micro-benchmark of the product information extractors on saved product pages
+
+Compares the JSON-LD and CSS extractors, the default extractor chain and the former
+parse function, which evaluated up to seven CSS selectors per page.
+
+Save product pages to a directory and run the benchmark from the project root:
+
+    scrapy fetch --nolog https://www.lego.com/de-de/product/<product> \
+        > benchmarks/pages/<product>.html
+    python -m benchmarks.bench_extractors benchmarks/pages
+"""
+
+import argparse
+import pathlib
+import timeit
+from scrapy.http import HtmlResponse
+from lego import extractors
+
+
+def legacy_extract(response: HtmlResponse) -> dict:
+    """The selector passes of the former parse functions of the spiders"""
+    fields = {}
+    if response.css(".eqJexe .hlipzx::text").get():
+        if not "Altes Produkt" in response.css(".ejRirH .hlipzx::text").get():
+            fields["name"] = response.css(".eqJexe .hlipzx::text").get()
+            fields["price"] = response.css(".eGdbAY::text").get()
+            fields["product_id"] = response.css(
+                ".ProductDetailsstyles__ProductID-sc-16lgx7x-10.bIKuiP::text"
+            ).get()
+            fields["availability"] = response.css(".ejRirH .hlipzx::text").get()
+    return fields
+
+
+def load_pages(directory: pathlib.Path):
+    """Returns the saved pages as fresh responses"""
+    pages = [
+        (path.name, path.read_bytes()) for path in sorted(directory.glob("*.html"))
+    ]
+    return [
+        (
+            name,
+            lambda body=body: HtmlResponse(
+                "https://www.lego.com/de-de/product/x", body=body, encoding="utf-8"
+            ),
+        )
+        for name, body in pages
+    ]
+
+
+def main():
+    """Run the benchmark and print the time per page of each extractor"""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n", maxsplit=1)[0])
+    parser.add_argument(
+        "pages",
+        nargs="?",
+        default=pathlib.Path(__file__).parent / "pages",
+        type=pathlib.Path,
+    )
+    parser.add_argument("--repeat", type=int, default=2000)
+    args = parser.parse_args()
+
+    chain = extractors.load_extractors()
+    candidates = {
+        "legacy css": legacy_extract,
+        "css": extractors.CssExtractor().extract,
+        "json-ld": extractors.JsonLdExtractor().extract,
+        "chain": lambda response: extractors.extract_product(response, chain),
+    }
+    for name, make_response in load_pages(args.pages):
+        print(name)
+        for label, extract in candidates.items():
+            # A new response per call, selectors cache the parsed document per response
+            seconds = timeit.timeit(
+                lambda e=extract, m=make_response: e(m()), number=args.repeat
+            )
+            print(f"  {label:<12} {seconds / args.repeat * 1e6:8.1f} µs/page")
+        print(f"  fields       {extractors.extract_product(make_response(), chain)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+"""Micro-benchmark of the field normalizers of the LegoItem
+
+Compares the normalizers of items.py with their former implementations on a corpus
+of field values as found on the product pages and in their JSON-LD data: prices with
+decimal commas, thousands separators and non-breaking spaces, product ids and
+availability strings including reorder texts with shipping dates. Also counts the
+values the former implementations got wrong.
+
+Run the benchmark from the project root:
+
+    python -m benchmarks.bench_normalizers --values 100000 --products 2000
+"""
+
+import argparse
+import random
+import timeit
+from lego import items
+
+MONTHS = ["Januar", "Februar", "März", "April", "Mai", "Juni", "Juli", "August"]
+STATUSES = [
+    "Jetzt verfügbar",
+    "Vorübergehend nicht auf Lager",
+    "Ausverkauft",
+    "Bald erhältlich",
+]
+
+
+def legacy_process_price(price_text: str) -> int:
+    """The former price conversion through a float"""
+    try:
+        splitted = price_text.split("\xa0")
+        price = float(splitted[0].replace(",", "."))
+        price = int(price * 100)
+        return price
+    except:  # pylint: disable=bare-except
+        return 0
+
+
+def legacy_str_to_int(text: str) -> int:
+    """The former product id conversion"""
+    try:
+        i = int(text)
+        return i
+    except:  # pylint: disable=bare-except
+        return text
+
+
+def legacy_availability_str_to_int(text: str) -> int:
+    """The former linear scan of the availability codes"""
+    for key, value in items.AVAILABILITY_CODES.items():
+        if value == text:
+            return key
+        if key == 4 and items.AVAILABILITY_CODES[4] in text:
+            return key
+    raise Exception(f"Verfügbarkeitsstatus {text} unkown")
+
+
+def make_corpus(size: int, products: int, seed: int = 0):
+    """Returns price, product id and availability values with their expected result
+
+    The values are drawn from a catalog of products, as repeated sweeps over the
+    same products see the same values again
+    """
+    rng = random.Random(seed)
+    catalog = [
+        rng.choice([rng.randrange(199, 9999), rng.randrange(9999, 89999)])
+        for _ in range(products)
+    ]
+    prices, product_ids, statuses = [], [], []
+    for _ in range(size):
+        product = rng.randrange(products)
+        cents = catalog[product]
+        euros = f"{cents // 100:,}".replace(",", ".")
+        prices.append(
+            (
+                rng.choice(
+                    [
+                        f"{euros},{cents % 100:02d}\xa0€",
+                        f"{cents // 100}.{cents % 100:02d}",
+                    ]
+                ),
+                cents,
+            )
+        )
+        product_ids.append((str(10000 + product), 10000 + product))
+        if rng.random() < 0.2:
+            statuses.append(
+                (
+                    f"Nachbestellungen möglich. Versand zum {rng.randrange(1, 29)}. "
+                    f"{rng.choice(MONTHS)} 2022",
+                    4,
+                )
+            )
+        else:
+            code = rng.choice([1, 1, 1, 2, 3, -1])
+            statuses.append((STATUSES[code - 1] if code > 0 else STATUSES[3], code))
+    return {"price": prices, "product_id": product_ids, "availability": statuses}
+
+
+def errors(function, values) -> int:
+    """Returns the number of values converted wrongly or raising"""
+    count = 0
+    for value, expected in values:
+        try:
+            count += function(value) != expected
+        except Exception:  # pylint: disable=broad-except
+            count += 1
+    return count
+
+
+def main():
+    """Run the benchmark and print the time per value of each normalizer"""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n", maxsplit=1)[0])
+    parser.add_argument("--values", type=int, default=100000)
+    parser.add_argument("--products", type=int, default=2000)
+    args = parser.parse_args()
+
+    corpus = make_corpus(args.values, args.products)
+    candidates = {
+        "price": [
+            ("legacy", legacy_process_price),
+            ("items", items.process_price),
+        ],
+        "product_id": [
+            ("legacy", legacy_str_to_int),
+            ("items", items.str_to_int),
+        ],
+        "availability": [
+            ("legacy", legacy_availability_str_to_int),
+            ("items", items.availability_str_to_int),
+        ],
+    }
+    print(f"{args.values} values per field of {args.products} products")
+    print(f"{'field':<13} {'normalizer':<8} {'µs/value':>9} {'errors':>8}")
+    for field, normalizers in candidates.items():
+        values = corpus[field]
+        texts = [value for value, _ in values]
+        for label, function in normalizers:
+            wrong = errors(function, values)
+            if hasattr(function, "cache_clear"):
+                function.cache_clear()
+
+            def convert(function=function, texts=texts):
+                for text in texts:
+                    try:
+                        function(text)
+                    except Exception:  # pylint: disable=broad-except
+                        pass
+
+            seconds = timeit.timeit(convert, number=1)
+            print(
+                f"{field:<13} {label:<8} {seconds / len(texts) * 1e6:9.3f} {wrong:8d}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,236 @@
+"""A synthetic local stand-in for the Lego shop
+
+Serves a themes page, paginated theme pages linking to the products and product pages
+with the same markup as the shop (embedded JSON-LD and the CSS class names used by the
+CssExtractor). Like the shop, pages link url variants of the same page with tracking
+and sort parameters and fragments. Product pages support ETag validation. The
+availability of products can be changed while the shop is running to simulate restocks.
+
+    shop = SyntheticShop(products=1000, latency=0.05)
+    shop.start()
+    ... crawl shop.url ...
+    shop.restock(0.1)
+    shop.stop()
+"""
+
+import hashlib
+import html
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List
+from urllib.parse import parse_qs, urlparse
+
+PRODUCTS_PER_PAGE = 24
+PRODUCTS_PER_THEME = 240
+FIRST_PRODUCT_ID = 10000
+
+AVAILABILITY_TEXTS = {
+    1: ("Jetzt verfügbar", "InStock"),
+    2: ("Vorübergehend nicht auf Lager", "OutOfStock"),
+    3: ("Ausverkauft", "SoldOut"),
+    4: ("Nachbestellungen möglich. Versand zum 12. Oktober 2021", "BackOrder"),
+}
+
+PAGE = """<!DOCTYPE html>
+<html lang="de-DE"><head><meta charset="utf-8"><title>{title}</title>{head}</head>
+<body><header><nav><a href="/de-de/themes">Themenwelten</a></nav></header>
+<main>{main}</main></body></html>"""
+
+PRODUCT_MAIN = """<div class="ProductOverviewstyles__Container-sc-1a1az6h-2">
+<h1 class="ProductOverviewstyles__NameWrapper-sc-1a1az6h-5 eqJexe">\
+<span class="Markup__StyledMarkup-ar1l9g-0 hlipzx">{name}</span></h1>
+<div class="ProductPricestyles__Wrapper-vmt0i4-1"><span data-test="product-price" \
+class="ProductPricestyles__StyledText-vmt0i4-0 eGdbAY">{price}\xa0€</span></div>
+<p data-test="product-overview-availability" \
+class="ProductOverviewstyles__AvailabilityStatus-sc-1a1az6h-10 ejRirH">\
+<span class="Markup__StyledMarkup-ar1l9g-0 hlipzx">{availability}</span></p></div>
+<section class="ProductDetailsstyles__Wrapper-sc-16lgx7x-0">\
+<div class="ProductDetailsstyles__ProductAttribute-sc-16lgx7x-8"><span>Artikelnummer\
+</span><span class="ProductDetailsstyles__ProductID-sc-16lgx7x-10 bIKuiP">{product_id}\
+</span></div></section>
+<ul class="ProductGrid">{related}</ul>"""
+
+
+class SyntheticShop:
+    """A threaded HTTP server serving a synthetic catalog of products"""
+
+    def __init__(self, products: int = 1000, latency: float = 0.0, port: int = 0):
+        """Creates a catalog of products with deterministic prices and availabilities
+
+        latency is the delay in seconds added to every response
+        """
+        self.latency = latency
+        self.product_ids = list(range(FIRST_PRODUCT_ID, FIRST_PRODUCT_ID + products))
+        self.availability = {
+            product_id: initial_availability(product_id)
+            for product_id in self.product_ids
+        }
+        self.prices = {
+            product_id: 999 + (product_id * 7919) % 40000
+            for product_id in self.product_ids
+        }
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), self.handler_class())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self) -> str:
+        """The SHOP_URL of the synthetic shop"""
+        return f"http://127.0.0.1:{self.server.server_address[1]}/de-de"
+
+    def product_url(self, product_id: int) -> str:
+        """Returns the url of a product page"""
+        return f"{self.url}/product/set-{product_id}"
+
+    def start(self):
+        """Serve the shop in a background thread"""
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Stop serving the shop"""
+        self.server.shutdown()
+        self.server.server_close()
+
+    def restock(self, fraction: float) -> List[int]:
+        """Makes a fraction of the temporarily unavailable products available
+
+        Returns the ids of the restocked products
+        """
+        unavailable = [p for p in self.product_ids if self.availability[p] == 2]
+        restocked = unavailable[: max(int(len(unavailable) * fraction), 1)]
+        for product_id in restocked:
+            self.availability[product_id] = 1
+        return restocked
+
+    def themes(self) -> int:
+        """Returns the number of theme pages"""
+        return max((len(self.product_ids) - 1) // PRODUCTS_PER_THEME + 1, 1)
+
+    def render(self, path: str, query: dict) -> str:
+        """Returns the page for a path or None if it does not exist"""
+        if path == "/de-de/themes":
+            links = "".join(
+                f'<li><a href="/de-de/themes/theme-{theme}">Theme {theme}</a></li>'
+                for theme in range(self.themes())
+            )
+            return PAGE.format(title="Themenwelten", head="", main=f"<ul>{links}</ul>")
+
+        match = re.fullmatch(r"/de-de/themes/theme-(\d+)", path)
+        if match and int(match.group(1)) < self.themes():
+            return self.render_theme(int(match.group(1)), query)
+
+        match = re.fullmatch(r"/de-de/product/set-(\d+)", path)
+        if match and int(match.group(1)) in self.availability:
+            return self.render_product(int(match.group(1)))
+        return None
+
+    def render_theme(self, theme: int, query: dict) -> str:
+        """Returns a page of the product listing of a theme"""
+        page = int(query.get("page", ["1"])[0])
+        first = theme * PRODUCTS_PER_THEME + (page - 1) * PRODUCTS_PER_PAGE
+        last = min(
+            first + PRODUCTS_PER_PAGE,
+            (theme + 1) * PRODUCTS_PER_THEME,
+            len(self.product_ids),
+        )
+        links = "".join(
+            f'<li><a href="/de-de/product/set-{product_id}?icmp=LP-SHQ-{theme}">'
+            f"Set {product_id}</a></li>"
+            for product_id in self.product_ids[first:last]
+        )
+        # Url variants of the same listing as linked by the shop
+        links += f'<li><a href="?page={page}&sort=price-asc">Preis</a></li>'
+        links += '<li><a href="?page=1#filter">Erste Seite</a></li>'
+        if last < min((theme + 1) * PRODUCTS_PER_THEME, len(self.product_ids)):
+            links += f'<li><a href="?page={page + 1}">Weitere Produkte</a></li>'
+        return PAGE.format(title=f"Theme {theme}", head="", main=f"<ul>{links}</ul>")
+
+    def render_product(self, product_id: int) -> str:
+        """Returns the product page of a product"""
+        text, schema = AVAILABILITY_TEXTS[self.availability[product_id]]
+        price = self.prices[product_id]
+        name = f"Set {product_id}"
+        json_ld = {
+            "@context": "https://schema.org",
+            "@type": "Product",
+            "name": name,
+            "sku": str(product_id),
+            "offers": {
+                "@type": "Offer",
+                "price": f"{price // 100}.{price % 100:02d}",
+                "priceCurrency": "EUR",
+                "availability": f"http://schema.org/{schema}",
+            },
+        }
+        related = "".join(
+            f'<li><a href="/de-de/product/set-{other}#product-details">Set {other}</a></li>'
+            for other in (product_id - 1, product_id + 1)
+            if other in self.availability
+        )
+        main = PRODUCT_MAIN.format(
+            name=html.escape(name),
+            price=f"{price // 100},{price % 100:02d}",
+            availability=text,
+            product_id=product_id,
+            related=related,
+        )
+        head = (
+            '<script type="application/ld+json">'
+            + json.dumps(json_ld, ensure_ascii=False)
+            + "</script>"
+        )
+        return PAGE.format(title=name, head=head, main=main)
+
+    def handler_class(self):  # pylint: disable=R0201
+        """Returns the request handler class bound to this shop"""
+        shop = self
+
+        class Handler(BaseHTTPRequestHandler):
+            """Serves the pages of the synthetic shop"""
+
+            def do_GET(self):  # pylint: disable=C0103
+                """Respond with the page, 304 if the ETag matches or 404"""
+                if shop.latency:
+                    time.sleep(shop.latency)
+                url = urlparse(self.path)
+                page = shop.render(url.path, parse_qs(url.query))
+                if page is None:
+                    self.send_response(404)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+
+                body = page.encode()
+                etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+                if self.headers.get("If-None-Match") == etag:
+                    self.send_response(304)
+                    self.send_header("ETag", etag)
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", "text/html; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.send_header("ETag", etag)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):  # pylint: disable=W0622
+                """Don't log every request"""
+
+        return Handler
+
+
+def initial_availability(product_id: int) -> int:
+    """Returns a deterministic initial availability, most products are available"""
+    bucket = product_id % 20
+    if bucket < 12:
+        return 1
+    if bucket < 16:
+        return 2
+    if bucket < 19:
+        return 3
+    return 4
@@ -0,0 +1,228 @@
+#!/usr/bin/python3
+
+"""Vectorized analytics of the availability history exported by export.py
+
+All functions take the history as dict of arrays, as returned by load_history, and
+work on whole columns at once, so years of history of the full catalog take seconds.
+
+A product is in stock while its availability is one of in_stock, by default only
+"Jetzt verfügbar". Consecutive entries of a product on the same side form a period.
+An out of stock period ends with a restock when the product is in stock again, its
+duration is the time to restock. Timestamps are UTC.
+
+Print a report of an export from the project root:
+
+    python -m lego.analytics history
+"""
+
+import argparse
+import os
+from typing import Dict, Iterable, Optional
+import numpy as np
+from lego.items import AVAILABILITY_CODES
+
+IN_STOCK = (1,)
+WEEKDAYS = ["Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun"]
+
+
+def load_history(path: str) -> Dict[str, np.ndarray]:
+    """Loads the directory of .npy files written by export.py"""
+    return {
+        name[: -len(".npy")]: np.load(os.path.join(path, name))
+        for name in sorted(os.listdir(path))
+        if name.endswith(".npy")
+    }
+
+
+def _seconds(delta: np.ndarray) -> np.ndarray:
+    return delta.astype("timedelta64[s]").astype(np.float64)
+
+
+def _following(product_ids: np.ndarray) -> np.ndarray:
+    """Returns whether the next row belongs to the same product"""
+    following = np.zeros(len(product_ids), dtype=bool)
+    following[:-1] = product_ids[1:] == product_ids[:-1]
+    return following
+
+
+def entry_ends(history: Dict[str, np.ndarray]) -> np.ndarray:
+    """Returns the end of every entry
+
+    An entry lasts until the next entry of the product, the latest entry until it
+    was last seen
+    """
+    following = _following(history["product_id"])
+    next_timestamps = np.roll(history["timestamp"], -1)
+    return np.where(following, next_timestamps, history["last_seen"])
+
+
+def status_periods(
+    history: Dict[str, np.ndarray], in_stock: Iterable[int] = IN_STOCK
+) -> Dict[str, np.ndarray]:
+    """Returns the in stock and out of stock periods of all products
+
+    Arrays of the returned dict:
+        - product_id, in_stock, start, end: one value per period
+        - closed: whether the next period of the product started at end
+    """
+    product_ids = history["product_id"]
+    stocked = np.isin(history["availability"], list(in_stock))
+    first = np.ones(len(product_ids), dtype=bool)
+    first[1:] = (product_ids[1:] != product_ids[:-1]) | (stocked[1:] != stocked[:-1])
+    starts = np.flatnonzero(first)
+    lasts = np.append(starts[1:], len(product_ids))[: len(starts)] - 1
+
+    period_products = product_ids[starts]
+    closed = _following(period_products)
+    start = history["timestamp"][starts]
+    return {
+        "product_id": period_products,
+        "in_stock": stocked[starts],
+        "start": start,
+        "end": np.where(closed, np.roll(start, -1), history["last_seen"][lasts]),
+        "closed": closed,
+    }
+
+
+def out_of_stock_durations(
+    history: Dict[str, np.ndarray], in_stock: Iterable[int] = IN_STOCK
+) -> Dict[str, np.ndarray]:
+    """Returns the out of stock periods with their duration in seconds
+
+    restocked tells whether the period ended with a restock or still lasts
+    """
+    periods = status_periods(history, in_stock)
+    out = ~periods["in_stock"]
+    return {
+        "product_id": periods["product_id"][out],
+        "start": periods["start"][out],
+        "duration": _seconds(periods["end"][out] - periods["start"][out]),
+        "restocked": periods["closed"][out],
+    }
+
+
+def _quantile(
+    values: np.ndarray, first: np.ndarray, count: np.ndarray, fraction: float
+):
+    """Returns the quantile of every group of sorted values"""
+    position = first + fraction * (count - 1)
+    lower = np.floor(position).astype(np.int64)
+    upper = np.ceil(position).astype(np.int64)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+
+def time_to_restock(
+    history: Dict[str, np.ndarray], in_stock: Iterable[int] = IN_STOCK
+) -> Dict[str, np.ndarray]:
+    """Returns the distribution of the time to restock per product in seconds
+
+    Arrays of the returned dict with one value per product which was restocked:
+    product_id, count, mean, median, p90 and max
+    """
+    periods = out_of_stock_durations(history, in_stock)
+    product_ids = periods["product_id"][periods["restocked"]]
+    durations = periods["duration"][periods["restocked"]]
+    order = np.lexsort((durations, product_ids))
+    product_ids, durations = product_ids[order], durations[order]
+    products, first, inverse, count = np.unique(
+        product_ids, return_index=True, return_inverse=True, return_counts=True
+    )
+    return {
+        "product_id": products,
+        "count": count,
+        "mean": np.bincount(inverse, weights=durations, minlength=len(products))
+        / np.maximum(count, 1),
+        "median": _quantile(durations, first, count, 0.5),
+        "p90": _quantile(durations, first, count, 0.9),
+        "max": _quantile(durations, first, count, 1.0),
+    }
+
+
+def restocks_by_weekday_hour(
+    history: Dict[str, np.ndarray], in_stock: Iterable[int] = IN_STOCK
+) -> np.ndarray:
+    """Returns the number of restocks per weekday (Monday first) and hour as 7x24 array"""
+    periods = status_periods(history, in_stock)
+    restocked = np.zeros(len(periods["product_id"]), dtype=bool)
+    restocked[1:] = periods["closed"][:-1]
+    times = periods["start"][restocked & periods["in_stock"]]
+    days = times.astype("datetime64[D]")
+    # 1970-01-01 was a Thursday
+    weekdays = (days.astype(np.int64) + 3) % 7
+    hours = (times - days).astype("timedelta64[h]").astype(np.int64)
+    return np.bincount(weekdays * 24 + hours, minlength=7 * 24).reshape(7, 24)
+
+
+def availability_ratios(
+    history: Dict[str, np.ndarray],
+    start: Optional[np.datetime64] = None,
+    end: Optional[np.datetime64] = None,
+) -> Dict[int, float]:
+    """Returns the share of product time spent in every availability
+
+    Optionally only the time between start and end is counted
+    """
+    begins = history["timestamp"]
+    ends = entry_ends(history)
+    if start is not None:
+        begins = np.maximum(begins, np.datetime64(start, "s"))
+    if end is not None:
+        ends = np.minimum(ends, np.datetime64(end, "s"))
+    durations = np.maximum(_seconds(ends - begins), 0)
+    codes, inverse = np.unique(history["availability"], return_inverse=True)
+    totals = np.bincount(inverse, weights=durations, minlength=len(codes))
+    if totals.sum() == 0:
+        return {}
+    return {
+        int(code): float(total) for code, total in zip(codes, totals / totals.sum())
+    }
+
+
+def print_report(history: Dict[str, np.ndarray], top: int = 10):
+    """Prints the analytics of a history"""
+    print(
+        f"{len(history['product_id'])} availability entries of "
+        f"{len(np.unique(history['product_id']))} products"
+    )
+    if history["product_id"].size == 0:
+        return
+    print(f"from {history['timestamp'].min()} to {history['last_seen'].max()}\n")
+
+    print("Share of product time per availability")
+    for code, ratio in availability_ratios(history).items():
+        print(f"  {AVAILABILITY_CODES.get(code, code)!s:<32} {ratio:6.1%}")
+
+    periods = out_of_stock_durations(history)
+    restocked = periods["duration"][periods["restocked"]]
+    median = np.median(restocked) / 3600 if len(restocked) else 0.0
+    print(
+        f"\n{len(periods['duration'])} out of stock periods, {len(restocked)} "
+        f"restocked after a median of {median:.1f}h"
+    )
+
+    restocks = time_to_restock(history)
+    names = dict(zip(history["product_ids"], history["product_names"]))
+    print("\nLongest median time to restock")
+    for i in np.argsort(-restocks["median"])[:top]:
+        product_id = restocks["product_id"][i]
+        print(
+            f"  {product_id:>8} {names.get(product_id, '')[:40]:<40} "
+            f"{restocks['count'][i]:4d}x median {restocks['median'][i] / 3600:8.1f}h "
+            f"p90 {restocks['p90'][i] / 3600:8.1f}h"
+        )
+
+    counts = restocks_by_weekday_hour(history)
+    print("\nMost restocks (UTC)")
+    for slot in np.argsort(-counts, axis=None)[:5]:
+        weekday, hour = divmod(int(slot), 24)
+        if not counts[weekday, hour]:
+            break
+        print(f"  {WEEKDAYS[weekday]} {hour:02d}:00 {counts[weekday, hour]:6d}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n", maxsplit=1)[0])
+    parser.add_argument("path", help="the directory written by lego.export")
+    parser.add_argument("--top", type=int, default=10)
+    args = parser.parse_args()
+    print_report(load_history(args.path), args.top)
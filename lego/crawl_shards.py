@@ -0,0 +1,129 @@
+#!/usr/bin/python3
+
+"""Script running a sharded availability crawl
+
+The products are split into shards by their lego product id. Every shard is crawled
+by its own `scrapy crawl availability` worker process, so a full sweep scales with the
+number of cores. The workers only read from the database and append their writes to
+a result file per shard. After all workers finished, the result files are merged into
+the database by this process as the single writer.
+
+The result file of a shard is truncated when its worker starts. The results of a
+failed worker are merged as well: every line of a result file is a complete batch of
+observations, a line cut off by the failure is skipped.
+
+Run 4 workers on this machine and merge their results:
+
+    python -m lego.crawl_shards run 4
+
+Or run the workers on several machines with a copy of the database and merge the
+result files on the machine with the database:
+
+    scrapy crawl availability -a shard=0 -a shards=4 -s SHARD_RESULTS_FILE=shard-0.jsonl
+    python -m lego.crawl_shards merge shard-*.jsonl
+"""
+
+import argparse
+import logging
+import os
+import subprocess
+import sys
+from typing import List
+from scrapy.utils.project import get_project_settings
+from lego.pipelines import (
+    AvailabilityPipeline,
+    QuarantinePipeline,
+    UpdatePricePipeline,
+)
+from lego.shards import read_shard_results
+
+logger = logging.getLogger(__name__)
+
+MERGE_PIPELINES = [
+    AvailabilityPipeline,
+    UpdatePricePipeline,
+    QuarantinePipeline,
+]
+
+
+def worker_command(shard: int, shards: int, results_file: str) -> List[str]:
+    """Returns the command running the availability crawl of one shard"""
+    return [
+        sys.executable,
+        "-m",
+        "scrapy",
+        "crawl",
+        "availability",
+        "-a",
+        f"shard={shard}",
+        "-a",
+        f"shards={shards}",
+        "-s",
+        f"SHARD_RESULTS_FILE={results_file}",
+    ]
+
+
+def run_workers(shards: int, directory: str) -> List[str]:
+    """Runs one worker process per shard and waits for them
+
+    Returns the result files of all workers, including the partial results of failed
+    workers
+    """
+    os.makedirs(directory, exist_ok=True)
+    workers = []
+    for shard in range(shards):
+        results_file = os.path.join(directory, f"shard-{shard}.jsonl")
+        # A worker failing before it opens its result file leaves no stale batches
+        with open(results_file, "w", encoding="utf-8"):
+            pass
+        workers.append(
+            (
+                results_file,
+                subprocess.Popen(  # pylint: disable=R1732
+                    worker_command(shard, shards, results_file)
+                ),
+            )
+        )
+
+    for results_file, worker in workers:
+        if worker.wait() != 0:
+            logger.error(
+                "Worker for %s failed, merging its partial results", results_file
+            )
+    return [results_file for results_file, _ in workers]
+
+
+def merge_results(results_files: List[str], settings=None) -> int:
+    """Writes the result files of the workers to the database
+
+    Every batch is written by the pipeline which buffered it. Merged files are
+    renamed to <file>.merged, so they are not merged twice.
+    Returns the number of merged entries
+    """
+    settings = settings if settings is not None else get_project_settings()
+    pipelines = {pipeline.kind: pipeline(settings) for pipeline in MERGE_PIPELINES}
+    merged = 0
+    for results_file in results_files:
+        for kind, entries in read_shard_results(results_file):
+            pipelines[kind].write(entries)
+            merged += len(entries)
+        os.replace(results_file, results_file + ".merged")
+    return merged
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Run a sharded availability crawl")
+    commands = parser.add_subparsers(dest="command", required=True)
+    run_parser = commands.add_parser("run", help="run and merge all shards")
+    run_parser.add_argument("shards", type=int)
+    run_parser.add_argument("--directory", default="shards")
+    merge_parser = commands.add_parser("merge", help="merge result files")
+    merge_parser.add_argument("files", nargs="+")
+    args = parser.parse_args()
+
+    if args.command == "run":
+        files = run_workers(args.shards, args.directory)
+    else:
+        files = args.files
+    logger.info("Merged %d entries", merge_results(files))
@@ -0,0 +1,236 @@
+#!/usr/bin/python3
+
+"""Long-running service checking the availability of Lego products
+
+Replaces running `scrapy crawl availability` and evaluate_availability.py from cron.
+One process keeps the Twisted reactor, the database engine and the Telegram bot and
+runs the availability sweeps one after another:
+
+- After a sweep the daemon sleeps until the AvailabilityScheduler says the next
+  product is due, at least DAEMON_MIN_SLEEP and at most DAEMON_MAX_SLEEP seconds.
+  Without the scheduler every sweep checks all products, every DAEMON_MAX_SLEEP seconds
+- The notification outbox is drained whenever the TransitionPipeline queued a
+  transition and every DAEMON_DRAIN_INTERVAL seconds, so a restock is sent seconds
+  after its page was crawled and not after the sweep
+- With METRICS_PROMETHEUS_PORT the latency metrics of the latest sweep and of the
+  Telegram deliveries are served for Prometheus, see metrics.py
+- Every RETENTION_INTERVAL_HOURS the retention job downsamples and deletes old
+  availability history in a thread, see retention.py
+
+Run it from the project root with the Telegram bot token and channel ID in .env:
+
+    python -m lego.daemon
+"""
+
+import datetime
+import logging
+from typing import Optional
+from dotenv import dotenv_values
+from scrapy.crawler import CrawlerRunner
+from scrapy.utils.log import configure_logging, failure_to_exc_info
+from scrapy.utils.project import get_project_settings
+from twisted.internet import defer, reactor, task, threads
+from twisted.python.failure import Failure
+from lego.database import db_connect, iter_product_schedule
+from lego.metrics import Metrics, serve_metrics
+from lego.outbox import OutboxSender
+from lego.retention import RetentionJob
+from lego.scheduler import AvailabilityScheduler
+from lego.spiders.product_spider import AvailabilitySpider
+from lego.telegram_message import LegoRestockBot, NotificationDispatcher
+from lego.transitions import transition_detected
+
+logger = logging.getLogger(__name__)
+
+
+class AvailabilityDaemon:  # pylint: disable=R0902
+    """Runs availability sweeps and sends the notifications of their changes"""
+
+    def __init__(
+        self, settings, sender: Optional[OutboxSender] = None, clock=None
+    ) -> None:
+        self.settings = settings
+        # The reactor running the loops, sleeps and threads of the daemon
+        self.clock = clock or reactor
+        self.engine = db_connect(settings)
+        self.runner = CrawlerRunner(settings)
+        self.sender = sender
+        self.scheduler = None
+        if settings.getbool("AVAILABILITY_SCHEDULER_ENABLED"):
+            self.scheduler = AvailabilityScheduler.from_settings(settings)
+        self.min_sleep = settings.getfloat("DAEMON_MIN_SLEEP", 60.0)
+        self.max_sleep = settings.getfloat("DAEMON_MAX_SLEEP", 3600.0)
+        self.drain_loop = task.LoopingCall(self.drain)
+        self.drain_loop.clock = self.clock
+        self.retention = RetentionJob.from_settings(settings, self.engine)
+        self.retention_loop = task.LoopingCall(self.clean_up)
+        self.retention_loop.clock = self.clock
+        self.cleaning = None
+        self.draining = None
+        self.drain_again = False
+        self.sleeping = None
+        self.running = False
+
+    def sweep_delay(self, now: Optional[datetime.datetime] = None) -> float:
+        """Returns the seconds until the next sweep"""
+        if self.scheduler is None:
+            return self.max_sleep
+        now = now or datetime.datetime.utcnow()
+        entries = iter_product_schedule(
+            self.engine, since=self.scheduler.history_start(now)
+        )
+        due = self.scheduler.next_due(entries, now)
+        if due is None:
+            return self.max_sleep
+        delay = (due - now).total_seconds()
+        return min(max(delay, self.min_sleep), self.max_sleep)
+
+    def in_thread(self, func) -> defer.Deferred:
+        """Calls a function in the thread pool of the reactor"""
+        return threads.deferToThreadPool(self.clock, self.clock.getThreadPool(), func)
+
+    def drain(self) -> defer.Deferred:
+        """Sends the pending notifications in a thread
+
+        If a drain still runs, another one starts after it
+        """
+        if self.sender is None:
+            return defer.succeed(None)
+        if self.draining is not None:
+            self.drain_again = True
+            return defer.succeed(None)
+        self.draining = self.in_thread(self.sender.drain)
+        self.draining.addCallbacks(self._drained, self._drain_failed)
+        return self.draining
+
+    def _drained(self, counts: dict):
+        self.draining = None
+        if counts["sent"] or counts["failed"]:
+            logger.info(
+                "Sent %d and failed %d notifications", counts["sent"], counts["failed"]
+            )
+        self._drain_again()
+
+    def _drain_failed(self, failure):
+        self.draining = None
+        logger.error(
+            "Draining the outbox failed", exc_info=failure_to_exc_info(failure)
+        )
+        self._drain_again()
+
+    def _drain_again(self):
+        if self.drain_again:
+            self.drain_again = False
+            self.drain()
+
+    def clean_up(self) -> defer.Deferred:
+        """Runs the retention job in a thread unless it still runs"""
+        if self.cleaning is not None:
+            return defer.succeed(None)
+        self.cleaning = self.in_thread(self.retention.run)
+        self.cleaning.addErrback(
+            lambda failure: logger.error(
+                "Retention failed", exc_info=failure_to_exc_info(failure)
+            )
+        )
+        self.cleaning.addBoth(self._cleaned_up)
+        return self.cleaning
+
+    def _cleaned_up(self, _):
+        self.cleaning = None
+
+    def on_transition(self, transition, spider):  # pylint: disable=W0613
+        """Sends the notification of a transition right away"""
+        self.drain()
+
+    @defer.inlineCallbacks
+    def run(self):
+        """Runs sweeps until stop is called"""
+        self.running = True
+        self.drain_loop.start(self.settings.getfloat("DAEMON_DRAIN_INTERVAL", 1.0))
+        self.retention_loop.start(
+            self.settings.getfloat("RETENTION_INTERVAL_HOURS", 24.0) * 3600, now=False
+        )
+        while self.running:
+            started = datetime.datetime.utcnow()
+            try:
+                crawler = self.runner.create_crawler(AvailabilitySpider)
+                crawler.signals.connect(self.on_transition, signal=transition_detected)
+                yield self.runner.crawl(crawler)
+            except Exception:  # pylint: disable=broad-except
+                logger.exception("Availability sweep failed")
+            if not self.running:
+                break
+            yield self.drain()
+            delay = yield self.in_thread(self.sweep_delay)
+            logger.info(
+                "Sweep took %s, next sweep in %.0fs",
+                datetime.datetime.utcnow() - started,
+                delay,
+            )
+            self.sleeping = task.deferLater(self.clock, delay, lambda: None)
+            try:
+                yield self.sleeping
+            except defer.CancelledError:
+                pass
+            self.sleeping = None
+
+    @defer.inlineCallbacks
+    def stop(self):
+        """Stops the running sweep and sends the notifications it recorded"""
+        self.running = False
+        if self.sleeping is not None:
+            self.sleeping.cancel()
+        yield self.runner.stop()
+        if self.drain_loop.running:
+            self.drain_loop.stop()
+        if self.retention_loop.running:
+            self.retention_loop.stop()
+        if self.cleaning is not None:
+            yield self.cleaning
+        if self.draining is not None:
+            yield self.draining
+        yield self.drain()
+
+
+def _stopped(result, daemon: AvailabilityDaemon):
+    """Stops the reactor if the daemon stopped on its own, e.g. on an error"""
+    if isinstance(result, Failure):
+        logger.error("Daemon failed", exc_info=failure_to_exc_info(result))
+    if daemon.running:
+        daemon.running = False
+        reactor.stop()  # pylint: disable=E1101
+
+
+def main():
+    """Runs the daemon until the process is interrupted"""
+    settings = get_project_settings()
+    configure_logging(settings)
+    config = dotenv_values(".env")
+    telegram_bot = LegoRestockBot(
+        config["TELEGRAM_BOT_TOKEN"],
+        config["TELEGRAM_CHANNEL_ID"],
+        con_pool_size=settings.getint("TELEGRAM_MAX_WORKERS", 4),
+    )
+    dispatcher = NotificationDispatcher.from_settings(settings, telegram_bot.bot)
+    metrics = Metrics()
+    if settings.get("METRICS_PROMETHEUS_PORT") is not None:
+        serve_metrics(
+            settings.getint("METRICS_PROMETHEUS_PORT"),
+            settings.get("METRICS_PROMETHEUS_INTERFACE", "127.0.0.1"),
+        ).register("outbox", metrics)
+    daemon = AvailabilityDaemon(
+        settings,
+        OutboxSender.from_settings(
+            settings, db_connect(settings), telegram_bot, dispatcher, metrics
+        ),
+    )
+    # pylint: disable=E1101
+    reactor.addSystemEventTrigger("before", "shutdown", daemon.stop)
+    reactor.addSystemEventTrigger("after", "shutdown", dispatcher.close)
+    daemon.run().addBoth(_stopped, daemon)
+    reactor.run()
+
+
+if __name__ == "__main__":
+    main()
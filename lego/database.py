@@ -1,4 +1,4 @@
-# pylint: disable=R0903
+# pylint: disable=R0903,C0302
 
 """ A collection of functions to work with the Lego products database and SQLalchemy
 
@@ -6,23 +6,44 @@ It includes functions for creating tables, selecting, updating and deleting entr
 Also the tables, columns and relationships of the database are defined
 """
 
-from typing import List
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple
 import datetime
+import time
+import uuid
+import weakref
 from sqlalchemy import (
+    bindparam,
+    Boolean,
+    case,
     create_engine,
     Column,
+    delete,
     ForeignKey,
     func,
+    Index,
+    insert,
+    inspect,
     Integer,
+    JSON,
+    literal,
+    or_,
     String,
     DateTime,
+    event,
+    select,
+    tuple_,
+    update,
 )
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.engine import make_url
 from sqlalchemy.engine.base import Engine
-from sqlalchemy.orm import relationship
+from sqlalchemy.orm import aliased, relationship
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm.session import Session
+from sqlalchemy.pool import QueuePool
 from sqlalchemy.sql.expression import asc
 from scrapy.utils.project import get_project_settings
+from lego import migrations
 
 
 Base = declarative_base()
@@ -42,24 +63,253 @@ class Product(Base):
 
 
 class Availability(Base):
-    """Class defining the Availability table"""
+    """Class defining the Availability table
+
+    Each entry is an interval in which the product had the same availability, from
+    the first observation (timestamp) to the latest observation (last_seen).
+    Without run length encoding every observation is stored as its own entry
+    """
 
     __tablename__ = "availability"
+    __table_args__ = (
+        Index("ix_availability_product_id_timestamp", "product_id", "timestamp"),
+        Index("ix_availability_timestamp", "timestamp"),
+    )
 
     id = Column(Integer, primary_key=True)
     availability = Column("availability", Integer())
-    product_id = Column("product_id", ForeignKey("products.id"))
+    product_id = Column("product_id", ForeignKey("products.product_id"))
     timestamp = Column(DateTime(timezone=True), server_default=func.now())
+    last_seen = Column("last_seen", DateTime(timezone=True))
+
+
+class ProductStatus(Base):
+    """Class defining the ProductStatus table
+
+    Holds the latest state of the availability history of each product. It is
+    updated in the same transaction as new entries are added to the Availability table
+    """
+
+    __tablename__ = "product_status"
+
+    product_id = Column(
+        "product_id", ForeignKey("products.product_id"), primary_key=True
+    )
+    availability = Column("availability", Integer())
+    previous_availability = Column("previous_availability", Integer())
+    last_changed = Column("last_changed", DateTime(timezone=True))
+    last_seen = Column("last_seen", DateTime(timezone=True))
+    interval_id = Column("interval_id", ForeignKey("availability.id"))
+
+
+class PriceHistory(Base):
+    """Class defining the PriceHistory table
+
+    Holds an entry for every change of the price of a product. The price before the
+    first change is the previous_price of the first entry
+    """
+
+    __tablename__ = "price_history"
+    __table_args__ = (
+        Index("ix_price_history_product_id_changed_at", "product_id", "changed_at"),
+    )
+
+    id = Column(Integer, primary_key=True)
+    product_id = Column("product_id", ForeignKey("products.product_id"))
+    price = Column("price", Integer())
+    previous_price = Column("previous_price", Integer())
+    changed_at = Column("changed_at", DateTime(timezone=True))
+
+
+class PageFingerprint(Base):
+    """Class defining the PageFingerprint table
+
+    Holds the HTTP validators and a hash of the product information of each product
+    page to detect unchanged pages
+    """
+
+    __tablename__ = "page_fingerprints"
+
+    url = Column("url", String(512), primary_key=True)
+    etag = Column("etag", String(256))
+    last_modified = Column("last_modified", String(64))
+    content_hash = Column("content_hash", String(64))
+    checked_at = Column("checked_at", DateTime(timezone=True))
+
+
+class Notification(Base):
+    """Class defining the Notification table, the outbox of the notifications
+
+    An entry is added in the same transaction that records a change of a product, e.g.
+    an availability transition. The idempotency_key identifies the change, so a change
+    is only queued once. The state is pending, sending, sent, failed or skipped
+    """
+
+    __tablename__ = "notification_outbox"
+    __table_args__ = (Index("ix_notification_outbox_state", "state", "id"),)
+
+    id = Column(Integer, primary_key=True)
+    idempotency_key = Column("idempotency_key", String(128), unique=True)
+    kind = Column("kind", String(32))
+    product_id = Column("product_id", ForeignKey("products.product_id"))
+    old_value = Column("old_value", Integer())
+    new_value = Column("new_value", Integer())
+    changed_at = Column("changed_at", DateTime(timezone=True))
+    created_at = Column("created_at", DateTime(timezone=True))
+    state = Column("state", String(16), default="pending")
+    attempts = Column("attempts", Integer(), default=0)
+    claim_token = Column("claim_token", String(32))
+    claimed_at = Column("claimed_at", DateTime(timezone=True))
+    sent_at = Column("sent_at", DateTime(timezone=True))
+    last_error = Column("last_error", String(512))
+
+
+class QuarantinedStatus(Base):
+    """Class defining the QuarantinedStatus table
+
+    Holds the availability strings of product pages which are not in
+    AVAILABILITY_CODES, with the last product showing them and how often they were seen
+    """
+
+    __tablename__ = "quarantined_statuses"
+
+    text = Column("text", String(256), primary_key=True)
+    product_id = Column("product_id", Integer())
+    url = Column("url", String(512))
+    first_seen = Column("first_seen", DateTime(timezone=True))
+    last_seen = Column("last_seen", DateTime(timezone=True))
+    count = Column("count", Integer(), default=0)
+
+
+class CrawlRun(Base):
+    """Class defining the CrawlRun table
+
+    Holds a summary of every crawl: its counters and, as JSON, the numeric crawl stats
+    and the latency histograms of metrics.py
+    """
+
+    __tablename__ = "crawl_runs"
+
+    id = Column(Integer, primary_key=True)
+    spider = Column("spider", String(64))
+    started_at = Column("started_at", DateTime(timezone=True))
+    finished_at = Column("finished_at", DateTime(timezone=True))
+    finish_reason = Column("finish_reason", String(64))
+    items_scraped = Column("items_scraped", Integer(), default=0)
+    items_dropped = Column("items_dropped", Integer(), default=0)
+    responses = Column("responses", Integer(), default=0)
+    errors = Column("errors", Integer(), default=0)
+    stats = Column("stats", JSON())
+    metrics = Column("metrics", JSON())
+
+
+class FrontierPage(Base):
+    """Class defining the FrontierPage table
+
+    Holds every page discovered by the LegoProductSpider. Pending pages still have to
+    be crawled in the current discovery run. For listing pages a hash of their links
+    is kept to detect when they changed
+    """
+
+    __tablename__ = "crawl_frontier"
+    __table_args__ = (Index("ix_crawl_frontier_pending", "pending"),)
+
+    url = Column("url", String(512), primary_key=True)
+    is_listing = Column("is_listing", Boolean(), default=True)
+    pending = Column("pending", Boolean(), default=True)
+    discovered_at = Column("discovered_at", DateTime(timezone=True))
+    crawled_at = Column("crawled_at", DateTime(timezone=True))
+    links_hash = Column("links_hash", String(64))
+    changed_at = Column("changed_at", DateTime(timezone=True))
+
 
+# Engines created by db_connect, shared by all users of the same database settings
+_ENGINES: Dict[tuple, Engine] = {}
+_PREPARED_ENGINES = weakref.WeakSet()
 
-def db_connect():
-    """Returns sqlalchemy engine instance using the database settings from settings.py"""
-    return create_engine(get_project_settings().get("CONNECTION_STRING"))
+DEFAULT_SQLITE_PRAGMAS = {
+    "auto_vacuum": "incremental",
+    "journal_mode": "wal",
+    "synchronous": "normal",
+    "busy_timeout": 10000,
+}
+
+
+def _set_sqlite_pragmas(engine: Engine, pragmas: Dict[str, object]):
+    """Executes the PRAGMA statements on every new connection of the engine"""
+
+    @event.listens_for(engine, "connect")
+    def set_pragmas(dbapi_connection, connection_record):  # pylint: disable=W0613
+        cursor = dbapi_connection.cursor()
+        # auto_vacuum only takes effect if set before the journal mode of a new database
+        for name, value in sorted(pragmas.items(), key=lambda p: p[0] != "auto_vacuum"):
+            cursor.execute(f"PRAGMA {name} = {value}")
+        cursor.close()
+
+
+def db_connect(settings=None) -> Engine:
+    """Returns sqlalchemy engine instance using the database settings from settings.py
+
+    The settings of a crawler can be passed to override the project settings.
+    Engines are created once per process and database settings and shared by all
+    callers. Connections to SQLite files are pooled with DB_POOL_SIZE and
+    DB_MAX_OVERFLOW and open with the SQLITE_PRAGMAS, by default in WAL mode, so the
+    database can be read while the crawl writes to it
+    """
+    if settings is None:
+        settings = get_project_settings()
+    connection_string = settings.get("CONNECTION_STRING")
+    pool_size = settings.getint("DB_POOL_SIZE", 5)
+    max_overflow = settings.getint("DB_MAX_OVERFLOW", 10)
+    pragmas = dict(DEFAULT_SQLITE_PRAGMAS)
+    pragmas.update(settings.getdict("SQLITE_PRAGMAS"))
+    key = (connection_string, pool_size, max_overflow, tuple(sorted(pragmas.items())))
+    if key in _ENGINES:
+        return _ENGINES[key]
+
+    url = make_url(connection_string)
+    options = {}
+    if url.get_backend_name() != "sqlite" or url.database not in (None, "", ":memory:"):
+        options.update(
+            poolclass=QueuePool, pool_size=pool_size, max_overflow=max_overflow
+        )
+    if url.get_backend_name() == "sqlite":
+        # Connections are shared between the reactor and the database writer thread
+        options["connect_args"] = {"check_same_thread": False}
+    engine = create_engine(connection_string, **options)
+    if url.get_backend_name() == "sqlite":
+        _set_sqlite_pragmas(engine, pragmas)
+    _ENGINES[key] = engine
+    return engine
+
+
+def dispose_engines():
+    """Closes the connections of all engines created by db_connect and forgets them
+
+    Call this before the database file is removed or replaced, or in a forked process
+    """
+    for engine in _ENGINES.values():
+        engine.dispose()
+        _PREPARED_ENGINES.discard(engine)
+    _ENGINES.clear()
 
 
 def create_table(engine):
-    """Creates all tables if they don't exist yet"""
+    """Creates all tables if they don't exist yet
+
+    New databases are marked with the latest schema version, existing databases
+    are upgraded by applying the pending migrations from migrations.py.
+    This is done once per engine
+    """
+    if engine in _PREPARED_ENGINES:
+        return
+    is_new_database = not inspect(engine).has_table(Availability.__tablename__)
+    if not is_new_database:
+        migrations.upgrade(engine)
     Base.metadata.create_all(engine)
+    if is_new_database:
+        migrations.stamp(engine)
+    _PREPARED_ENGINES.add(engine)
 
 
 def select_all_products(engine: Engine) -> List[Product]:
@@ -73,7 +323,162 @@ def select_all_products(engine: Engine) -> List[Product]:
 
 def load_product_urls(engine: Engine) -> List[str]:
     """Returns the list of strings of all product urls"""
-    return [p.url for p in select_all_products(engine)]
+    return list(iter_product_urls(engine))
+
+
+def _filter_products(
+    query,
+    max_age: Optional[datetime.timedelta] = None,
+    availabilities: Optional[Iterable[int]] = None,
+    shard: Optional[Tuple[int, int]] = None,
+):
+    """Restricts a query on the Product table to products due for a refresh
+
+    Optional filters:
+        - max_age: only products not seen within max_age
+        - availabilities: only products whose current availability is in the list
+        - shard: tuple (index, count), only products whose lego product id modulo
+          count is index
+    """
+    if shard is not None:
+        index, count = shard
+        query = query.where(Product.product_id % count == index)
+    if max_age is not None:
+        query = query.where(
+            or_(
+                ProductStatus.last_seen.is_(None),
+                ProductStatus.last_seen < datetime.datetime.utcnow() - max_age,
+            )
+        )
+    if availabilities is not None:
+        query = query.where(ProductStatus.availability.in_(list(availabilities)))
+    return query
+
+
+def _iter_product_chunks(engine: Engine, query, chunk_size: int) -> Iterator:
+    """Yields the rows of a query on the Product table in chunks of chunk_size
+
+    Every chunk is read in its own short transaction (keyset pagination on the
+    primary key), so memory stays constant and no read transaction blocks writers
+    while the rows are consumed. The query has to select Product.id
+    """
+    query = query.order_by(Product.id).limit(chunk_size)
+    last_id = 0
+    while True:
+        with Session(engine) as session:
+            rows = session.execute(query.where(Product.id > last_id)).all()
+        if not rows:
+            return
+        yield from rows
+        last_id = rows[-1].id
+
+
+def iter_product_urls(
+    engine: Engine,
+    max_age: Optional[datetime.timedelta] = None,
+    availabilities: Optional[Iterable[int]] = None,
+    chunk_size: int = 1000,
+    shard: Optional[Tuple[int, int]] = None,
+) -> Iterator[str]:
+    """Yields the product urls in chunks of chunk_size
+    Only the url column is selected
+
+    Optional filters:
+        - max_age: only products not seen within max_age
+        - availabilities: only products whose current availability is in the list
+        - shard: tuple (index, count), only the products of one of count shards
+    """
+    query = select(Product.id, Product.url).outerjoin(
+        ProductStatus, ProductStatus.product_id == Product.product_id
+    )
+    query = _filter_products(query, max_age, availabilities, shard)
+    for row in _iter_product_chunks(engine, query, chunk_size):
+        yield row.url
+
+
+def iter_product_schedule(  # pylint: disable=R0913
+    engine: Engine,
+    since: datetime.datetime,
+    *,
+    max_age: Optional[datetime.timedelta] = None,
+    availabilities: Optional[Iterable[int]] = None,
+    chunk_size: int = 1000,
+    shard: Optional[Tuple[int, int]] = None,
+) -> Iterator[dict]:
+    """Yields the information for scheduling the availability check of each product
+
+    Takes the same filters as iter_product_urls.
+    Yields dicts of format:
+    {
+        "product_id": <lego product id>,
+        "url": <url to lego product page>,
+        "availability": <current integer code for availability or None>,
+        "last_changed": <timestamp of the last change or None>,
+        "last_seen": <timestamp of the latest observation or None>,
+        "transitions": <number of availability changes after since>,
+        "etag": <ETag of the product page or None>,
+        "last_modified": <Last-Modified of the product page or None>,
+        "content_hash": <hash of the product information or None>
+    }
+    """
+    # The window starts at the last entry before since, so the first entry after
+    # since is compared with the availability it changed from
+    earlier = aliased(Availability)
+    window_start = (
+        select(func.max(earlier.timestamp))
+        .where(earlier.product_id == Product.product_id)
+        .where(earlier.timestamp < since)
+        .correlate(Product)
+        .scalar_subquery()
+    )
+    history = (
+        select(
+            Availability.availability,
+            Availability.timestamp,
+            func.lag(Availability.availability)
+            .over(order_by=(Availability.timestamp, Availability.id))
+            .label("previous"),
+        )
+        .where(Availability.product_id == Product.product_id)
+        .where(Availability.timestamp >= func.coalesce(window_start, since))
+        .correlate(Product)
+        .subquery()
+    )
+    transitions = (
+        select(func.count())
+        .select_from(history)
+        .where(history.c.timestamp >= since)
+        .where(history.c.availability != history.c.previous)
+        .scalar_subquery()
+    )
+    query = select(
+        Product.id,
+        Product.product_id,
+        Product.url,
+        ProductStatus.availability,
+        ProductStatus.last_changed,
+        ProductStatus.last_seen,
+        transitions.label("transitions"),
+        PageFingerprint.etag,
+        PageFingerprint.last_modified,
+        PageFingerprint.content_hash,
+    )
+    query = query.outerjoin(
+        ProductStatus, ProductStatus.product_id == Product.product_id
+    ).outerjoin(PageFingerprint, PageFingerprint.url == Product.url)
+    query = _filter_products(query, max_age, availabilities, shard)
+    for row in _iter_product_chunks(engine, query, chunk_size):
+        yield {
+            "product_id": row.product_id,
+            "url": row.url,
+            "availability": row.availability,
+            "last_changed": row.last_changed,
+            "last_seen": row.last_seen,
+            "transitions": row.transitions,
+            "etag": row.etag,
+            "last_modified": row.last_modified,
+            "content_hash": row.content_hash,
+        }
 
 
 def load_product_ids(engine: Engine) -> List[int]:
@@ -81,6 +486,20 @@ def load_product_ids(engine: Engine) -> List[int]:
     return [p.product_id for p in select_all_products(engine)]
 
 
+def load_product_prices(engine: Engine) -> Dict[int, int]:
+    """Returns a dict mapping all lego product ids to their price in cents"""
+    with Session(engine) as session:
+        rows = session.query(Product.product_id, Product.price).all()
+    return dict(rows)
+
+
+def load_product_availabilities(engine: Engine) -> Dict[int, int]:
+    """Returns a dict mapping the lego product ids to their current availability"""
+    with Session(engine) as session:
+        rows = session.query(ProductStatus.product_id, ProductStatus.availability).all()
+    return dict(rows)
+
+
 def get_product_name(product_id_to_search: int, engine: Engine) -> str:
     """Retrieves the product name from the Product table for a given product id"""
     with Session(engine) as session:
@@ -110,9 +529,12 @@ def does_product_exist(product_id_to_search: int, engine: Engine) -> bool:
 def get_availabilities(product_id_to_search: int, engine: Engine):
     """Returns all availability entries for a given lego product id
 
+    Every entry covers the interval from timestamp to last_seen in which the product
+    had the same availability.
     Returns a list of dicts of format:
     {
-        "timestamp": <timestamp of entry>,
+        "timestamp": <timestamp of the first observation>,
+        "last_seen": <timestamp of the latest observation>,
         "availability": <integer code for availability>
     }
     """
@@ -124,12 +546,64 @@ def get_availabilities(product_id_to_search: int, engine: Engine):
             .all()
         )
         ret = [
-            {"timestamp": a.timestamp, "availability": a.availability}
+            {
+                "timestamp": a.timestamp,
+                "last_seen": a.last_seen or a.timestamp,
+                "availability": a.availability,
+            }
             for a in availabilites
         ]
         return ret
 
 
+def iter_availability_chunks(engine: Engine, chunk_size: int = 100000) -> Iterator:
+    """Yields all entries of the Availability table in lists of chunk_size rows
+
+    The rows are tuples (product_id, availability, timestamp, last_seen, id) ordered by
+    product, timestamp and id, with a missing last_seen replaced by the timestamp.
+    They are read with a raw DBAPI cursor, as ORM rows cost more than the whole
+    export. The timestamps are returned as stored, ISO strings in SQLite, which numpy
+    parses much faster than datetime objects. Every chunk is a single SELECT with
+    keyset pagination on the product_id and timestamp index, so no read transaction
+    blocks the checkpoints of a crawl writing meanwhile
+    """
+    columns = (
+        "SELECT product_id, availability, timestamp, "
+        f"coalesce(last_seen, timestamp), id FROM {Availability.__tablename__} "
+    )
+    order = "ORDER BY product_id, timestamp, id LIMIT ?"
+    raw_connection = engine.raw_connection()
+    try:
+        cursor = raw_connection.cursor()
+        cursor.execute(columns + order, (chunk_size,))
+        while True:
+            rows = cursor.fetchall()
+            if not rows:
+                return
+            yield rows
+            last = rows[-1]
+            cursor.execute(
+                columns + "WHERE (product_id, timestamp, id) > (?, ?, ?) " + order,
+                (last[0], last[2], last[4], chunk_size),
+            )
+    finally:
+        raw_connection.close()
+
+
+def iter_products(engine: Engine, chunk_size: int = 1000) -> Iterator:
+    """Yields the product_id, name, price and url of all products, read in chunks"""
+    query = select(
+        Product.id, Product.product_id, Product.name, Product.price, Product.url
+    )
+    yield from _iter_product_chunks(engine, query, chunk_size)
+
+
+def get_product_status(product_id: int, engine: Engine) -> ProductStatus:
+    """Returns the ProductStatus object for a given product id or None"""
+    with Session(engine) as session:
+        return session.get(ProductStatus, product_id)
+
+
 def get_product(product_id: int, engine: Engine) -> Product:
     """Returns a Product object from the Product table for a given product id"""
     with Session(engine) as session:
@@ -155,17 +629,839 @@ def update_product_price(product: Product, engine: Engine):
         session.commit()
 
 
+def _as_datetime(timestamp) -> datetime.datetime:
+    """Returns dates as datetimes at midnight and the current time for None"""
+    if timestamp is None:
+        return datetime.datetime.utcnow()
+    if not isinstance(timestamp, datetime.datetime):
+        return datetime.datetime.combine(timestamp, datetime.time())
+    return timestamp
+
+
+def _write_availabilities(
+    session: Session, availabilities: List[dict], run_length_encoding: bool
+):
+    """Adds availability entries and applies them to the ProductStatus table
+    Every availability transition is queued in the Notification table
+
+    With run length encoding an entry with the same availability as the current
+    interval of the product only moves the last_seen timestamp of that interval.
+    Entries older than the last seen entry of a product don't change its status.
+    Entries without availability confirm the current availability of the product
+    """
+    statuses = {
+        status.product_id: status
+        for status in session.query(ProductStatus).filter(
+            ProductStatus.product_id.in_({a["product_id"] for a in availabilities})
+        )
+    }
+    new_intervals = {}
+    extended_intervals = {}
+    notifications = []
+    for entry in sorted(availabilities, key=lambda a: a["timestamp"]):
+        product_id = entry["product_id"]
+        timestamp = entry["timestamp"]
+        status = statuses.get(product_id)
+
+        if entry["availability"] is None:
+            if status is None:
+                continue
+            entry = {**entry, "availability": status.availability}
+
+        if status is not None and timestamp < _as_datetime(status.last_seen):
+            session.add(Availability(**entry, last_seen=timestamp))
+            continue
+
+        if status is None:
+            status = ProductStatus(
+                product_id=product_id,
+                availability=entry["availability"],
+                last_changed=timestamp,
+            )
+            session.add(status)
+            statuses[product_id] = status
+        elif status.availability != entry["availability"]:
+            notifications.append(
+                notification_entry(
+                    "availability",
+                    product_id,
+                    status.availability,
+                    entry["availability"],
+                    timestamp,
+                )
+            )
+            status.previous_availability = status.availability
+            status.availability = entry["availability"]
+            status.last_changed = timestamp
+        elif run_length_encoding and product_id in new_intervals:
+            new_intervals[product_id].last_seen = timestamp
+            status.last_seen = timestamp
+            continue
+        elif run_length_encoding and status.interval_id is not None:
+            extended_intervals[status.interval_id] = timestamp
+            status.last_seen = timestamp
+            continue
+
+        status.last_seen = timestamp
+        new_intervals[product_id] = Availability(**entry, last_seen=timestamp)
+        session.add(new_intervals[product_id])
+
+    session.flush()
+    for product_id, interval in new_intervals.items():
+        statuses[product_id].interval_id = interval.id
+    if extended_intervals:
+        session.execute(
+            update(Availability)
+            .where(Availability.id == bindparam("interval_id"))
+            .values(last_seen=bindparam("interval_last_seen"))
+            .execution_options(synchronize_session=False),
+            [
+                {"interval_id": interval_id, "interval_last_seen": last_seen}
+                for interval_id, last_seen in extended_intervals.items()
+            ],
+        )
+    add_notifications(session, notifications)
+
+
+def notification_entry(
+    kind: str,
+    product_id: int,
+    old_value: Optional[int],
+    new_value: Optional[int],
+    changed_at: datetime.datetime,
+) -> dict:
+    """Returns an entry of the Notification table for a change of a product
+
+    The idempotency key is built from the kind, the product id and the time of the
+    change, so recording the same change again doesn't queue another notification
+    """
+    return {
+        "idempotency_key": f"{kind}:{product_id}:{changed_at.isoformat()}",
+        "kind": kind,
+        "product_id": product_id,
+        "old_value": old_value,
+        "new_value": new_value,
+        "changed_at": changed_at,
+        "created_at": datetime.datetime.utcnow(),
+        "state": "pending",
+        "attempts": 0,
+    }
+
+
+def add_notifications(session: Session, notifications: List[dict]):
+    """Queues notifications within the transaction of the session
+
+    Notifications with an already queued idempotency key are ignored
+    """
+    if notifications:
+        session.execute(
+            sqlite_insert(Notification)
+            .values(notifications)
+            .on_conflict_do_nothing(index_elements=[Notification.idempotency_key])
+        )
+
+
+def queue_notifications(notifications: List[dict], engine: Engine):
+    """Queues notifications in their own transaction"""
+    with Session(engine) as session:
+        add_notifications(session, notifications)
+        session.commit()
+
+
+def claim_notifications(
+    engine: Engine, limit: int = 100, lease: datetime.timedelta = None
+) -> List[dict]:
+    """Claims the oldest pending notifications for sending
+
+    The notifications are moved to the sending state in one statement, so concurrent
+    senders never claim the same notification. Notifications left in the sending state
+    for longer than lease, e.g. by a crashed sender, are claimed again.
+    Returns a list of dicts of format:
+    {
+        "id": <id of the notification>,
+        "kind": <kind of the change, e.g. "availability">,
+        "product_id": <lego product id>,
+        "name": <product name>,
+        "url": <url to lego product page>,
+        "price": <price in cents>,
+        "old_value": <value before the change>,
+        "new_value": <value after the change>,
+        "changed_at": <timestamp of the change>,
+        "attempts": <number of claims including this one>
+    }
+    """
+    now = datetime.datetime.utcnow()
+    claimable = Notification.state == "pending"
+    if lease is not None:
+        claimable = or_(
+            claimable,
+            (Notification.state == "sending") & (Notification.claimed_at < now - lease),
+        )
+    token = uuid.uuid4().hex
+    ids = (
+        select(Notification.id)
+        .where(claimable)
+        .order_by(Notification.id)
+        .limit(limit)
+        .scalar_subquery()
+    )
+    with Session(engine) as session:
+        session.execute(
+            update(Notification)
+            .where(Notification.id.in_(ids))
+            .values(
+                state="sending",
+                claim_token=token,
+                claimed_at=now,
+                attempts=Notification.attempts + 1,
+            )
+            .execution_options(synchronize_session=False)
+        )
+        session.commit()
+        rows = session.execute(
+            select(
+                Notification.id,
+                Notification.kind,
+                Notification.product_id,
+                Product.name,
+                Product.url,
+                Product.price,
+                Notification.old_value,
+                Notification.new_value,
+                Notification.changed_at,
+                Notification.attempts,
+            )
+            .join(Product, Product.product_id == Notification.product_id)
+            .where(Notification.claim_token == token)
+            .order_by(Notification.id)
+        ).all()
+    return [row._asdict() for row in rows]
+
+
+def finish_notifications(results: List[dict], engine: Engine, max_attempts: int = 5):
+    """Records the outcome of sending claimed notifications
+
+    Expects a list of dicts of format:
+    {
+        "id": <id of the notification>,
+        "state": <"sent", "failed" or "skipped">,
+        "error": <error message or None>
+    }
+    Failed notifications are pending again until they failed max_attempts times
+    """
+    if not results:
+        return
+    now = datetime.datetime.utcnow()
+    failed = bindparam("notification_state") == "failed"
+    with Session(engine) as session:
+        session.execute(
+            update(Notification)
+            .where(Notification.id == bindparam("notification_id"))
+            .values(
+                state=case(
+                    (
+                        failed & (Notification.attempts < max_attempts),
+                        "pending",
+                    ),
+                    else_=bindparam("notification_state"),
+                ),
+                sent_at=bindparam("notification_sent_at"),
+                last_error=bindparam("notification_error"),
+                claim_token=None,
+            )
+            .execution_options(synchronize_session=False),
+            [
+                {
+                    "notification_id": result["id"],
+                    "notification_state": result["state"],
+                    "notification_sent_at": now if result["state"] == "sent" else None,
+                    "notification_error": (result.get("error") or "")[:512] or None,
+                }
+                for result in results
+            ],
+        )
+        session.commit()
+
+
+def count_notifications(engine: Engine) -> Dict[str, int]:
+    """Returns the number of notifications in each state"""
+    with Session(engine) as session:
+        rows = session.execute(
+            select(Notification.state, func.count(Notification.id)).group_by(
+                Notification.state
+            )
+        ).all()
+    return dict(rows)
+
+
 def add_availability(availability: Availability, engine: Engine):
     """Add a new Availability object to the Availability table"""
+    add_availabilities(
+        [
+            {
+                "product_id": availability.product_id,
+                "availability": availability.availability,
+                "timestamp": availability.timestamp,
+            }
+        ],
+        engine,
+    )
+
+
+def add_availabilities(
+    availabilities: List[dict], engine: Engine, run_length_encoding: bool = False
+):
+    """Add several Availability entries to the Availability table in one transaction
+    The ProductStatus table is updated in the same transaction
+
+    With run_length_encoding a new entry is only added if the availability of the
+    product changed. Otherwise the last_seen timestamp of its latest entry is moved.
+
+    The fingerprints of the product pages are saved in the same transaction, so a
+    page is only skipped as unchanged by the next crawl if its availability is stored.
+
+    Expects a list of dicts of format:
+    {
+        "product_id": <lego product id>,
+        "availability": <integer code for availability or None if unchanged>,
+        "timestamp": <timestamp of entry>,
+        "fingerprint": <optional fingerprint of the page, see save_page_fingerprints>
+    }
+    """
+    if not availabilities:
+        return
+    entries = []
+    fingerprints = []
+    for entry in availabilities:
+        entry = {**entry, "timestamp": _as_datetime(entry.get("timestamp"))}
+        fingerprint = entry.pop("fingerprint", None)
+        if fingerprint:
+            fingerprints.append(fingerprint)
+        entries.append(entry)
+    with Session(engine) as session:
+        _write_availabilities(session, entries, run_length_encoding)
+        _write_page_fingerprints(session, fingerprints)
+        session.commit()
+
+
+def _write_page_fingerprints(session: Session, fingerprints: List[dict]):
+    """Inserts or replaces page fingerprints within the transaction of the session"""
+    if not fingerprints:
+        return
+    latest = {fingerprint["url"]: fingerprint for fingerprint in fingerprints}
+    statement = sqlite_insert(PageFingerprint).values(list(latest.values()))
+    statement = statement.on_conflict_do_update(
+        index_elements=[PageFingerprint.url],
+        set_={
+            "etag": statement.excluded.etag,
+            "last_modified": statement.excluded.last_modified,
+            "content_hash": statement.excluded.content_hash,
+            "checked_at": statement.excluded.checked_at,
+        },
+    )
+    session.execute(statement)
+
+
+def save_page_fingerprints(fingerprints: List[dict], engine: Engine):
+    """Inserts or replaces several entries of the PageFingerprint table
+
+    Expects a list of dicts of format:
+    {
+        "url": <url to lego product page>,
+        "etag": <ETag response header or None>,
+        "last_modified": <Last-Modified response header or None>,
+        "content_hash": <hash of the product information>,
+        "checked_at": <timestamp of the response>
+    }
+    """
+    if not fingerprints:
+        return
     with Session(engine) as session:
-        session.add(availability)
+        _write_page_fingerprints(session, fingerprints)
         session.commit()
 
 
-def delete_old_availability_entries(min_timestamp: datetime, engine: Engine):
-    """Delete entries from the Availability tablee that are older than min_timestamp"""
+def quarantine_statuses(statuses: List[dict], engine: Engine):
+    """Records unknown availability strings in the QuarantinedStatus table
+
+    Expects a list of dicts of format:
+    {
+        "text": <availability string of the product page>,
+        "product_id": <lego product id>,
+        "url": <url to lego product page>,
+        "timestamp": <timestamp of the item>
+    }
+    """
+    if not statuses:
+        return
+    entries = {}
+    for status in sorted(statuses, key=lambda s: s["timestamp"]):
+        text = status["text"][:256]
+        entry = entries.setdefault(
+            text, {"text": text, "first_seen": status["timestamp"], "count": 0}
+        )
+        entry.update(
+            product_id=status["product_id"],
+            url=status["url"],
+            last_seen=status["timestamp"],
+            count=entry["count"] + 1,
+        )
+    statement = sqlite_insert(QuarantinedStatus).values(list(entries.values()))
+    statement = statement.on_conflict_do_update(
+        index_elements=[QuarantinedStatus.text],
+        set_={
+            "product_id": statement.excluded.product_id,
+            "url": statement.excluded.url,
+            "last_seen": statement.excluded.last_seen,
+            "count": QuarantinedStatus.count + statement.excluded.count,
+        },
+    )
+    with Session(engine) as session:
+        session.execute(statement)
+        session.commit()
+
+
+def load_quarantined_statuses(engine: Engine) -> List[QuarantinedStatus]:
+    """Returns all quarantined availability strings, the most frequent first"""
     with Session(engine) as session:
-        session.query(Availability).filter(
-            Availability.timestamp <= min_timestamp
-        ).delete()
+        return (
+            session.query(QuarantinedStatus)
+            .order_by(QuarantinedStatus.count.desc())
+            .all()
+        )
+
+
+def add_crawl_run(run: dict, engine: Engine):
+    """Adds the summary of a crawl to the CrawlRun table
+
+    Expects a dict with the columns of the CrawlRun table
+    """
+    with Session(engine) as session:
+        session.execute(insert(CrawlRun).values(**run))
+        session.commit()
+
+
+def get_crawl_runs(engine: Engine, limit: int = 10) -> List[CrawlRun]:
+    """Returns the latest crawl runs, the latest first"""
+    with Session(engine) as session:
+        return session.query(CrawlRun).order_by(CrawlRun.id.desc()).limit(limit).all()
+
+
+def get_page_fingerprint(url: str, engine: Engine) -> PageFingerprint:
+    """Returns the PageFingerprint object for a given url or None"""
+    with Session(engine) as session:
+        return session.get(PageFingerprint, url)
+
+
+def update_product_prices(
+    prices: Dict[int, int],
+    engine: Engine,
+    observed_at: Optional[Dict[int, datetime.datetime]] = None,
+    min_drop: Optional[float] = None,
+):
+    """Updates the prices of several products in the Product table in one transaction
+
+    Expects a dict mapping the lego product id to the new price in cents and
+    optionally a dict mapping the product ids to the time the price was seen.
+    Only prices which differ from the Product table are updated and added to the
+    PriceHistory table. With min_drop, a price drop of at least this fraction of the
+    previous price is queued in the Notification table
+    """
+    if not prices:
+        return
+    now = datetime.datetime.utcnow()
+    observed_at = observed_at or {}
+    with Session(engine) as session:
+        current = dict(
+            session.execute(
+                select(Product.product_id, Product.price).where(
+                    Product.product_id.in_(list(prices))
+                )
+            ).all()
+        )
+        changed = {
+            product_id: price
+            for product_id, price in prices.items()
+            if product_id in current and current[product_id] != price
+        }
+        if not changed:
+            return
+        session.execute(
+            update(Product)
+            .where(Product.product_id == bindparam("lego_product_id"))
+            .values(price=bindparam("new_price"))
+            .execution_options(synchronize_session=False),
+            [
+                {"lego_product_id": product_id, "new_price": price}
+                for product_id, price in changed.items()
+            ],
+        )
+        history = [
+            {
+                "product_id": product_id,
+                "price": price,
+                "previous_price": current[product_id],
+                "changed_at": observed_at.get(product_id, now),
+            }
+            for product_id, price in changed.items()
+        ]
+        session.execute(insert(PriceHistory), history)
+        if min_drop is not None:
+            add_notifications(
+                session,
+                [
+                    notification_entry(
+                        "price",
+                        entry["product_id"],
+                        entry["previous_price"],
+                        entry["price"],
+                        entry["changed_at"],
+                    )
+                    for entry in history
+                    if entry["previous_price"]
+                    and entry["price"] is not None
+                    and entry["price"] <= entry["previous_price"] * (1 - min_drop)
+                ],
+            )
+        session.commit()
+
+
+def get_price_history(product_id: int, engine: Engine) -> List[dict]:
+    """Returns the price changes of a product, the oldest first
+
+    Returns a list of dicts of format:
+    {
+        "price": <price in cents>,
+        "previous_price": <price in cents before the change>,
+        "changed_at": <timestamp of the change>
+    }
+    """
+    with Session(engine) as session:
+        rows = session.execute(
+            select(
+                PriceHistory.price, PriceHistory.previous_price, PriceHistory.changed_at
+            )
+            .where(PriceHistory.product_id == product_id)
+            .order_by(PriceHistory.changed_at, PriceHistory.id)
+        ).all()
+    return [row._asdict() for row in rows]
+
+
+def _retained_availabilities():
+    """Returns the condition excluding the current interval of every product"""
+    return Availability.id.not_in(
+        select(ProductStatus.interval_id).where(ProductStatus.interval_id.is_not(None))
+    )
+
+
+def delete_old_availability_entries(
+    min_timestamp: datetime.datetime,
+    engine: Engine,
+    chunk_size: int = 1000,
+    pause: float = 0.0,
+) -> int:
+    """Delete entries from the Availability table that are older than min_timestamp
+    An entry is old if its latest observation is older than min_timestamp.
+    The current interval of a product is kept.
+
+    Deletes at most chunk_size entries per transaction and sleeps pause seconds
+    between the transactions, so writers of a running crawl aren't blocked for long.
+    Returns the number of deleted entries
+    """
+    is_old = (
+        func.coalesce(Availability.last_seen, Availability.timestamp) <= min_timestamp
+    )
+    deleted = 0
+    position = 0
+    while True:
+        with Session(engine) as session:
+            ids = (
+                session.execute(
+                    select(Availability.id)
+                    .where(Availability.id > position)
+                    .where(is_old)
+                    .where(_retained_availabilities())
+                    .order_by(Availability.id)
+                    .limit(chunk_size)
+                )
+                .scalars()
+                .all()
+            )
+        if not ids:
+            return deleted
+        with Session(engine) as session:
+            result = session.execute(
+                delete(Availability)
+                .where(Availability.id.in_(ids))
+                .where(is_old)
+                .where(_retained_availabilities())
+                .execution_options(synchronize_session=False)
+            )
+            session.commit()
+        deleted += result.rowcount
+        position = ids[-1]
+        if len(ids) < chunk_size:
+            return deleted
+        time.sleep(pause)
+
+
+def _merge_availabilities(
+    extended: Dict[int, datetime.datetime], deleted: List[int], engine
+):
+    """Moves the last_seen of the extended entries and deletes the merged entries"""
+    with Session(engine) as session:
+        session.execute(
+            update(Availability)
+            .where(Availability.id == bindparam("interval_id"))
+            .values(last_seen=bindparam("interval_last_seen"))
+            .execution_options(synchronize_session=False),
+            [
+                {"interval_id": interval_id, "interval_last_seen": last_seen}
+                for interval_id, last_seen in extended.items()
+            ],
+        )
+        session.execute(
+            delete(Availability)
+            .where(Availability.id.in_(deleted))
+            .execution_options(synchronize_session=False)
+        )
+        session.commit()
+
+
+def downsample_availability_entries(
+    max_timestamp: datetime.datetime,
+    engine: Engine,
+    chunk_size: int = 1000,
+    pause: float = 0.0,
+) -> int:
+    """Merges consecutive entries of a product with the same availability into one
+
+    Only entries whose latest observation is older than max_timestamp are merged.
+    The first entry of a run is extended to the latest observation of the run and the
+    other entries are deleted, like run length encoding does for new entries.
+    Reads and writes at most chunk_size entries per transaction and sleeps pause
+    seconds between the transactions. Returns the number of deleted entries
+    """
+    last_seen = func.coalesce(Availability.last_seen, Availability.timestamp)
+    order = (Availability.product_id, Availability.timestamp, Availability.id)
+    query = (
+        select(
+            Availability.id,
+            Availability.product_id,
+            Availability.availability,
+            Availability.timestamp,
+            last_seen.label("last_seen"),
+        )
+        .where(last_seen < max_timestamp)
+        .where(_retained_availabilities())
+        .order_by(*order)
+        .limit(chunk_size)
+    )
+    run = {"id": None, "product_id": None, "availability": None}
+    merged = 0
+    after = []
+    while True:
+        with Session(engine) as session:
+            rows = session.execute(query.where(*after)).all()
+
+        extended = {}
+        deleted = []
+        for row in rows:
+            if (
+                run["product_id"] == row.product_id
+                and run["availability"] == row.availability
+            ):
+                run["last_seen"] = max(run["last_seen"], row.last_seen)
+                extended[run["id"]] = run["last_seen"]
+                deleted.append(row.id)
+            else:
+                run = row._asdict()
+        if deleted:
+            _merge_availabilities(extended, deleted, engine)
+            merged += len(deleted)
+        if len(rows) < chunk_size:
+            return merged
+        after = [
+            tuple_(*order)
+            > tuple_(
+                *[
+                    literal(getattr(rows[-1], column.name), column.type)
+                    for column in order
+                ]
+            )
+        ]
+        time.sleep(pause)
+
+
+def incremental_vacuum(engine: Engine, pages: int = 1000, pause: float = 0.0) -> int:
+    """Returns the free pages of an SQLite database to the file system
+
+    Frees at most pages pages per step. Only databases created with
+    auto_vacuum = incremental, see SQLITE_PRAGMAS in settings.py, support this.
+    Returns the number of freed pages
+    """
+    if engine.dialect.name != "sqlite":
+        return 0
+    raw_connection = engine.raw_connection()
+    try:
+        dbapi_connection = raw_connection.connection
+        if dbapi_connection.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            return 0
+        freed = 0
+        while True:
+            free = dbapi_connection.execute("PRAGMA freelist_count").fetchone()[0]
+            if free == 0:
+                return freed
+            # executescript steps the pragma until all pages are freed
+            dbapi_connection.executescript(f"PRAGMA incremental_vacuum({int(pages)})")
+            freed += min(free, pages)
+            time.sleep(pause)
+    finally:
+        raw_connection.close()
+
+
+def load_frontier_urls(engine: Engine) -> Set[str]:
+    """Returns the set of all urls in the FrontierPage table"""
+    with Session(engine) as session:
+        return set(session.execute(select(FrontierPage.url)).scalars())
+
+
+def has_pending_frontier_pages(engine: Engine) -> bool:
+    """Returns True if pages of an interrupted discovery run are left"""
+    with Session(engine) as session:
+        query = select(FrontierPage.url).where(FrontierPage.pending.is_(True))
+        return session.execute(query.limit(1)).first() is not None
+
+
+def schedule_frontier_pages(
+    engine: Engine,
+    urls: Iterable[str],
+    revisit_before: datetime.datetime,
+    changed_since: datetime.datetime,
+) -> int:
+    """Marks the pages of a new discovery run as pending
+
+    The given urls are always scheduled, they are added if they don't exist yet.
+    Listing pages are scheduled if they were never crawled, not crawled since
+    revisit_before or changed since changed_since.
+    Returns the number of scheduled pages
+    """
+    urls = list(urls)
+    now = datetime.datetime.utcnow()
+    with Session(engine) as session:
+        if urls:
+            session.execute(
+                sqlite_insert(FrontierPage)
+                .values(
+                    [
+                        {"url": url, "is_listing": True, "discovered_at": now}
+                        for url in urls
+                    ]
+                )
+                .on_conflict_do_nothing(index_elements=[FrontierPage.url])
+            )
+        result = session.execute(
+            update(FrontierPage)
+            .where(
+                or_(
+                    FrontierPage.url.in_(urls),
+                    FrontierPage.is_listing.is_(True)
+                    & or_(
+                        FrontierPage.crawled_at.is_(None),
+                        FrontierPage.crawled_at < revisit_before,
+                        FrontierPage.changed_at >= changed_since,
+                    ),
+                )
+            )
+            .values(pending=True)
+            .execution_options(synchronize_session=False)
+        )
+        session.commit()
+        return result.rowcount
+
+
+def iter_pending_frontier_pages(
+    engine: Engine, chunk_size: int = 1000
+) -> Iterator[FrontierPage]:
+    """Yields the pending pages of the discovery run in chunks of chunk_size"""
+    query = (
+        select(FrontierPage)
+        .where(FrontierPage.pending.is_(True))
+        .order_by(FrontierPage.url)
+        .limit(chunk_size)
+    )
+    last_url = ""
+    while True:
+        with Session(engine) as session:
+            pages = session.execute(query.where(FrontierPage.url > last_url)).scalars()
+            pages = pages.all()
+        if not pages:
+            return
+        yield from pages
+        last_url = pages[-1].url
+
+
+def update_frontier(discovered: List[dict], crawled: List[dict], engine: Engine):
+    """Adds discovered pages and marks crawled pages as done in one transaction
+
+    Expects lists of dicts of format:
+    discovered: {"url": <url>, "is_listing": <bool>, "discovered_at": <timestamp>}
+    crawled: {"url": <url>, "crawled_at": <timestamp>, "links_hash": <hash or None>}
+
+    The changed_at timestamp of a crawled page is set if the hash of its links changed
+    since the previous crawl
+    """
+    with Session(engine) as session:
+        if discovered:
+            session.execute(
+                sqlite_insert(FrontierPage)
+                .values([dict(page, pending=True) for page in discovered])
+                .on_conflict_do_nothing(index_elements=[FrontierPage.url])
+            )
+        if crawled:
+            links_hash = bindparam("page_links_hash")
+            crawled_at = bindparam("page_crawled_at")
+            session.execute(
+                update(FrontierPage)
+                .where(FrontierPage.url == bindparam("page_url"))
+                .values(
+                    pending=False,
+                    crawled_at=crawled_at,
+                    changed_at=case(
+                        (
+                            FrontierPage.links_hash.isnot(None)
+                            & (
+                                FrontierPage.links_hash != func.coalesce(links_hash, "")
+                            ),
+                            crawled_at,
+                        ),
+                        else_=FrontierPage.changed_at,
+                    ),
+                    links_hash=links_hash,
+                )
+                .execution_options(synchronize_session=False),
+                [
+                    {
+                        "page_url": page["url"],
+                        "page_crawled_at": page["crawled_at"],
+                        "page_links_hash": page["links_hash"],
+                    }
+                    for page in crawled
+                ],
+            )
+        session.commit()
+
+
+def finish_frontier(engine: Engine):
+    """Ends the discovery run by marking all remaining pending pages as done
+
+    Pages are left pending if the crawl filtered their requests, e.g. as duplicates
+    """
+    with Session(engine) as session:
+        session.execute(
+            update(FrontierPage)
+            .where(FrontierPage.pending.is_(True))
+            .values(pending=False)
+            .execution_options(synchronize_session=False)
+        )
         session.commit()
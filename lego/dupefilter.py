@@ -0,0 +1,199 @@
+"""Compact request dupefilter on canonical urls
+
+The CanonicalDupeFilter identifies GET requests by the canonical url of the page (see
+urls.py), so all url variants of a page are requested only once. The seen keys are
+kept in a ScalableBloomFilter, which needs a few bytes per page instead of a
+fingerprint string per request variant. With JOBDIR set, the state of the filter is
+saved when the spider closes and loaded when a paused crawl continues.
+
+Enable it with DUPEFILTER_CLASS in settings.py
+"""
+
+import hashlib
+import logging
+import math
+import os
+import pickle
+from typing import List, Optional
+from scrapy.dupefilters import BaseDupeFilter
+from scrapy.http import Request
+from scrapy.utils.request import referer_str
+from lego.urls import canonicalize_url, CANONICAL_QUERY_PARAMETERS
+
+try:
+    from scrapy.utils.request import fingerprint  # pylint: disable=C0412
+except ImportError:  # Scrapy < 2.7
+    from scrapy.utils.request import request_fingerprint  # pylint: disable=C0412
+
+    def fingerprint(request: Request) -> bytes:
+        """Returns the fingerprint of a request as bytes"""
+        return request_fingerprint(request).encode()
+
+
+logger = logging.getLogger(__name__)
+
+
+class BloomFilter:
+    """A fixed size Bloom filter for capacity keys with a false positive rate"""
+
+    def __init__(self, capacity: int, error_rate: float) -> None:
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.size = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        self.hashes = max(round(self.size / capacity * math.log(2)), 1)
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def positions(self, key: bytes) -> List[int]:
+        """Returns the bit positions of a key using double hashing"""
+        digest = hashlib.blake2b(key, digest_size=16).digest()
+        first = int.from_bytes(digest[:8], "little")
+        second = int.from_bytes(digest[8:], "little") | 1
+        return [(first + i * second) % self.size for i in range(self.hashes)]
+
+    def add(self, key: bytes) -> bool:
+        """Adds a key. Returns True if the key was probably added before"""
+        found = True
+        for position in self.positions(key):
+            mask = 1 << (position & 7)
+            if not self.bits[position >> 3] & mask:
+                found = False
+                self.bits[position >> 3] |= mask
+        if not found:
+            self.count += 1
+        return found
+
+    def __contains__(self, key: bytes) -> bool:
+        return all(
+            self.bits[position >> 3] & (1 << (position & 7))
+            for position in self.positions(key)
+        )
+
+
+class ScalableBloomFilter:
+    """A Bloom filter growing with the number of keys
+
+    A new filter with growth times the capacity and a tightened error rate is added
+    when the last filter is full, so the overall false positive rate stays below
+    error_rate
+    """
+
+    def __init__(
+        self,
+        initial_capacity: int = 100000,
+        error_rate: float = 1e-6,
+        growth: int = 2,
+        tightening: float = 0.5,
+    ) -> None:
+        self.initial_capacity = initial_capacity
+        self.error_rate = error_rate
+        self.growth = growth
+        self.tightening = tightening
+        self.filters: List[BloomFilter] = []
+
+    def __len__(self) -> int:
+        return sum(bloom_filter.count for bloom_filter in self.filters)
+
+    def __contains__(self, key: bytes) -> bool:
+        return any(key in bloom_filter for bloom_filter in self.filters)
+
+    def add(self, key: bytes) -> bool:
+        """Adds a key. Returns True if the key was probably added before"""
+        if key in self:
+            return True
+        if not self.filters or self.filters[-1].count >= self.filters[-1].capacity:
+            self.filters.append(
+                BloomFilter(
+                    self.initial_capacity * self.growth ** len(self.filters),
+                    self.error_rate
+                    * (1 - self.tightening)
+                    * self.tightening ** len(self.filters),
+                )
+            )
+        return self.filters[-1].add(key)
+
+    def save(self, path: str):
+        """Writes the state of the filter to a file"""
+        with open(path, "wb") as file:
+            pickle.dump(self, file, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def load(cls, path: str) -> "ScalableBloomFilter":
+        """Reads the state of a filter written by save"""
+        with open(path, "rb") as file:
+            return pickle.load(file)
+
+
+class CanonicalDupeFilter(BaseDupeFilter):
+    """Request dupefilter on the canonical urls of the pages in a Bloom filter
+
+    Requests with another method than GET or with a body are identified by their
+    request fingerprint
+    """
+
+    def __init__(  # pylint: disable=R0913
+        self,
+        path: Optional[str] = None,
+        debug: bool = False,
+        capacity: int = 100000,
+        error_rate: float = 1e-6,
+        query_parameters=CANONICAL_QUERY_PARAMETERS,
+    ) -> None:
+        self.path = path
+        self.debug = debug
+        self.logdupes = True
+        self.query_parameters = tuple(query_parameters)
+        self.seen = ScalableBloomFilter(capacity, error_rate)
+        if path and os.path.exists(path):
+            self.seen = ScalableBloomFilter.load(path)
+
+    @classmethod
+    def from_settings(cls, settings):
+        """Instantiate the filter with the DUPEFILTER_* settings.
+        The state is persisted in JOBDIR
+        """
+        jobdir = settings.get("JOBDIR")
+        if jobdir and not os.path.exists(jobdir):
+            os.makedirs(jobdir)
+        return cls(
+            path=os.path.join(jobdir, "requests.bloom") if jobdir else None,
+            debug=settings.getbool("DUPEFILTER_DEBUG"),
+            capacity=settings.getint("DUPEFILTER_BLOOM_CAPACITY", 100000),
+            error_rate=settings.getfloat("DUPEFILTER_BLOOM_ERROR_RATE", 1e-6),
+            query_parameters=settings.getlist(
+                "CANONICAL_QUERY_PARAMETERS", CANONICAL_QUERY_PARAMETERS
+            ),
+        )
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        """Instantiate the filter with the settings of the crawler"""
+        return cls.from_settings(crawler.settings)
+
+    def request_key(self, request: Request) -> bytes:
+        """Returns the key identifying the page of a request"""
+        if request.method == "GET" and not request.body:
+            return canonicalize_url(request.url, self.query_parameters).encode()
+        return fingerprint(request)
+
+    def request_seen(self, request: Request) -> bool:
+        return self.seen.add(self.request_key(request))
+
+    def close(self, reason: str):
+        if self.path:
+            self.seen.save(self.path)
+
+    def log(self, request: Request, spider):
+        if self.debug:
+            msg = "Filtered duplicate request: %(request)s (referer: %(referer)s)"
+            args = {"request": request, "referer": referer_str(request)}
+            logger.debug(msg, args, extra={"spider": spider})
+        elif self.logdupes:
+            msg = (
+                "Filtered duplicate request: %(request)s"
+                " - no more duplicates will be shown"
+                " (see DUPEFILTER_DEBUG to show all duplicates)"
+            )
+            logger.debug(msg, {"request": request}, extra={"spider": spider})
+            self.logdupes = False
+        spider.crawler.stats.inc_value("dupefilter/filtered", spider=spider)
@@ -1,54 +1,37 @@
 #!/usr/bin/python3
 
-"""Script which checks the availability of Lego products
+"""Script which sends the notifications about changed availabilities of Lego products
 
-Adds new entries to the Availability database for the newest availability
-If an availability changes to "available" it sends notifications via Telegram
+The crawls queue every availability change in the notification outbox. This script
+sends the queued notifications via Telegram for changes to "available" or "reorder",
+see outbox.py. Notifications which couldn't be sent are retried by the next run
 """
 
+import logging
 from dotenv import dotenv_values
-from lego.database import (
-    load_product_ids,
-    get_availabilities,
-    db_connect,
-    get_product_name,
-    get_product,
-)
-from lego.items import availability_int_to_str
-from lego.telegram_message import LegoRestockBot
+from scrapy.utils.project import get_project_settings
+from lego.database import db_connect
+from lego.outbox import OutboxSender
+from lego.telegram_message import LegoRestockBot, NotificationDispatcher
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
     config = dotenv_values(".env")
-    engine = db_connect()
-    product_ids = load_product_ids(engine)
-
-    for product_id in product_ids:
-        availabilites = get_availabilities(product_id, engine)
-
-        if len(availabilites) > 1:
-            last_availability = availabilites[-1]["availability"]
-            n_last_availability = availabilites[-2]["availability"]
-
-            if not last_availability == n_last_availability:
-                old_status = availability_int_to_str(n_last_availability)
-                new_status = availability_int_to_str(last_availability)
-                product_name = get_product_name(product_id, engine)
-
-                if last_availability in [
-                    1,
-                    4,
-                ]:  # 1: Jetzt verfügbar oder 4: Nachbestellungen möglich
-                    telegram_bot = LegoRestockBot(
-                        config["TELEGRAM_BOT_TOKEN"], config["TELEGRAM_CHANNEL_ID"]
-                    )
-                    product = get_product(product_id, engine)
-
-                    if last_availability == 1:
-                        message = telegram_bot.create_message_available(
-                            product_id, product.name, product.url, product.price
-                        )
-                    else:
-                        message = telegram_bot.create_message_reorder(
-                            product_id, product.name, product.url
-                        )
-                    telegram_bot.send_html_message_to_channel(message)
+    settings = get_project_settings()
+    engine = db_connect(settings)
+    telegram_bot = LegoRestockBot(
+        config["TELEGRAM_BOT_TOKEN"],
+        config["TELEGRAM_CHANNEL_ID"],
+        con_pool_size=settings.getint("TELEGRAM_MAX_WORKERS", 4),
+    )
+
+    with NotificationDispatcher.from_settings(settings, telegram_bot.bot) as dispatcher:
+        # 1: Jetzt verfügbar oder 4: Nachbestellungen möglich
+        sender = OutboxSender.from_settings(settings, engine, telegram_bot, dispatcher)
+        counts = sender.drain()
+    logging.info(
+        "Sent %d, failed %d and skipped %d notifications",
+        counts["sent"],
+        counts["failed"],
+        counts["skipped"],
+    )
@@ -0,0 +1,144 @@
+#!/usr/bin/python3
+
+"""Export of the availability history into a directory of NumPy .npy files
+
+The availability and products tables are read in chunks with keyset pagination,
+so the export runs next to a crawl, and written into one .npy file per column:
+
+- product_id, availability, timestamp, last_seen: the availability entries sorted
+  by product and timestamp. Timestamps are datetime64[s], a missing last_seen is
+  replaced by the timestamp
+- product_ids, product_names, product_prices, product_urls: the products, a missing
+  price is -1
+
+The availability entries are written chunk by chunk as they are read, so the memory
+of the export is bounded by the chunk size and not by the length of the history.
+Only the products are kept in memory.
+
+Analyze the export with analytics.py. Run the export from the project root:
+
+    python -m lego.export history
+"""
+
+import argparse
+import contextlib
+import logging
+import os
+import shutil
+from typing import BinaryIO, Dict
+import numpy as np
+from scrapy.utils.project import get_project_settings
+from sqlalchemy.engine.base import Engine
+from lego.database import db_connect, iter_availability_chunks, iter_products
+
+logger = logging.getLogger(__name__)
+
+COLUMNS = {
+    "product_id": np.int64,
+    "availability": np.int8,
+    "timestamp": "datetime64[s]",
+    "last_seen": "datetime64[s]",
+}
+ROW_DTYPE = [
+    ("product_id", COLUMNS["product_id"]),
+    ("availability", COLUMNS["availability"]),
+    ("timestamp", "S26"),
+    ("last_seen", "S26"),
+    ("id", np.int64),
+]
+
+
+def _parse_timestamps(timestamps: np.ndarray) -> np.ndarray:
+    return timestamps.astype("datetime64[us]").astype("datetime64[s]")
+
+
+def _availability_columns(rows) -> Dict[str, np.ndarray]:
+    """Converts a chunk of availability rows into arrays"""
+    # A structured array transposes the rows in C, the timestamps are ISO strings
+    rows = np.array(rows, dtype=ROW_DTYPE)
+    return {
+        "product_id": rows["product_id"],
+        "availability": rows["availability"],
+        "timestamp": _parse_timestamps(rows["timestamp"]),
+        "last_seen": _parse_timestamps(rows["last_seen"]),
+    }
+
+
+def _write_npy(path: str, dtype, count: int, values: BinaryIO):
+    """Writes a .npy file of count values of dtype from a file of the raw values"""
+    with open(path, "wb") as file:
+        np.lib.format.write_array_header_1_0(
+            file,
+            {
+                "descr": np.lib.format.dtype_to_descr(np.dtype(dtype)),
+                "fortran_order": False,
+                "shape": (count,),
+            },
+        )
+        values.seek(0)
+        shutil.copyfileobj(values, file)
+
+
+def _save_products(path: str, engine: Engine):
+    """Writes the columns of the products table"""
+    products = list(iter_products(engine))
+    columns = {
+        "product_ids": np.array(
+            [product.product_id for product in products], dtype=np.int64
+        ),
+        "product_names": np.array(
+            [product.name or "" for product in products], dtype=str
+        ),
+        "product_prices": np.array(
+            [-1 if product.price is None else product.price for product in products],
+            dtype=np.int64,
+        ),
+        "product_urls": np.array(
+            [product.url or "" for product in products], dtype=str
+        ),
+    }
+    for name, column in columns.items():
+        np.save(os.path.join(path, name + ".npy"), column)
+    return len(products)
+
+
+def export_history(path: str, engine: Engine, chunk_size: int = 100000) -> int:
+    """Writes the availability history into a directory of .npy files
+
+    Every chunk of entries is appended to a raw file per column, which is copied
+    behind the .npy header once the number of entries is known.
+    Returns the number of exported availability entries
+    """
+    os.makedirs(path, exist_ok=True)
+    parts = {name: os.path.join(path, name + ".part") for name in COLUMNS}
+    count = 0
+    try:
+        with contextlib.ExitStack() as stack:
+            files = {
+                name: stack.enter_context(open(part, "w+b"))
+                for name, part in parts.items()
+            }
+            for rows in iter_availability_chunks(engine, chunk_size):
+                for name, column in _availability_columns(rows).items():
+                    files[name].write(column.tobytes())
+                count += len(rows)
+            for name, dtype in COLUMNS.items():
+                _write_npy(os.path.join(path, name + ".npy"), dtype, count, files[name])
+    finally:
+        for part in parts.values():
+            if os.path.exists(part):
+                os.remove(part)
+    products = _save_products(path, engine)
+    logger.info(
+        "Exported %d availability entries of %d products to %s", count, products, path
+    )
+    return count
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description=__doc__.split("\n", maxsplit=1)[0])
+    parser.add_argument("path", help="the directory to write the .npy files to")
+    parser.add_argument("--chunk-size", type=int, default=100000)
+    args = parser.parse_args()
+    export_history(args.path, db_connect(get_project_settings()), args.chunk_size)
@@ -0,0 +1,153 @@
+# pylint: disable=R0903
+"""Extractors for the product information on Lego product pages
+
+An extractor returns the raw product information of a product page as a dict with
+the fields name, price, product_id and availability. The raw values are converted by
+the processors of the LegoItem. Fields an extractor cannot find are None.
+
+extract_product runs the extractors in order and only runs the next extractor if
+fields are still missing. The JsonLdExtractor reads the embedded structured data in
+one pass and doesn't depend on the generated CSS class names of the shop, the
+CssExtractor is the fallback. The availability codes are defined by the status text
+of the shop, so the schema.org availability of the JSON-LD data is only used if no
+extractor finds the status text.
+
+Configure the extractors with PRODUCT_EXTRACTORS in settings.py
+"""
+
+import json
+from typing import Iterable, List, Optional
+import scrapy
+from scrapy.utils.misc import load_object
+from lego.items import AVAILABILITY_CODES
+
+PRODUCT_FIELDS = ("name", "price", "product_id", "availability")
+
+DEFAULT_EXTRACTORS = [
+    "lego.extractors.JsonLdExtractor",
+    "lego.extractors.CssExtractor",
+]
+
+# Status shown on the pages of retired products, which the spiders skip
+RETIRED_STATUS = "Altes Produkt"
+
+# schema.org ItemAvailability to the availability codes of the shop
+SCHEMA_AVAILABILITY_CODES = {
+    "InStock": 1,
+    "InStoreOnly": 1,
+    "LimitedAvailability": 1,
+    "OnlineOnly": 1,
+    "OutOfStock": 2,
+    "SoldOut": 3,
+    "BackOrder": 4,
+    "PreOrder": 4,
+    "PreSale": 4,
+}
+
+
+class Extractor:
+    """Base class for extractors of the raw product information
+
+    Values of the fallback_fields are only used if no other extractor finds the field
+    """
+
+    fallback_fields = ()
+
+    def extract(self, response: scrapy.http.Response) -> dict:
+        """Returns a dict with the raw value or None for each of the PRODUCT_FIELDS"""
+        raise NotImplementedError
+
+
+class CssExtractor(Extractor):
+    """Extracts the product information with CSS selectors on the shop's class names"""
+
+    selectors = {
+        "name": ".eqJexe .hlipzx::text",
+        "price": ".eGdbAY::text",
+        "product_id": ".ProductDetailsstyles__ProductID-sc-16lgx7x-10.bIKuiP::text",
+        "availability": ".ejRirH .hlipzx::text",
+    }
+
+    def extract(self, response: scrapy.http.Response) -> dict:
+        return {
+            field: response.css(selector).get()
+            for field, selector in self.selectors.items()
+        }
+
+
+class JsonLdExtractor(Extractor):
+    """Extracts the product information from the embedded JSON-LD Product data"""
+
+    fallback_fields = ("availability",)
+
+    def extract(self, response: scrapy.http.Response) -> dict:
+        fields = dict.fromkeys(PRODUCT_FIELDS)
+        product = self.find_product(response)
+        if product is None:
+            return fields
+
+        offers = product.get("offers") or {}
+        if isinstance(offers, list):
+            offers = offers[0] if offers else {}
+        product_id = product.get("sku") or product.get("productID")
+        fields["name"] = product.get("name")
+        fields["product_id"] = str(product_id) if product_id is not None else None
+        fields["price"] = (
+            str(offers["price"]) if offers.get("price") is not None else None
+        )
+        availability = str(offers.get("availability") or "").rsplit("/", 1)[-1]
+        if availability == "Discontinued":
+            fields["availability"] = RETIRED_STATUS
+        elif availability in SCHEMA_AVAILABILITY_CODES:
+            fields["availability"] = AVAILABILITY_CODES[
+                SCHEMA_AVAILABILITY_CODES[availability]
+            ]
+        return fields
+
+    @staticmethod
+    def find_product(response: scrapy.http.Response) -> Optional[dict]:
+        """Returns the first JSON-LD object of type Product on the page"""
+        for script in response.xpath('//script[@type="application/ld+json"]/text()'):
+            try:
+                data = json.loads(script.get())
+            except ValueError:
+                continue
+            candidates = data if isinstance(data, list) else [data]
+            for candidate in candidates:
+                if isinstance(candidate, dict) and "@graph" in candidate:
+                    candidates.extend(candidate["@graph"])
+                elif (
+                    isinstance(candidate, dict) and candidate.get("@type") == "Product"
+                ):
+                    return candidate
+        return None
+
+
+def load_extractors(paths: Optional[Iterable[str]] = None) -> List[Extractor]:
+    """Instantiates the extractor classes from their import paths"""
+    return [load_object(path)() for path in (paths or DEFAULT_EXTRACTORS)]
+
+
+def extract_product(
+    response: scrapy.http.Response, extractors: Iterable[Extractor]
+) -> dict:
+    """Returns the raw product information of a product page
+
+    Runs the extractors in order until all PRODUCT_FIELDS are found. The fallback
+    fields of an extractor are filled in last
+    """
+    fields = dict.fromkeys(PRODUCT_FIELDS)
+    fallbacks = {}
+    for extractor in extractors:
+        for field, value in extractor.extract(response).items():
+            if field in extractor.fallback_fields:
+                if value is not None:
+                    fallbacks.setdefault(field, value)
+            elif fields.get(field) is None:
+                fields[field] = value
+        if all(fields[field] is not None for field in PRODUCT_FIELDS):
+            break
+    for field, value in fallbacks.items():
+        if fields.get(field) is None:
+            fields[field] = value
+    return fields
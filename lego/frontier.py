@@ -0,0 +1,129 @@
+"""Persistent crawl frontier of the LegoProductSpider
+
+The frontier keeps every page discovered by the LegoProductSpider in the crawl_frontier
+table of the products database. A discovery run marks its pages as pending and every
+crawled page as done, so a run interrupted by a crash or shutdown is resumed with the
+pending pages instead of starting over.
+
+A new run only schedules the start pages and the listing pages which are new, changed
+recently (FRONTIER_CHANGED_DAYS) or were not crawled for FRONTIER_REVISIT_DAYS. From
+there only links to pages not discovered before are followed, so known product pages
+are not requested again.
+"""
+
+import datetime
+import hashlib
+from typing import Iterable, Iterator
+from sqlalchemy.engine.base import Engine
+from lego.database import (
+    create_table,
+    finish_frontier,
+    FrontierPage,
+    has_pending_frontier_pages,
+    iter_pending_frontier_pages,
+    load_frontier_urls,
+    schedule_frontier_pages,
+    update_frontier,
+)
+
+
+def hash_links(links: Iterable[str]) -> str:
+    """Returns a hash of the set of links of a page"""
+    return hashlib.sha1("\n".join(sorted(set(links))).encode()).hexdigest()
+
+
+class CrawlFrontier:  # pylint: disable=R0902
+    """Disk-backed frontier and seen-url store of a discovery run
+
+    Discovered and crawled pages are buffered and written in one transaction per
+    batch of batch_size pages
+    """
+
+    def __init__(
+        self,
+        engine: Engine,
+        batch_size: int = 100,
+        revisit_days: float = 3.0,
+        changed_days: float = 7.0,
+    ) -> None:
+        self.engine = engine
+        self.batch_size = max(batch_size, 1)
+        self.revisit = datetime.timedelta(days=revisit_days)
+        self.changed = datetime.timedelta(days=changed_days)
+        self.seen = set()
+        self.discovered = []
+        self.crawled = []
+        self.resumed = False
+
+    @classmethod
+    def from_settings(cls, settings, engine: Engine):
+        """Instantiate the frontier with the FRONTIER_* and DB_BATCH_SIZE settings"""
+        create_table(engine)
+        return cls(
+            engine,
+            batch_size=settings.getint("DB_BATCH_SIZE", 100),
+            revisit_days=settings.getfloat("FRONTIER_REVISIT_DAYS", 3.0),
+            changed_days=settings.getfloat("FRONTIER_CHANGED_DAYS", 7.0),
+        )
+
+    def start(self, start_urls: Iterable[str], now=None) -> Iterator[FrontierPage]:
+        """Yields the pending pages of the discovery run
+
+        Resumes the interrupted run if pending pages are left, otherwise schedules the
+        pages of a new run
+        """
+        now = now or datetime.datetime.utcnow()
+        self.seen = load_frontier_urls(self.engine)
+        self.resumed = has_pending_frontier_pages(self.engine)
+        if not self.resumed:
+            schedule_frontier_pages(
+                self.engine,
+                start_urls,
+                revisit_before=now - self.revisit,
+                changed_since=now - self.changed,
+            )
+            self.seen.update(start_urls)
+        yield from iter_pending_frontier_pages(self.engine)
+
+    def discover(self, url: str, is_listing: bool) -> bool:
+        """Adds a page to the frontier. Returns False if the page is already known"""
+        if url in self.seen:
+            return False
+        self.seen.add(url)
+        self.discovered.append(
+            {
+                "url": url,
+                "is_listing": is_listing,
+                "discovered_at": datetime.datetime.utcnow(),
+            }
+        )
+        return True
+
+    def crawled_page(self, url: str, links: Iterable[str] = None):
+        """Marks a page as crawled together with the links of a listing page"""
+        self.crawled.append(
+            {
+                "url": url,
+                "crawled_at": datetime.datetime.utcnow(),
+                "links_hash": hash_links(links) if links is not None else None,
+            }
+        )
+        if len(self.crawled) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Write the buffered pages to the database
+
+        Pages discovered on a crawled page are written in the same transaction as the
+        crawled page, so no discovered page is lost after a crash
+        """
+        if not self.discovered and not self.crawled:
+            return
+        discovered, self.discovered = self.discovered, []
+        crawled, self.crawled = self.crawled, []
+        update_frontier(discovered, crawled, self.engine)
+
+    def finish(self):
+        """Write the buffered pages and end the discovery run"""
+        self.flush()
+        finish_frontier(self.engine)
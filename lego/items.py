@@ -4,32 +4,51 @@ See documentation in:
 https://docs.scrapy.org/en/latest/topics/items.html
 """
 
+import functools
+import logging
+import re
+from typing import Optional
 import scrapy
 from itemloaders.processors import MapCompose, TakeFirst
 
+logger = logging.getLogger(__name__)
 
-def process_price(price_text: str) -> int:
+
+# A price with optional thousands separators and up to two decimals,
+# e.g. "1.299,99\xa0€" on the product pages or "19.99" in the JSON-LD data
+PRICE_PATTERN = re.compile(
+    r"(?P<units>\d{1,3}(?:[. \u00a0\u202f']\d{3})+|\d+)"
+    r"(?:[.,](?P<cents>\d{1,2}))?(?!\d)"
+)
+PRICE_SEPARATORS = str.maketrans("", "", ". \u00a0\u202f'")
+INTEGER_PATTERN = re.compile(r"\d+")
+
+
+@functools.lru_cache(maxsize=4096)
+def process_price(price_text: str) -> Optional[int]:
     """Convert the incoming price string to an integer in cents
+    Returns None if the string contains no price
     Example:
         in: 19,99\xa0€
         out: 1999
     """
-    try:
-        splitted = price_text.split("\xa0")
-        price = float(splitted[0].replace(",", "."))
-        price = int(price * 100)
-        return price
-    except:  # pylint: disable=bare-except
-        return 0
+    match = PRICE_PATTERN.search(price_text)
+    if match is None:
+        logger.warning("Unknown price %r", price_text)
+        return None
+    units, cents = match.groups()
+    price = int(units.translate(PRICE_SEPARATORS)) * 100
+    if cents is not None:
+        price += int(cents) * (10 if len(cents) == 1 else 1)
+    return price
 
 
-def str_to_int(text: str) -> int:
-    """Convert a string to int"""
-    try:
-        i = int(text)
-        return i
-    except:  # pylint: disable=bare-except
-        return text
+def str_to_int(text: str) -> Optional[int]:
+    """Convert a string to int. Returns None if the string contains no number"""
+    if text.isascii() and text.isdigit():
+        return int(text)
+    match = INTEGER_PATTERN.search(text)
+    return int(match.group()) if match is not None else None
 
 
 AVAILABILITY_CODES = {
@@ -40,18 +59,44 @@ AVAILABILITY_CODES = {
     4: "Nachbestellungen möglich",
     -1: "Unknown",
 }
+UNKNOWN_AVAILABILITY = -1
+
+
+def _normalize_text(text: str) -> str:
+    """Collapses whitespace and case of a status string"""
+    return " ".join(text.split()).casefold()
+
+
+AVAILABILITY_LOOKUP = {
+    _normalize_text(text): code for code, text in AVAILABILITY_CODES.items()
+}
+# Codes whose status string may continue, e.g. with a shipping date
+AVAILABILITY_PREFIX_CODES = (4,)
+AVAILABILITY_PREFIXES = re.compile(
+    "|".join(
+        re.escape(_normalize_text(AVAILABILITY_CODES[code]))
+        for code in AVAILABILITY_PREFIX_CODES
+    )
+)
 
 
+@functools.lru_cache(maxsize=1024)
 def availability_str_to_int(text: str) -> int:
-    """Lookup the corresponding availability status int code for the string"""
-    for key, value in AVAILABILITY_CODES.items():
-        if value == text:
-            return key
-        if (
-            key == 4 and AVAILABILITY_CODES[4] in text
-        ):  # special case. Text contains "Nachbestellungen möglich"
-            return key
-    raise Exception(f"Verfügbarkeitsstatus {text} unkown")
+    """Lookup the corresponding availability status int code for the string
+
+    Returns UNKNOWN_AVAILABILITY for unknown strings, which the QuarantinePipeline
+    records in the quarantined_statuses table
+    """
+    key = _normalize_text(text)
+    code = AVAILABILITY_LOOKUP.get(key)
+    if code is None:
+        match = AVAILABILITY_PREFIXES.match(key)
+        if match is not None:
+            code = AVAILABILITY_LOOKUP[match.group()]
+    if code is None:
+        logger.warning("Unknown availability %r", text)
+        return UNKNOWN_AVAILABILITY
+    return code
 
 
 def availability_int_to_str(availability: int) -> str:
@@ -67,7 +112,10 @@ class LegoItem(scrapy.Item):
         - price: in cents
         - product_id: Lego product ID
         - availability: integer representing the availability status
+        - availability_text: the availability status as shown on the product page
         - url: url to lego product page
+        - observed_at: time the availability was observed, set by the TransitionPipeline
+        - fingerprint: PageFingerprintItem of the page, saved with the availability
     """
 
     name = scrapy.Field(output_processor=TakeFirst())
@@ -81,4 +129,41 @@ class LegoItem(scrapy.Item):
         input_processor=MapCompose(availability_str_to_int),
         output_processor=TakeFirst(),
     )
+    availability_text = scrapy.Field(output_processor=TakeFirst())
     url = scrapy.Field(output_processor=TakeFirst())
+    observed_at = scrapy.Field()
+    fingerprint = scrapy.Field()
+
+
+class HeartbeatItem(scrapy.Item):
+    """Model for a product page which did not change since the last crawl
+
+    Confirms the current availability of the product without parsing the page
+
+    Fields:
+        - product_id: Lego product ID
+        - url: url to lego product page
+        - fingerprint: PageFingerprintItem of the page, saved with the availability
+    """
+
+    product_id = scrapy.Field()
+    url = scrapy.Field()
+    fingerprint = scrapy.Field()
+
+
+class PageFingerprintItem(scrapy.Item):
+    """Model for the HTTP validators and the content hash of a product page
+
+    Attached to the LegoItem or HeartbeatItem of the page
+
+    Fields:
+        - url: url to lego product page
+        - etag: ETag response header
+        - last_modified: Last-Modified response header
+        - content_hash: hash of the product information on the page
+    """
+
+    url = scrapy.Field()
+    etag = scrapy.Field()
+    last_modified = scrapy.Field()
+    content_hash = scrapy.Field()
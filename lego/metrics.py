@@ -0,0 +1,357 @@
+"""Latency metrics of the crawls
+
+The CrawlMetrics extension, the CallbackTimingMiddleware and the pipelines collect
+latency histograms of every stage of a crawl in the Metrics of the spider:
+
+- download: the download latency of every response, per host
+- callback: the time spent in every spider callback, per callback
+- spider: sections of the callbacks, e.g. the extraction and the ItemLoader
+- pipeline: the time until process_item of every pipeline finished, per class, see
+  DatabasePipeline in pipelines.py
+- database: the duration of every database function called by the pipelines
+- telegram: the time until a notification of the OutboxSender was delivered
+
+Items are dropped by the pipelines with a DropItem subclass per reason, Scrapy counts
+them in the stats as item_dropped_reasons_count/<reason>.
+
+When the spider closes the histograms are logged and, with METRICS_CRAWL_RUNS, a
+summary of the run is added to the crawl_runs table. With METRICS_PROMETHEUS_PORT the
+histograms and the numeric crawl stats of the latest crawl are served in the
+Prometheus text format on http://<METRICS_PROMETHEUS_INTERFACE>:<port>/metrics
+"""
+
+import bisect
+import contextlib
+import datetime
+import logging
+import math
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+from scrapy import signals
+from scrapy.exceptions import NotConfigured
+from scrapy.utils.httpobj import urlparse_cached
+from twisted.internet import reactor
+from twisted.web import resource, server
+from lego.database import add_crawl_run, create_table, db_connect
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds of the histogram buckets in seconds
+BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+)
+
+
+class Histogram:
+    """Latency histogram with fixed buckets, like a Prometheus histogram"""
+
+    def __init__(self, buckets: Tuple[float, ...] = BUCKETS) -> None:
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds: float):
+        """Adds a duration to the histogram"""
+        self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+
+    def quantile(self, fraction: float) -> float:
+        """Estimates a quantile by interpolating within its bucket"""
+        rank = fraction * self.count
+        cumulative = 0
+        for i, count in enumerate(self.counts):
+            if count and cumulative + count >= rank:
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                upper = self.buckets[i] if i < len(self.buckets) else self.max
+                return min(
+                    lower + (upper - lower) * (rank - cumulative) / count, self.max
+                )
+            cumulative += count
+        return self.max
+
+    def summary(self) -> Dict[str, float]:
+        """Returns the count, sum, mean, median, 95th percentile and maximum"""
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "mean": self.sum / self.count if self.count else 0.0,
+            "p50": self.quantile(0.5),
+            "p95": self.quantile(0.95),
+            "max": self.max,
+        }
+
+
+class Metrics:
+    """The latency histograms of one crawl by stage and name
+
+    Durations may be observed from any thread
+    """
+
+    def __init__(self) -> None:
+        self.histograms: Dict[Tuple[str, str], Histogram] = {}
+        self.lock = threading.Lock()
+
+    @classmethod
+    def for_spider(cls, spider):
+        """Returns the metrics shared by the extension, middleware and pipelines"""
+        metrics = getattr(spider, "metrics", None)
+        if metrics is None:
+            metrics = cls()
+            spider.metrics = metrics
+        return metrics
+
+    def observe(self, stage: str, name: str, seconds: float):
+        """Adds a duration to the histogram of a stage and name"""
+        with self.lock:
+            histogram = self.histograms.get((stage, name))
+            if histogram is None:
+                histogram = self.histograms[(stage, name)] = Histogram()
+            histogram.observe(seconds)
+
+    @contextlib.contextmanager
+    def time(self, stage: str, name: str):
+        """Context manager observing the duration of its block"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, name, time.perf_counter() - start)
+
+    def summary(self) -> Dict[str, Dict[str, Dict[str, float]]]:
+        """Returns the summaries of all histograms as {stage: {name: summary}}"""
+        with self.lock:
+            summary = {}
+            for (stage, name), histogram in sorted(self.histograms.items()):
+                summary.setdefault(stage, {})[name] = histogram.summary()
+            return summary
+
+
+class CallbackTimingMiddleware:
+    """Spider middleware observing the time spent in every spider callback
+
+    Must be the spider middleware closest to the spider, so only the callback itself
+    is timed while its output is consumed
+    """
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        """Instantiate the middleware unless METRICS_ENABLED is False"""
+        if not crawler.settings.getbool("METRICS_ENABLED", True):
+            raise NotConfigured
+        return cls()
+
+    def process_spider_output(self, response, result, spider):  # pylint: disable=R0201
+        """Yields the output of the callback, timing the callback between the items"""
+        callback = response.request.callback if response.request else None
+        name = getattr(callback, "__name__", "parse")
+        elapsed = 0.0
+        iterator = iter(result)
+        try:
+            while True:
+                start = time.perf_counter()
+                try:
+                    entry = next(iterator)
+                except StopIteration:
+                    return
+                finally:
+                    elapsed += time.perf_counter() - start
+                yield entry
+        finally:
+            Metrics.for_spider(spider).observe("callback", name, elapsed)
+
+
+def _label(value) -> str:
+    return str(value).replace("\\", r"\\").replace('"', r"\"").replace("\n", r"\n")
+
+
+def _histogram_lines(labels: str, histogram: Histogram) -> List[str]:
+    """Returns the cumulative buckets, sum and count of a histogram"""
+    lines = []
+    cumulative = 0
+    for bound, count in zip(histogram.buckets + (math.inf,), histogram.counts):
+        cumulative += count
+        upper = "+Inf" if bound == math.inf else repr(bound)
+        lines.append(
+            f'lego_latency_seconds_bucket{{{labels},le="{upper}"}} {cumulative}'
+        )
+    lines.append(f"lego_latency_seconds_sum{{{labels}}} {histogram.sum!r}")
+    lines.append(f"lego_latency_seconds_count{{{labels}}} {histogram.count}")
+    return lines
+
+
+def render_prometheus(sources: Dict[str, Tuple[Metrics, Optional[dict]]]) -> str:
+    """Returns the histograms and numeric stats of the sources in the Prometheus text
+    format. Sources map a name, e.g. the spider, to its metrics and crawl stats
+    """
+    lines = [
+        "# HELP lego_latency_seconds Latency of the stages of the crawls",
+        "# TYPE lego_latency_seconds histogram",
+    ]
+    for source, (metrics, _) in sorted(sources.items()):
+        with metrics.lock:
+            for (stage, name), histogram in sorted(metrics.histograms.items()):
+                labels = (
+                    f'source="{_label(source)}",stage="{_label(stage)}",'
+                    f'name="{_label(name)}"'
+                )
+                lines.extend(_histogram_lines(labels, histogram))
+
+    lines.append("# HELP lego_crawl_stat Numeric Scrapy stats of the latest crawl")
+    lines.append("# TYPE lego_crawl_stat gauge")
+    for source, (_, stats) in sorted(sources.items()):
+        for key, value in sorted((stats or {}).items()):
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                lines.append(
+                    f'lego_crawl_stat{{source="{_label(source)}",'
+                    f'name="{_label(key)}"}} {value!r}'
+                )
+    return "\n".join(lines) + "\n"
+
+
+class MetricsResource(resource.Resource):
+    """Twisted web resource serving the metrics of the registered sources"""
+
+    isLeaf = True
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.sources: Dict[str, Tuple[Metrics, Optional[dict]]] = {}
+
+    def register(self, source: str, metrics: Metrics, stats: Optional[dict] = None):
+        """Serves the metrics and stats of a source, replacing its former ones"""
+        self.sources[source] = (metrics, stats)
+
+    def render_GET(self, request):  # pylint: disable=C0103
+        """Returns the metrics in the Prometheus text format"""
+        request.setHeader(b"Content-Type", b"text/plain; version=0.0.4; charset=utf-8")
+        return render_prometheus(self.sources).encode()
+
+
+_ENDPOINTS: Dict[Tuple[str, int], MetricsResource] = {}
+
+
+def serve_metrics(port: int, interface: str = "127.0.0.1") -> MetricsResource:
+    """Returns the metrics endpoint listening on the port
+
+    The endpoint is started once per process and serves the latest crawl of every
+    spider, so the daemon keeps serving between its sweeps
+    """
+    if (interface, port) not in _ENDPOINTS:
+        endpoint = MetricsResource()
+        reactor.listenTCP(  # pylint: disable=E1101
+            port, server.Site(endpoint), interface=interface
+        )
+        _ENDPOINTS[(interface, port)] = endpoint
+        logger.info("Serving metrics on http://%s:%d/metrics", interface, port)
+    return _ENDPOINTS[(interface, port)]
+
+
+def _naive_utc(timestamp: Optional[datetime.datetime]) -> Optional[datetime.datetime]:
+    if timestamp is None or timestamp.tzinfo is None:
+        return timestamp
+    return timestamp.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+
+
+class CrawlMetrics:
+    """Scrapy extension collecting the metrics of a crawl and recording the run"""
+
+    def __init__(self, crawler) -> None:
+        self.settings = crawler.settings
+        self.stats = crawler.stats
+        self.metrics = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        """Instantiate the extension unless METRICS_ENABLED is False"""
+        if not crawler.settings.getbool("METRICS_ENABLED", True):
+            raise NotConfigured
+        extension = cls(crawler)
+        crawler.signals.connect(extension.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(
+            extension.response_received, signal=signals.response_received
+        )
+        crawler.signals.connect(extension.spider_closed, signal=signals.spider_closed)
+        return extension
+
+    def spider_opened(self, spider):
+        """Registers the metrics at the endpoint"""
+        self.metrics = Metrics.for_spider(spider)
+        port = self.settings.get("METRICS_PROMETHEUS_PORT")
+        if port is not None:
+            endpoint = serve_metrics(
+                int(port),
+                self.settings.get("METRICS_PROMETHEUS_INTERFACE", "127.0.0.1"),
+            )
+            endpoint.register(spider.name, self.metrics, self.stats.get_stats())
+
+    def response_received(self, response, request, spider):  # pylint: disable=W0613
+        """Observes the download latency of a response"""
+        latency = request.meta.get("download_latency")
+        if latency is not None:
+            self.metrics.observe(
+                "download", urlparse_cached(request).hostname or "", latency
+            )
+
+    def spider_closed(self, spider, reason: str):
+        """Logs the histograms and records the run in the crawl_runs table"""
+        summary = self.metrics.summary() if self.metrics is not None else {}
+        for stage, names in summary.items():
+            for name, values in names.items():
+                logger.info(
+                    "%s %s: %d in %.3fs, mean %.2fms, p95 %.2fms, max %.2fms",
+                    stage,
+                    name,
+                    values["count"],
+                    values["sum"],
+                    values["mean"] * 1000,
+                    values["p95"] * 1000,
+                    values["max"] * 1000,
+                )
+        # Workers of a sharded crawl don't write to the database
+        if not self.settings.getbool("METRICS_CRAWL_RUNS", True) or self.settings.get(
+            "SHARD_RESULTS_FILE"
+        ):
+            return
+        stats = self.stats.get_stats()
+        engine = db_connect(self.settings)
+        create_table(engine)
+        add_crawl_run(
+            {
+                "spider": spider.name,
+                "started_at": _naive_utc(stats.get("start_time")),
+                "finished_at": _naive_utc(stats.get("finish_time"))
+                or datetime.datetime.utcnow(),
+                "finish_reason": reason,
+                "items_scraped": stats.get("item_scraped_count", 0),
+                "items_dropped": stats.get("item_dropped_count", 0),
+                "responses": stats.get("response_received_count", 0),
+                "errors": stats.get("log_count/ERROR", 0),
+                "stats": {
+                    key: value
+                    for key, value in stats.items()
+                    if isinstance(value, (int, float)) and not isinstance(value, bool)
+                },
+                "metrics": summary,
+            },
+            engine,
+        )
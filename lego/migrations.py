@@ -0,0 +1,179 @@
+"""Versioned schema migrations for the Lego products SQLite database
+
+The schema version of a database file is stored in the SQLite user_version pragma.
+Every migration is a function executing SQL statements on a DB-API cursor. Migrations
+are applied in order, each inside its own transaction together with the new version
+number, so an interrupted upgrade leaves the database at the last complete version.
+
+New databases are created by SQLAlchemy with the latest schema and only stamped with
+the latest version. Existing databases are migrated before SQLAlchemy creates missing
+tables, so a migration creates the tables it needs in the schema of its own version.
+To change the schema, update the table definitions in database.py and append a
+migration upgrading existing databases to the same schema.
+"""
+
+import logging
+from typing import Callable, List
+from sqlalchemy.engine.base import Engine
+
+logger = logging.getLogger(__name__)
+
+MIGRATIONS: List[Callable] = []
+
+
+def migration(func: Callable) -> Callable:
+    """Decorator registering a function as the next schema migration"""
+    MIGRATIONS.append(func)
+    return func
+
+
+@migration
+def fix_availability_product_id(cursor):
+    """Version 1: Reference the lego product id from the availability table
+
+    The product_id column of the availability table contains the lego product id but
+    was declared as a foreign key to products.id. The table is rebuilt with the
+    foreign key to products.product_id and with indexes on (product_id, timestamp)
+    and timestamp
+    """
+    cursor.execute(
+        """CREATE TABLE availability_new (
+            id INTEGER NOT NULL,
+            availability INTEGER,
+            product_id INTEGER,
+            timestamp DATETIME DEFAULT (CURRENT_TIMESTAMP),
+            PRIMARY KEY (id),
+            FOREIGN KEY(product_id) REFERENCES products (product_id)
+        )"""
+    )
+    cursor.execute(
+        """INSERT INTO availability_new (id, availability, product_id, timestamp)
+        SELECT id, availability, product_id, timestamp FROM availability"""
+    )
+    cursor.execute("DROP TABLE availability")
+    cursor.execute("ALTER TABLE availability_new RENAME TO availability")
+    cursor.execute(
+        """CREATE INDEX ix_availability_product_id_timestamp
+        ON availability (product_id, timestamp)"""
+    )
+    cursor.execute("CREATE INDEX ix_availability_timestamp ON availability (timestamp)")
+
+
+@migration
+def add_product_status(cursor):
+    """Version 2: Add the product_status table and fill it from the availability history
+
+    previous_availability is the last status different from the latest one and
+    last_changed the timestamp of the first entry after it
+    """
+    cursor.execute(
+        """CREATE TABLE IF NOT EXISTS product_status (
+            product_id INTEGER NOT NULL,
+            availability INTEGER,
+            previous_availability INTEGER,
+            last_changed DATETIME,
+            last_seen DATETIME,
+            PRIMARY KEY (product_id),
+            FOREIGN KEY(product_id) REFERENCES products (product_id)
+        )"""
+    )
+    cursor.execute(
+        """WITH latest AS (
+            SELECT product_id, availability, timestamp FROM (
+                SELECT product_id, availability, timestamp, ROW_NUMBER() OVER (
+                    PARTITION BY product_id ORDER BY timestamp DESC, id DESC
+                ) AS position
+                FROM availability
+            ) WHERE position = 1
+        ),
+        previous AS (
+            SELECT product_id, availability, timestamp FROM (
+                SELECT a.product_id, a.availability, a.timestamp, ROW_NUMBER() OVER (
+                    PARTITION BY a.product_id ORDER BY a.timestamp DESC, a.id DESC
+                ) AS position
+                FROM availability a
+                JOIN latest l ON a.product_id = l.product_id
+                WHERE a.availability != l.availability
+            ) WHERE position = 1
+        )
+        INSERT OR REPLACE INTO product_status (
+            product_id, availability, previous_availability, last_changed, last_seen
+        )
+        SELECT l.product_id, l.availability, p.availability, (
+            SELECT MIN(a.timestamp) FROM availability a
+            WHERE a.product_id = l.product_id
+            AND a.timestamp > COALESCE(p.timestamp, '')
+        ), l.timestamp
+        FROM latest l LEFT JOIN previous p ON l.product_id = p.product_id"""
+    )
+
+
+@migration
+def add_availability_intervals(cursor):
+    """Version 3: Store availability entries as intervals for run length encoding
+
+    Adds the last_seen column to the availability table and the reference to the
+    current interval of each product to the product_status table
+    """
+    cursor.execute("ALTER TABLE availability ADD COLUMN last_seen DATETIME")
+    cursor.execute("UPDATE availability SET last_seen = timestamp")
+    cursor.execute(
+        """ALTER TABLE product_status
+        ADD COLUMN interval_id INTEGER REFERENCES availability (id)"""
+    )
+    cursor.execute(
+        """UPDATE product_status SET interval_id = (
+            SELECT a.id FROM availability a
+            WHERE a.product_id = product_status.product_id
+            ORDER BY a.timestamp DESC, a.id DESC LIMIT 1
+        )"""
+    )
+
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def get_schema_version(engine: Engine) -> int:
+    """Returns the schema version of the database"""
+    with engine.connect() as connection:
+        return connection.exec_driver_sql("PRAGMA user_version").scalar()
+
+
+def stamp(engine: Engine, version: int = SCHEMA_VERSION):
+    """Marks the database as being at the given schema version without migrating"""
+    if engine.dialect.name != "sqlite":
+        return
+    with engine.connect() as connection:
+        connection.exec_driver_sql(f"PRAGMA user_version = {int(version)}")
+
+
+def upgrade(engine: Engine):
+    """Applies all pending migrations to the database"""
+    if engine.dialect.name != "sqlite":
+        return
+    version = get_schema_version(engine)
+    if version >= SCHEMA_VERSION:
+        return
+
+    raw_connection = engine.raw_connection()
+    dbapi_connection = raw_connection.connection
+    isolation_level = dbapi_connection.isolation_level
+    # Take control of the transactions. Otherwise sqlite3 runs DDL outside of them
+    dbapi_connection.isolation_level = None
+    try:
+        cursor = dbapi_connection.cursor()
+        for index in range(version, SCHEMA_VERSION):
+            func = MIGRATIONS[index]
+            logger.info("Migrating database to version %d: %s", index + 1, func.__name__)
+            cursor.execute("BEGIN IMMEDIATE")
+            try:
+                func(cursor)
+                cursor.execute(f"PRAGMA user_version = {index + 1}")
+                cursor.execute("COMMIT")
+            except Exception:
+                cursor.execute("ROLLBACK")
+                raise
+        cursor.close()
+    finally:
+        dbapi_connection.isolation_level = isolation_level
+        raw_connection.close()
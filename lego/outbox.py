@@ -0,0 +1,150 @@
+"""Sends the notifications queued in the notification outbox
+
+Changes of products are queued in the notification_outbox table in the same
+transaction which records them, see database.py. The OutboxSender drains the outbox:
+it claims a batch of pending notifications, sends them via Telegram and records
+whether each was sent. A change is queued once by its idempotency key, and a sent
+notification is never claimed again, so running the sender twice or replaying results
+of a crawl doesn't send a notification twice. Notifications not sent because of a
+crash or Telegram being down stay in the outbox and are sent by the next run.
+
+Only a crash between sending a message and recording it leaves the notification in
+the sending state. It is sent again once its lease expired.
+"""
+
+import datetime
+import logging
+from typing import Dict, Iterable, Optional
+from sqlalchemy.engine.base import Engine
+from lego.database import claim_notifications, finish_notifications
+from lego.metrics import Metrics
+from lego.telegram_message import LegoRestockBot, NotificationDispatcher
+
+logger = logging.getLogger(__name__)
+
+
+class OutboxSender:  # pylint: disable=R0902
+    """Drains the notification outbox with a NotificationDispatcher
+
+    Availability changes into one of the statuses and price drops are sent, all
+    others are skipped. The delivery latencies are observed in the optional metrics
+    """
+
+    def __init__(  # pylint: disable=R0913
+        self,
+        engine: Engine,
+        restock_bot: LegoRestockBot,
+        dispatcher: NotificationDispatcher,
+        *,
+        statuses: Iterable[int] = (1, 4),
+        batch_size: int = 100,
+        max_attempts: int = 5,
+        lease: float = 300.0,
+        metrics: Optional[Metrics] = None,
+    ) -> None:
+        self.engine = engine
+        self.restock_bot = restock_bot
+        self.dispatcher = dispatcher
+        self.statuses = set(statuses)
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.lease = datetime.timedelta(seconds=lease)
+        self.metrics = metrics
+
+    @classmethod
+    def from_settings(  # pylint: disable=R0913
+        cls,
+        settings,
+        engine: Engine,
+        restock_bot: LegoRestockBot,
+        dispatcher: NotificationDispatcher,
+        metrics: Optional[Metrics] = None,
+    ):
+        """Instantiate the sender with the OUTBOX_* settings"""
+        return cls(
+            engine,
+            restock_bot,
+            dispatcher,
+            batch_size=settings.getint("OUTBOX_BATCH_SIZE", 100),
+            max_attempts=settings.getint("OUTBOX_MAX_ATTEMPTS", 5),
+            lease=settings.getfloat("OUTBOX_LEASE_SECONDS", 300.0),
+            metrics=metrics,
+        )
+
+    def format_message(self, notification: dict) -> Optional[str]:
+        """Returns the message of a notification or None if it isn't sent"""
+        if notification["kind"] == "price":
+            if not notification["new_value"] or not (
+                notification["new_value"] < (notification["old_value"] or 0)
+            ):
+                return None
+            return self.restock_bot.create_message_price_drop(
+                notification["product_id"],
+                notification["name"],
+                notification["url"],
+                notification["old_value"],
+                notification["new_value"],
+            )
+        if notification["kind"] != "availability":
+            return None
+        if notification["new_value"] not in self.statuses:
+            return None
+        if notification["new_value"] == 1:
+            return self.restock_bot.create_message_available(
+                notification["product_id"],
+                notification["name"],
+                notification["url"],
+                notification["price"],
+            )
+        return self.restock_bot.create_message_reorder(
+            notification["product_id"], notification["name"], notification["url"]
+        )
+
+    def drain(self) -> Dict[str, int]:
+        """Sends pending notifications until the outbox is empty
+
+        Returns the number of sent, failed and skipped notifications
+        """
+        counts = {"sent": 0, "failed": 0, "skipped": 0}
+        while True:
+            notifications = claim_notifications(
+                self.engine, self.batch_size, self.lease
+            )
+            if not notifications:
+                return counts
+
+            results = []
+            futures = []
+            for notification in notifications:
+                message = self.format_message(notification)
+                if message is None:
+                    results.append({"id": notification["id"], "state": "skipped"})
+                else:
+                    futures.append(
+                        (
+                            notification,
+                            self.dispatcher.send(self.restock_bot.channel_id, message),
+                        )
+                    )
+            for notification, future in futures:
+                report = future.result()
+                if self.metrics is not None and report.latency is not None:
+                    self.metrics.observe("telegram", "send", report.latency)
+                if report.delivered:
+                    results.append({"id": notification["id"], "state": "sent"})
+                else:
+                    results.append(
+                        {
+                            "id": notification["id"],
+                            "state": "failed",
+                            "error": str(report.error),
+                        }
+                    )
+            finish_notifications(results, self.engine, self.max_attempts)
+
+            for result in results:
+                counts[result["state"]] += 1
+            if any(result["state"] == "failed" for result in results):
+                # Retrying in the same run would only hit the same error again
+                logger.warning("Stopped draining the outbox after failed sends")
+                return counts
@@ -3,108 +3,546 @@
 
 - LegoPipeline: Adds new lego products to the database
 - DuplicatesPipelines: Drop items that already exist in the database
-- UpdatePricePipeline: Update the price of a lego product in the database
+- UpdatePricePipeline: Update the price of a lego product and its price history
 - AvailabilityPipeline: Add an entry about the availability of a product to the database
+  and save the HTTP validators and content hash of its page
+- TransitionPipeline: Detect availability transitions as soon as an item arrives
+- QuarantinePipeline: Record unknown availability strings of product pages
 
 Don't forget to add your pipeline to the ITEM_PIPELINES setting
 See: https://docs.scrapy.org/en/latest/topics/item-pipeline.html
+
+All pipelines share a ProductIndex of the known product ids and prices. It is loaded
+once when the spider opens and answers existence and price checks from memory.
+
+The AvailabilityPipeline and UpdatePricePipeline buffer their database writes and
+flush them as one transaction per batch. The batch size and the maximum time between
+two flushes are configured with DB_BATCH_SIZE and DB_FLUSH_INTERVAL in settings.py.
+The writes run in a dedicated writer thread, see writer.py. In a sharded crawl the
+batches are appended to the SHARD_RESULTS_FILE of the worker
 """
 
+import datetime
+import functools
+import logging
+import time
+from typing import Dict, Optional
+from twisted.internet import defer, task
 from scrapy.exceptions import DropItem
-from lego.items import LegoItem
+from scrapy.utils.log import failure_to_exc_info
+from scrapy.utils.misc import load_object
+from scrapy.utils.project import get_project_settings
+from lego.metrics import Metrics
+from lego.shards import ShardResults
+from lego.transitions import transition_detected
+from lego.writer import DatabaseWriter
+from lego.items import (
+    HeartbeatItem,
+    LegoItem,
+    UNKNOWN_AVAILABILITY,
+)
 from lego.database import (
-    add_availability,
+    add_availabilities,
     add_product,
     create_table,
     db_connect,
+    load_product_availabilities,
+    load_product_prices,
     Product,
-    Availability,
-    does_product_exist,
-    update_product_price,
+    quarantine_statuses,
+    update_product_prices,
 )
 
+logger = logging.getLogger(__name__)
+
+
+class DuplicateItem(DropItem):
+    """Dropped because the product is already in the database"""
+
+
+class UnknownProduct(DropItem):
+    """Dropped because the product is not in the database"""
+
+
+class ProductIndex:
+    """In-memory index mapping the lego product ids of the Product table to prices"""
+
+    def __init__(self, prices: Dict[int, int]) -> None:
+        self.prices = prices
+
+    @classmethod
+    def for_spider(cls, spider, engine):
+        """Returns the index shared by all pipelines of the spider.
+        The index is loaded from the database by the first pipeline asking for it
+        """
+        index = getattr(spider, "product_index", None)
+        if index is None:
+            with Metrics.for_spider(spider).time("database", "load_product_prices"):
+                index = cls(load_product_prices(engine))
+            spider.product_index = index
+        return index
+
+    def __contains__(self, product_id: int) -> bool:
+        return product_id in self.prices
+
+    def __len__(self) -> int:
+        return len(self.prices)
+
+    def get_price(self, product_id: int) -> Optional[int]:
+        """Returns the known price of a product in cents"""
+        return self.prices.get(product_id)
+
+    def set_price(self, product_id: int, price: int):
+        """Adds a product or updates its known price"""
+        self.prices[product_id] = price
+
+
+def timed_item(method):
+    """Decorates process_item of a DatabasePipeline to observe the time until the
+    pipeline finished an item
+    """
 
-class AvailabilityPipeline:
-    """Pipeline for adding an availability entry for a product to the database"""
+    @functools.wraps(method)
+    def process_item(self, item, spider):
+        start = time.perf_counter()
+        try:
+            result = method(self, item, spider)
+        except Exception:
+            self.observe_item(None, start)
+            raise
+        if isinstance(result, defer.Deferred):
+            return result.addBoth(self.observe_item, start)
+        return self.observe_item(result, start)
 
-    def __init__(self) -> None:
+    return process_item
+
+
+class DatabasePipeline:
+    """Base class for pipelines working with the products database
+
+    With DB_WRITER_ENABLED the database writes run in the DatabaseWriter thread shared
+    by the pipelines of the spider and process_item returns a Deferred while an item
+    waits for its write. The time spent writing to the database is collected in the
+    crawl stats as database/write_time and database/write_count and per function in
+    the database histograms of the Metrics of the spider. The time until process_item
+    finished an item is observed per class in the pipeline histograms
+    """
+
+    def __init__(self, settings=None, stats=None) -> None:
         """Create tables if they don't exist yet"""
-        self.engine = db_connect()
+        self.settings = settings if settings is not None else get_project_settings()
+        self.stats = stats
+        self.engine = db_connect(self.settings)
         create_table(self.engine)
+        self.products = None
+        self.writer = None
+        self.metrics = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        """Instantiate the pipeline with the settings and stats of the crawler"""
+        return cls(settings=crawler.settings, stats=crawler.stats)
+
+    def open_spider(self, spider):
+        """Load the product index and start the writer shared by the pipelines"""
+        self.metrics = Metrics.for_spider(spider)
+        self.products = ProductIndex.for_spider(spider, self.engine)
+        if self.settings.getbool("DB_WRITER_ENABLED"):
+            self.writer = DatabaseWriter.for_spider(spider, self.settings)
+            self.writer.open()
+
+    def close_spider(self, spider):  # pylint: disable=W0613
+        """Wait for the pending writes of the writer"""
+        if self.writer is not None:
+            return self.writer.close()
+        return None
+
+    def timed_write(self, func, *args) -> defer.Deferred:
+        """Calls a database write function and records its duration
+
+        Returns a Deferred firing when the write is done
+        """
+        if self.writer is None:
+            start = time.perf_counter()
+            func(*args)
+            return defer.succeed(
+                self.record_write(time.perf_counter() - start, func.__name__)
+            )
+        return self.writer.write(func, *args).addCallback(
+            self.record_write, func.__name__
+        )
+
+    def record_write(self, duration: float, name: str = "write"):
+        """Adds the duration of a write to the crawl stats and metrics"""
+        if self.stats is not None:
+            self.stats.inc_value("database/write_time", duration)
+            self.stats.inc_value("database/write_count")
+        if self.metrics is not None:
+            self.metrics.observe("database", name, duration)
+
+    def observe_item(self, result, start: float):
+        """Adds the time the pipeline took for an item to the metrics"""
+        if self.metrics is not None:
+            self.metrics.observe(
+                "pipeline", type(self).__name__, time.perf_counter() - start
+            )
+        return result
+
+    @staticmethod
+    def item_after(deferred: Optional[defer.Deferred], item):
+        """Returns the item, after the write of the Deferred if there is one"""
+        if deferred is None:
+            return item
+        return deferred.addCallback(lambda _: item)
+
+
+class BufferedPipeline(DatabasePipeline):
+    """Base class for pipelines collecting database writes in memory
+
+    Buffered entries are written by calling write() with the whole batch, either when
+    DB_BATCH_SIZE entries are buffered, DB_FLUSH_INTERVAL seconds passed or the
+    spider closes
+    """
+
+    kind = None
+
+    def __init__(self, settings=None, stats=None) -> None:
+        super().__init__(settings, stats)
+        self.batch_size = max(self.settings.getint("DB_BATCH_SIZE", 1), 1)
+        self.flush_interval = self.settings.getfloat("DB_FLUSH_INTERVAL", 0)
+        self.buffer = []
+        self.flush_loop = None
+        self.results = None
+
+    def open_spider(self, spider):
+        """Load the product index and start flushing the buffer periodically"""
+        super().open_spider(spider)
+        if self.settings.get("SHARD_RESULTS_FILE"):
+            self.results = ShardResults.for_spider(
+                spider, self.settings.get("SHARD_RESULTS_FILE")
+            )
+        if self.flush_interval > 0:
+            self.flush_loop = task.LoopingCall(self.periodic_flush)
+            self.flush_loop.start(self.flush_interval, now=False)
+
+    @defer.inlineCallbacks
+    def close_spider(self, spider):
+        """Write all remaining buffered entries"""
+        if self.flush_loop is not None and self.flush_loop.running:
+            self.flush_loop.stop()
+        try:
+            yield self.flush()
+        finally:
+            if self.results is not None:
+                self.results.close()
+            yield super().close_spider(spider)
+
+    def buffer_entry(self, entry) -> Optional[defer.Deferred]:
+        """Add an entry to the buffer and flush if the batch is full
+
+        Returns the Deferred of the write if the buffer was flushed
+        """
+        self.buffer.append(entry)
+        if len(self.buffer) >= self.batch_size:
+            return self.flush()
+        return None
+
+    def flush(self) -> defer.Deferred:
+        """Write all buffered entries to the database in one batch
+
+        Workers of a sharded crawl append the batch to their SHARD_RESULTS_FILE instead
+        """
+        if not self.buffer:
+            return defer.succeed(None)
+        entries, self.buffer = self.buffer, []
+        if self.results is not None:
+            self.results.append(self.kind, entries)
+            return defer.succeed(None)
+        return self.write(entries)
+
+    def periodic_flush(self):
+        """Flush the buffer and log errors instead of stopping the flush loop
+
+        Without the writer thread a failed write raises out of flush()
+        """
+        defer.maybeDeferred(self.flush).addErrback(
+            lambda failure: logger.error(
+                "Writing a batch of %s entries failed",
+                self.kind,
+                exc_info=failure_to_exc_info(failure),
+            )
+        )
+
+    def write(self, entries: list) -> defer.Deferred:
+        """Write a batch of buffered entries to the database"""
+        raise NotImplementedError
 
+
+class AvailabilityPipeline(BufferedPipeline):
+    """Pipeline for adding an availability entry for a product to the database
+
+    With AVAILABILITY_RUN_LENGTH_ENCODING enabled an entry is only added if the
+    availability changed, otherwise the current entry of the product is extended.
+    The fingerprint of the product page is written with the entry in one transaction
+    """
+
+    kind = "availability"
+
+    def __init__(self, settings=None, stats=None) -> None:
+        super().__init__(settings, stats)
+        self.run_length_encoding = self.settings.getbool(
+            "AVAILABILITY_RUN_LENGTH_ENCODING", False
+        )
+
+    @timed_item
     def process_item(self, item: LegoItem, spider):  # pylint: disable=W0613
         """Pipeline process function.
         Drops the item if product does not exist in the database.
-        Adds an entry to the Availability table for the product
+        Buffers an entry for the Availability table for the product.
+        A HeartbeatItem or an unknown availability confirms the current availability
+        of the product
         """
-        if not does_product_exist(item["product_id"], self.engine):
-            raise DropItem(f"Product does not exist in database: {item['name']}")
+        if isinstance(item, HeartbeatItem):
+            availability = None
+        elif isinstance(item, LegoItem):
+            availability = item["availability"]
+            if availability == UNKNOWN_AVAILABILITY:
+                availability = None
+        else:
+            return item
 
-        availability = Availability()
-        availability.product_id = item["product_id"]
-        availability.availability = item["availability"]
-        add_availability(availability, self.engine)
-        return item
+        if item["product_id"] not in self.products:
+            raise UnknownProduct(f"Product does not exist in database: {item['url']}")
 
+        entry = {
+            "product_id": item["product_id"],
+            "availability": availability,
+            "timestamp": item.get("observed_at") or datetime.datetime.utcnow(),
+        }
+        fingerprint = item.get("fingerprint")
+        if fingerprint is not None:
+            entry["fingerprint"] = {
+                "url": fingerprint["url"],
+                "etag": fingerprint.get("etag"),
+                "last_modified": fingerprint.get("last_modified"),
+                "content_hash": fingerprint["content_hash"],
+                "checked_at": entry["timestamp"],
+            }
+        flushed = self.buffer_entry(entry)
+        return self.item_after(flushed, item)
 
-class UpdatePricePipeline:
-    """Pipeline for updating the price of a lego product in the database"""
+    def write(self, entries: list) -> defer.Deferred:
+        """Insert all buffered availability entries and page fingerprints"""
+        return self.timed_write(
+            add_availabilities, entries, self.engine, self.run_length_encoding
+        )
 
-    def __init__(self) -> None:
-        """Create tables if they don't exist yet"""
-        self.engine = db_connect()
-        create_table(self.engine)
 
+class TransitionPipeline(DatabasePipeline):
+    """Pipeline for detecting availability transitions while crawling
+
+    Keeps the current availability of all products in memory. An item whose
+    availability differs from the cached one is passed as a transition to the sinks
+    configured with TRANSITION_SINKS, see transitions.py, before the buffered
+    AvailabilityPipeline writes it. The pipeline stamps the items with the time they
+    were observed, which the AvailabilityPipeline uses as timestamp of the entry.
+    Workers of a sharded crawl don't write to the database, so there the pipeline
+    does nothing
+    """
+
+    def __init__(self, settings=None, stats=None, signals=None) -> None:
+        super().__init__(settings, stats)
+        self.signals = signals
+        self.availabilities = None
+        self.sinks = []
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        """Instantiate the pipeline with the settings, stats and signals of the crawler"""
+        return cls(
+            settings=crawler.settings, stats=crawler.stats, signals=crawler.signals
+        )
+
+    def open_spider(self, spider):
+        """Load the current availabilities and instantiate the sinks"""
+        super().open_spider(spider)
+        if self.settings.get("SHARD_RESULTS_FILE"):
+            return
+        with self.metrics.time("database", "load_product_availabilities"):
+            self.availabilities = load_product_availabilities(self.engine)
+        self.sinks = [
+            load_object(path).from_pipeline(self)
+            for path in self.settings.getlist("TRANSITION_SINKS")
+        ]
+
+    @timed_item
+    def process_item(self, item: LegoItem, spider):
+        """Pipeline process function.
+        Passes a transition to the sinks if the availability of the item changed
+        """
+        if not isinstance(item, LegoItem) or self.availabilities is None:
+            return item
+        if item["product_id"] not in self.products:
+            return item
+
+        item.setdefault("observed_at", datetime.datetime.utcnow())
+        if item["availability"] == UNKNOWN_AVAILABILITY:
+            return item
+        previous = self.availabilities.get(item["product_id"])
+        self.availabilities[item["product_id"]] = item["availability"]
+        if previous is None or previous == item["availability"]:
+            return item
+
+        transition = {
+            "product_id": item["product_id"],
+            "name": item["name"],
+            "url": item["url"],
+            "price": item.get("price"),
+            "old_availability": previous,
+            "new_availability": item["availability"],
+            "observed_at": item["observed_at"],
+        }
+        if self.stats is not None:
+            self.stats.inc_value("transitions/detected")
+        handled = defer.DeferredList(
+            [defer.maybeDeferred(sink.emit, transition) for sink in self.sinks],
+            consumeErrors=True,
+        )
+        handled.addCallback(self.transition_handled, transition, spider)
+        return self.item_after(handled, item)
+
+    def transition_handled(self, results, transition: dict, spider):
+        """Log failed sinks and send the transition_detected signal"""
+        for success, result in results:
+            if not success:
+                logger.error(
+                    "Handling the transition of %s failed",
+                    transition["product_id"],
+                    exc_info=failure_to_exc_info(result),
+                )
+        if self.signals is not None:
+            self.signals.send_catch_log(
+                transition_detected, transition=transition, spider=spider
+            )
+
+
+class UpdatePricePipeline(BufferedPipeline):
+    """Pipeline for updating the price of a lego product in the database
+
+    Only prices which differ from the known price of the ProductIndex are buffered.
+    The ProductIndex is updated once the batch is written, so the prices of a failed
+    batch are buffered again by later items. Every change is added to the price
+    history. Price drops of at least PRICE_DROP_MIN_PERCENT are queued in the
+    notification outbox
+    """
+
+    kind = "price"
+
+    def __init__(self, settings=None, stats=None) -> None:
+        super().__init__(settings, stats)
+        min_percent = self.settings.get("PRICE_DROP_MIN_PERCENT")
+        self.min_drop = float(min_percent) / 100 if min_percent is not None else None
+
+    @timed_item
     def process_item(self, item: LegoItem, spider):  # pylint: disable=W0613
         """Pipeline process function.
         Drops the item if product does not exist in the database.
-        Updates the price of the product in the Product table
+        Buffers a price update of the product in the Product table if the price changed
         """
-        if not does_product_exist(item["product_id"], self.engine):
-            raise DropItem(f"Product does not exist in database: {item['name']}")
+        if not isinstance(item, LegoItem) or item.get("price") is None:
+            return item
+        if item["product_id"] not in self.products:
+            raise UnknownProduct(f"Product does not exist in database: {item['name']}")
 
-        product = Product()
-        product.name = item["name"]
-        product.price = item["price"]
-        product.product_id = item["product_id"]
-        product.url = item["url"]
-        update_product_price(product, self.engine)
+        if self.products.get_price(item["product_id"]) != item["price"]:
+            observed_at = item.get("observed_at") or datetime.datetime.utcnow()
+            return self.item_after(
+                self.buffer_entry((item["product_id"], item["price"], observed_at)),
+                item,
+            )
         return item
 
+    def write(self, entries: list) -> defer.Deferred:
+        """Update the prices of all buffered products. The latest price wins"""
+        prices = {product_id: price for product_id, price, _ in entries}
+        observed_at = {product_id: timestamp for product_id, _, timestamp in entries}
+        return self.timed_write(
+            update_product_prices, prices, self.engine, observed_at, self.min_drop
+        ).addCallback(self.update_index, prices)
 
-class LegoPipeline:
-    """Pipeline for adding new lego products to the database"""
+    def update_index(self, result, prices: Dict[int, int]):
+        """Set the written prices in the ProductIndex"""
+        if self.products is not None:
+            for product_id, price in prices.items():
+                self.products.set_price(product_id, price)
+        return result
 
-    def __init__(self) -> None:
-        """Create tables if they don't exist yet"""
-        self.engine = db_connect()
-        create_table(self.engine)
 
+class QuarantinePipeline(BufferedPipeline):
+    """Pipeline for recording unknown availability strings of product pages
+
+    Items with an unknown availability are kept, the AvailabilityPipeline treats them
+    like a HeartbeatItem. Their availability strings are written to the
+    quarantined_statuses table to extend AVAILABILITY_CODES in items.py
+    """
+
+    kind = "quarantine"
+
+    @timed_item
+    def process_item(self, item: LegoItem, spider):  # pylint: disable=W0613
+        """Pipeline process function.
+        Buffers the availability string of an item with an unknown availability
+        """
+        if (
+            not isinstance(item, LegoItem)
+            or item.get("availability") != UNKNOWN_AVAILABILITY
+        ):
+            return item
+
+        if self.stats is not None:
+            self.stats.inc_value("items/unknown_availability")
+        flushed = self.buffer_entry(
+            {
+                "text": item.get("availability_text") or "",
+                "product_id": item.get("product_id"),
+                "url": item.get("url"),
+                "timestamp": item.get("observed_at") or datetime.datetime.utcnow(),
+            }
+        )
+        return self.item_after(flushed, item)
+
+    def write(self, entries: list) -> defer.Deferred:
+        """Record all buffered availability strings"""
+        return self.timed_write(quarantine_statuses, entries, self.engine)
+
+
+class LegoPipeline(DatabasePipeline):
+    """Pipeline for adding new lego products to the database"""
+
+    @timed_item
     def process_item(self, item: LegoItem, spider):  # pylint: disable=W0613
         """Pipeline process function.
         Save products in the database
         """
         product = Product()
         product.name = item["name"]
-        product.price = item["price"]
+        product.price = item.get("price")
         product.product_id = item["product_id"]
         product.url = item["url"]
-        add_product(product, self.engine)
-        return item
+        self.products.set_price(item["product_id"], item.get("price"))
+        return self.item_after(
+            self.timed_write(add_product, product, self.engine), item
+        )
 
 
-class DuplicatesPipeline:
+class DuplicatesPipeline(DatabasePipeline):
     """Pipeline for dropping duplicate lego products"""
 
-    def __init__(self):
-        """Create tables if they don't exist yet"""
-        self.engine = db_connect()
-        create_table(self.engine)
-
+    @timed_item
     def process_item(self, item: LegoItem, spider):  # pylint: disable=W0613
         """Pipeline process function.
         Drop items that already exist in the database
         """
-        if does_product_exist(item["product_id"], self.engine):
-            raise DropItem(f"Duplicate item found: {item['name']}")
+        if item["product_id"] in self.products:
+            raise DuplicateItem(f"Duplicate item found: {item['name']}")
         return item
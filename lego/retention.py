@@ -0,0 +1,124 @@
+#!/usr/bin/python3
+
+"""Retention of the availability history
+
+The availability table grows with every sweep. The retention job keeps it small:
+
+- Consecutive entries of a product with the same availability, last seen more than
+  AVAILABILITY_DOWNSAMPLE_DAYS ago, are merged into one entry per status interval
+- Entries last seen more than AVAILABILITY_RETENTION_DAYS ago are deleted
+- The freed pages are returned to the file system with an incremental vacuum
+
+The current interval of every product is always kept. All steps work in short
+transactions, so the job can run while a crawl writes to the database. The daemon runs
+it every RETENTION_INTERVAL_HOURS, or run it from the project root:
+
+    python -m lego.retention
+
+A database created before auto_vacuum = incremental was added to SQLITE_PRAGMAS
+needs one full vacuum to enable the incremental vacuum, while no crawl runs:
+
+    python -m lego.retention --vacuum-full
+"""
+
+import argparse
+import datetime
+import logging
+from typing import Dict, Optional
+from scrapy.utils.project import get_project_settings
+from sqlalchemy.engine.base import Engine
+from lego.database import (
+    db_connect,
+    delete_old_availability_entries,
+    downsample_availability_entries,
+    incremental_vacuum,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class RetentionJob:  # pylint: disable=R0902
+    """Downsamples and deletes old availability entries and vacuums the database"""
+
+    def __init__(  # pylint: disable=R0913
+        self,
+        engine: Engine,
+        *,
+        downsample_days: Optional[float] = 30.0,
+        retention_days: Optional[float] = None,
+        chunk_size: int = 1000,
+        pause: float = 0.05,
+        vacuum_pages: int = 1000,
+    ) -> None:
+        self.engine = engine
+        self.downsample_days = downsample_days
+        self.retention_days = retention_days
+        self.chunk_size = chunk_size
+        self.pause = pause
+        self.vacuum_pages = vacuum_pages
+
+    @classmethod
+    def from_settings(cls, settings, engine: Engine):
+        """Instantiate the job with the retention settings"""
+        return cls(
+            engine,
+            downsample_days=settings.get("AVAILABILITY_DOWNSAMPLE_DAYS", 30.0),
+            retention_days=settings.get("AVAILABILITY_RETENTION_DAYS"),
+            chunk_size=settings.getint("RETENTION_CHUNK_SIZE", 1000),
+            pause=settings.getfloat("RETENTION_CHUNK_PAUSE", 0.05),
+            vacuum_pages=settings.getint("RETENTION_VACUUM_PAGES", 1000),
+        )
+
+    def run(self, now: Optional[datetime.datetime] = None) -> Dict[str, int]:
+        """Runs all steps and returns the number of merged, deleted and freed rows/pages"""
+        now = now or datetime.datetime.utcnow()
+        counts = {"merged": 0, "deleted": 0, "freed_pages": 0}
+        if self.downsample_days is not None:
+            counts["merged"] = downsample_availability_entries(
+                now - datetime.timedelta(days=float(self.downsample_days)),
+                self.engine,
+                self.chunk_size,
+                self.pause,
+            )
+        if self.retention_days is not None:
+            counts["deleted"] = delete_old_availability_entries(
+                now - datetime.timedelta(days=float(self.retention_days)),
+                self.engine,
+                self.chunk_size,
+                self.pause,
+            )
+        counts["freed_pages"] = incremental_vacuum(
+            self.engine, self.vacuum_pages, self.pause
+        )
+        logger.info(
+            "Merged %d and deleted %d availability entries, freed %d pages",
+            counts["merged"],
+            counts["deleted"],
+            counts["freed_pages"],
+        )
+        return counts
+
+
+def vacuum_full(engine: Engine):
+    """Rebuilds the database, which applies the auto_vacuum mode of SQLITE_PRAGMAS"""
+    raw_connection = engine.raw_connection()
+    try:
+        raw_connection.connection.execute("VACUUM")
+    finally:
+        raw_connection.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description=__doc__.split("\n", maxsplit=1)[0])
+    parser.add_argument(
+        "--vacuum-full",
+        action="store_true",
+        help="rebuild the database first to enable the incremental vacuum",
+    )
+    args = parser.parse_args()
+    project_settings = get_project_settings()
+    db_engine = db_connect(project_settings)
+    if args.vacuum_full:
+        vacuum_full(db_engine)
+    RetentionJob.from_settings(project_settings, db_engine).run()
@@ -0,0 +1,117 @@
+"""Priority-aware scheduling of the availability checks of Lego products
+
+Every product gets a check interval based on its current availability code
+(see AVAILABILITY_CODES in items.py), the number of availability changes within the
+recent history and the time since its last change. Products are only due for a check
+when their check interval passed since they were last seen. Due products get a Scrapy
+request priority, so the fixed request budget is spent on products which are likely
+to be restocked first.
+"""
+
+import datetime
+from typing import Dict, Iterable, Iterator, Optional, Tuple
+
+# Check interval in hours for each availability code
+DEFAULT_CHECK_INTERVALS = {
+    1: 6.0,  # Jetzt verfügbar
+    2: 1.0,  # Vorübergehend nicht auf Lager
+    3: 24.0,  # Ausverkauft
+    4: 2.0,  # Nachbestellungen möglich
+}
+DEFAULT_CHECK_INTERVAL = 2.0
+
+# Additional priority for availability codes which may change into a restock
+STATUS_PRIORITIES = {2: 20, 4: 10}
+MAX_PRIORITY = 100
+
+
+class AvailabilityScheduler:
+    """Computes the check interval and request priority of products
+
+    The entries passed to the scheduler are dicts as returned by
+    database.iter_product_schedule
+    """
+
+    def __init__(
+        self,
+        check_intervals: Optional[Dict[int, float]] = None,
+        min_interval: float = 0.5,
+        max_interval: float = 72.0,
+        history_days: float = 30.0,
+    ) -> None:
+        """All intervals are in hours"""
+        self.check_intervals = dict(DEFAULT_CHECK_INTERVALS)
+        self.check_intervals.update(check_intervals or {})
+        self.min_interval = datetime.timedelta(hours=min_interval)
+        self.max_interval = datetime.timedelta(hours=max_interval)
+        self.history = datetime.timedelta(days=history_days)
+
+    @classmethod
+    def from_settings(cls, settings):
+        """Instantiate the scheduler with the AVAILABILITY_SCHEDULER_* settings"""
+        check_intervals = settings.getdict("AVAILABILITY_SCHEDULER_CHECK_INTERVALS")
+        return cls(
+            check_intervals={int(k): float(v) for k, v in check_intervals.items()},
+            min_interval=settings.getfloat("AVAILABILITY_SCHEDULER_MIN_INTERVAL", 0.5),
+            max_interval=settings.getfloat("AVAILABILITY_SCHEDULER_MAX_INTERVAL", 72.0),
+            history_days=settings.getfloat("AVAILABILITY_SCHEDULER_HISTORY_DAYS", 30.0),
+        )
+
+    def history_start(self, now: datetime.datetime) -> datetime.datetime:
+        """Returns the start of the history used for counting transitions"""
+        return now - self.history
+
+    def check_interval(
+        self, entry: dict, now: datetime.datetime
+    ) -> datetime.timedelta:
+        """Returns the time between two checks of a product
+
+        The interval of the availability code is divided by the number of recent
+        transitions. It is halved for products changed within the last day and
+        doubled for products unchanged for longer than the history
+        """
+        hours = self.check_intervals.get(entry["availability"], DEFAULT_CHECK_INTERVAL)
+        interval = datetime.timedelta(hours=hours) / (1 + (entry["transitions"] or 0))
+        if entry["last_changed"] is not None:
+            since_change = now - entry["last_changed"]
+            if since_change < datetime.timedelta(days=1):
+                interval /= 2
+            elif since_change > self.history:
+                interval *= 2
+        return min(max(interval, self.min_interval), self.max_interval)
+
+    def next_check(self, entry: dict, now: datetime.datetime) -> datetime.datetime:
+        """Returns the time at which a product is due for the next check"""
+        if entry["last_seen"] is None:
+            return now
+        return entry["last_seen"] + self.check_interval(entry, now)
+
+    def priority(self, entry: dict, now: datetime.datetime) -> int:
+        """Returns the Scrapy request priority of a product
+
+        Products never checked get the maximum priority. Otherwise the priority grows
+        with the number of check intervals the product is overdue
+        """
+        if entry["last_seen"] is None:
+            return MAX_PRIORITY
+        overdue = (now - entry["last_seen"]) / self.check_interval(entry, now)
+        priority = int(10 * min(overdue, 5.0)) + STATUS_PRIORITIES.get(
+            entry["availability"], 0
+        )
+        return min(priority, MAX_PRIORITY)
+
+    def schedule(
+        self, entries: Iterable[dict], now: Optional[datetime.datetime] = None
+    ) -> Iterator[Tuple[dict, int]]:
+        """Yields the entries due for a check together with their priority"""
+        now = now or datetime.datetime.utcnow()
+        for entry in entries:
+            if self.next_check(entry, now) <= now:
+                yield entry, self.priority(entry, now)
+
+    def next_due(
+        self, entries: Iterable[dict], now: Optional[datetime.datetime] = None
+    ) -> Optional[datetime.datetime]:
+        """Returns the time at which the first of the entries is due for a check"""
+        now = now or datetime.datetime.utcnow()
+        return min((self.next_check(entry, now) for entry in entries), default=None)
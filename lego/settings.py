@@ -15,6 +15,144 @@ NEWSPIDER_MODULE = "lego.spiders"
 
 CONNECTION_STRING = "sqlite:///scrapy_products.db"
 
+# All database users of a process share one engine and its connection pool.
+# SQLite connections open with these PRAGMAs. In WAL mode the database can be read,
+# e.g. by evaluate_availability.py, while a crawl writes to it. busy_timeout is the
+# time in milliseconds to wait for a lock, cache_size is in KiB if negative
+DB_POOL_SIZE = 5
+DB_MAX_OVERFLOW = 10
+SQLITE_PRAGMAS = {
+    # Must precede journal_mode, only takes effect on a new database or after VACUUM
+    "auto_vacuum": "incremental",
+    "journal_mode": "wal",
+    "synchronous": "normal",
+    "busy_timeout": 10000,
+    "cache_size": -65536,
+    "mmap_size": 268435456,
+    "temp_store": "memory",
+}
+
+# The LegoProductSpider starts at SHOP_URL/themes and follows the links below SHOP_URL
+SHOP_URL = "https://www.lego.com/de-de"
+
+# Keep the pages discovered by the LegoProductSpider in the crawl_frontier table.
+# An interrupted crawl is resumed. A new crawl revisits the listing pages changed within
+# FRONTIER_CHANGED_DAYS or not crawled for FRONTIER_REVISIT_DAYS and only follows links
+# to pages not discovered before
+FRONTIER_ENABLED = True
+FRONTIER_REVISIT_DAYS = 3.0
+FRONTIER_CHANGED_DAYS = 7.0
+
+# Links are followed by their canonical url without the fragment and all query
+# parameters except CANONICAL_QUERY_PARAMETERS, see lego/urls.py.
+# The dupefilter keeps the canonical urls of the requests in a scalable Bloom filter
+# for DUPEFILTER_BLOOM_CAPACITY urls, growing if needed, with a false positive rate of
+# DUPEFILTER_BLOOM_ERROR_RATE. Its state is saved in JOBDIR if set
+CANONICAL_QUERY_PARAMETERS = ["page"]
+DUPEFILTER_CLASS = "lego.dupefilter.CanonicalDupeFilter"
+DUPEFILTER_BLOOM_CAPACITY = 100000
+DUPEFILTER_BLOOM_ERROR_RATE = 1e-6
+
+# Extractors for the product information on product pages, see lego/extractors.py.
+# The next extractor only runs if fields are still missing. The JSON-LD availability
+# is only used if no extractor finds the status text of the shop
+PRODUCT_EXTRACTORS = [
+    "lego.extractors.JsonLdExtractor",
+    "lego.extractors.CssExtractor",
+]
+
+# Buffered database writes of the AvailabilityPipeline and UpdatePricePipeline.
+# Entries are written in one transaction once DB_BATCH_SIZE items are buffered or
+# DB_FLUSH_INTERVAL seconds passed. Remaining entries are written when the spider closes.
+# DB_BATCH_SIZE = 1 writes every item immediately
+DB_BATCH_SIZE = 100
+DB_FLUSH_INTERVAL = 10.0
+
+# Run the database writes of the pipelines in a dedicated thread, so downloading and
+# parsing continue during commits. At most DB_WRITER_MAX_PENDING writes are queued,
+# further items wait for the database
+DB_WRITER_ENABLED = True
+DB_WRITER_MAX_PENDING = 4
+
+# The TransitionPipeline passes every availability transition to these sinks as soon
+# as the item arrives, see lego/transitions.py. The OutboxSink queues the notification
+# right away instead of with the next batch of the AvailabilityPipeline
+TRANSITION_SINKS = ["lego.transitions.OutboxSink"]
+
+# Price changes are added to the price_history table. A price drop of at least
+# PRICE_DROP_MIN_PERCENT of the previous price is queued in the notification outbox,
+# None disables the price drop notifications
+PRICE_DROP_MIN_PERCENT = 5.0
+
+# Store the availability history run length encoded. A new entry is only written if
+# the availability of a product changed, otherwise the last_seen timestamp of the
+# current entry is moved
+AVAILABILITY_RUN_LENGTH_ENCODING = True
+
+# Only crawl the products due for an availability check, see lego/scheduler.py.
+# The check interval in hours of each availability code is shortened for products
+# with many changes within the history and clamped to the min and max interval
+AVAILABILITY_SCHEDULER_ENABLED = True
+AVAILABILITY_SCHEDULER_CHECK_INTERVALS = {
+    1: 6.0,  # Jetzt verfügbar
+    2: 1.0,  # Vorübergehend nicht auf Lager
+    3: 24.0,  # Ausverkauft
+    4: 2.0,  # Nachbestellungen möglich
+}
+AVAILABILITY_SCHEDULER_MIN_INTERVAL = 0.5
+AVAILABILITY_SCHEDULER_MAX_INTERVAL = 72.0
+AVAILABILITY_SCHEDULER_HISTORY_DAYS = 30.0
+
+# Request product pages with If-None-Match / If-Modified-Since and skip parsing pages
+# which were not modified or whose product information did not change
+AVAILABILITY_CONDITIONAL_REQUESTS = True
+
+# Workers of a sharded availability crawl append their database writes to this file
+# instead of writing to the database, see lego/crawl_shards.py
+SHARD_RESULTS_FILE = None
+
+# Telegram notifications of evaluate_availability.py are sent by TELEGRAM_MAX_WORKERS
+# threads sharing one bot. At most TELEGRAM_CHAT_RATE messages per second are sent to a
+# chat, in bursts of up to TELEGRAM_CHAT_BURST messages. Flood control is waited out,
+# network errors are retried TELEGRAM_MAX_RETRIES times with exponential backoff
+# starting at TELEGRAM_RETRY_BACKOFF seconds
+TELEGRAM_MAX_WORKERS = 4
+TELEGRAM_CHAT_RATE = 1.0
+TELEGRAM_CHAT_BURST = 3
+TELEGRAM_MAX_RETRIES = 5
+TELEGRAM_RETRY_BACKOFF = 1.0
+
+# Availability changes are queued in the notification outbox when they are recorded.
+# evaluate_availability.py claims OUTBOX_BATCH_SIZE notifications at a time and retries
+# a failed notification in later runs until it failed OUTBOX_MAX_ATTEMPTS times.
+# Notifications claimed by a sender which crashed are claimed again after
+# OUTBOX_LEASE_SECONDS
+OUTBOX_BATCH_SIZE = 100
+OUTBOX_MAX_ATTEMPTS = 5
+OUTBOX_LEASE_SECONDS = 300.0
+
+# The daemon (python -m lego.daemon) runs availability sweeps one after another. After a
+# sweep it sleeps until the next product is due, but at least DAEMON_MIN_SLEEP and at
+# most DAEMON_MAX_SLEEP seconds. It drains the notification outbox every
+# DAEMON_DRAIN_INTERVAL seconds while it runs
+DAEMON_MIN_SLEEP = 60.0
+DAEMON_MAX_SLEEP = 3600.0
+DAEMON_DRAIN_INTERVAL = 1.0
+
+# Retention of the availability history (python -m lego.retention, and the daemon
+# every RETENTION_INTERVAL_HOURS). Runs of the same availability last seen more than
+# AVAILABILITY_DOWNSAMPLE_DAYS ago are merged into one entry, entries last seen more
+# than AVAILABILITY_RETENTION_DAYS ago are deleted. None disables either step.
+# Both work in transactions of RETENTION_CHUNK_SIZE entries with RETENTION_CHUNK_PAUSE
+# seconds in between, so a running crawl can still write. Freed pages are returned to
+# the file system RETENTION_VACUUM_PAGES at a time
+AVAILABILITY_DOWNSAMPLE_DAYS = 30.0
+AVAILABILITY_RETENTION_DAYS = None
+RETENTION_CHUNK_SIZE = 1000
+RETENTION_CHUNK_PAUSE = 0.05
+RETENTION_VACUUM_PAGES = 1000
+RETENTION_INTERVAL_HOURS = 24.0
+
 # Crawl responsibly by identifying yourself (and your website) on the user-agent
 # USER_AGENT = 'lego (+http://www.yourdomain.com)'
 
@@ -62,6 +200,22 @@ CONCURRENT_REQUESTS_PER_DOMAIN = 4
 #    'scrapy.extensions.telnet.TelnetConsole': None,
 # }
 
+# Latency histograms of the downloads, callbacks, pipelines and database functions,
+# see metrics.py. The CallbackTimingMiddleware must be closest to the spider.
+# With METRICS_CRAWL_RUNS a summary of every crawl is added to the crawl_runs table.
+# With METRICS_PROMETHEUS_PORT the metrics are served for Prometheus on
+# http://<METRICS_PROMETHEUS_INTERFACE>:<port>/metrics
+EXTENSIONS = {
+    "lego.metrics.CrawlMetrics": 500,
+}
+SPIDER_MIDDLEWARES = {
+    "lego.metrics.CallbackTimingMiddleware": 990,
+}
+METRICS_ENABLED = True
+METRICS_CRAWL_RUNS = True
+METRICS_PROMETHEUS_PORT = None
+METRICS_PROMETHEUS_INTERFACE = "127.0.0.1"
+
 # Configure item pipelines
 # See https://docs.scrapy.org/en/latest/topics/item-pipeline.html
 
@@ -69,6 +223,7 @@ ITEM_PIPELINES = {}
 
 # Pipelines for checking availabilities of products
 # ITEM_PIPELINES = {
+#    'lego.pipelines.TransitionPipeline': 100,
 #    'lego.pipelines.AvailabilityPipeline': 200,
 # }
 
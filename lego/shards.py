@@ -0,0 +1,88 @@
+"""Result files of the workers of a sharded availability crawl
+
+In a sharded crawl every worker process runs the AvailabilitySpider for one shard of
+the products. Instead of writing to the database, the buffered pipelines of a worker
+append each batch of database writes as one JSON line to the SHARD_RESULTS_FILE.
+The files are merged into the database by a single writer, see crawl_shards.py.
+A worker truncates its file when it starts, so batches of an earlier crawl are never
+merged again.
+
+Each line has the format:
+{
+    "kind": <name of the pipeline writing the entries>,
+    "entries": <list of buffered entries>
+}
+"""
+
+import datetime
+import json
+import logging
+from typing import Iterator, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+DATETIME_KEY = "__datetime__"
+
+
+def _encode(value):
+    """Encodes the datetimes of the entries for JSON"""
+    if isinstance(value, datetime.datetime):
+        return {DATETIME_KEY: value.isoformat()}
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def _decode(value: dict):
+    """Decodes the datetimes of the entries"""
+    if DATETIME_KEY in value:
+        return datetime.datetime.fromisoformat(value[DATETIME_KEY])
+    return value
+
+
+class ShardResults:
+    """Appends the batches of database writes of a worker to its result file
+
+    The file is truncated when it is opened. The pipelines of a worker share one
+    instance, which is closed with the last pipeline
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.file = open(path, "w", encoding="utf-8")  # pylint: disable=R1732
+        self.users = 0
+
+    @classmethod
+    def for_spider(cls, spider, path: str):
+        """Returns the result file shared by all pipelines of the spider"""
+        results = getattr(spider, "shard_results", None)
+        if results is None:
+            results = cls(path)
+            spider.shard_results = results
+        results.users += 1
+        return results
+
+    def append(self, kind: str, entries: list):
+        """Appends a batch of entries as one line"""
+        line = json.dumps({"kind": kind, "entries": entries}, default=_encode)
+        self.file.write(line + "\n")
+        self.file.flush()
+
+    def close(self):
+        """Close the result file after the last pipeline using it"""
+        self.users -= 1
+        if self.users <= 0:
+            self.file.close()
+
+
+def read_shard_results(path: str) -> Iterator[Tuple[str, List]]:
+    """Yields the kind and entries of every batch of a result file
+
+    A line cut off by a crashed worker is skipped
+    """
+    with open(path, encoding="utf-8") as file:
+        for line in file:
+            try:
+                batch = json.loads(line, object_hook=_decode)
+            except ValueError:
+                logger.warning("Skipping incomplete line in %s", path)
+                continue
+            yield batch["kind"], batch["entries"]
@@ -5,51 +5,262 @@ The Availability does not follow links and scrapes the current availability on t
 Lego product pages
 """
 
+import datetime
+import hashlib
+import logging
+import re
+from typing import Optional
+from urllib.parse import urlparse
 import scrapy
 from scrapy.loader import ItemLoader
 from scrapy.linkextractors import LinkExtractor
-from lego.items import LegoItem
-from lego.database import db_connect, load_product_urls
+from lego.items import (
+    availability_str_to_int,
+    HeartbeatItem,
+    LegoItem,
+    PageFingerprintItem,
+    UNKNOWN_AVAILABILITY,
+)
+from lego.database import db_connect, iter_product_schedule
+from lego.extractors import (
+    extract_product,
+    load_extractors,
+    PRODUCT_FIELDS,
+    RETIRED_STATUS,
+)
+from lego.frontier import CrawlFrontier
+from lego.metrics import Metrics
+from lego.scheduler import AvailabilityScheduler
+from lego.urls import canonicalize_url, CANONICAL_QUERY_PARAMETERS
 
+logger = logging.getLogger(__name__)
 
-class AvailabilitySpider(scrapy.Spider):
-    """A scrapy spider to extract the availabilities of crawled Lego products"""
+DEFAULT_SHOP_URL = "https://www.lego.com/de-de"
+
+
+def shop_link_extractor(shop_url: str) -> LinkExtractor:
+    """Returns a LinkExtractor following the pages of the shop and no files or mails"""
+    parsed = urlparse(shop_url)
+    domain = re.escape(parsed.netloc.removeprefix("www."))
+    return LinkExtractor(
+        allow=[f".*{domain}{re.escape(parsed.path)}.*"],
+        deny=[rf".*{domain}(.*)(\.\w{{1,3}})$", rf".*@{domain}.*"],
+    )
+
+
+def hash_product_fields(fields: dict) -> str:
+    """Returns a hash of the raw product information of a product page"""
+    content = "\x1f".join(fields[field] or "" for field in PRODUCT_FIELDS)
+    return hashlib.sha1(content.encode()).hexdigest()
+
+
+def load_product_item(
+    fields: dict, response: scrapy.http.Response
+) -> Optional[LegoItem]:
+    """Returns a LegoItem loaded from the raw product information
+
+    Returns None if the product id can't be read
+    """
+    loader = ItemLoader(item=LegoItem(), response=response)
+    for field, value in fields.items():
+        if value is not None:
+            loader.add_value(field, value)
+    loader.add_value("availability_text", fields.get("availability"))
+    loader.add_value("url", response.url)
+    item = loader.load_item()
+    if item.get("product_id") is None:
+        logger.warning("No product id on %s", response.url)
+        return None
+    return item
+
+
+class ProductPageMixin:
+    """Extraction of the product information shared by the spiders"""
+
+    _extractors = None
+
+    @property
+    def extractors(self):
+        """The extractors configured with PRODUCT_EXTRACTORS in settings.py"""
+        if self._extractors is None:
+            settings = getattr(self, "settings", None)
+            paths = settings.getlist("PRODUCT_EXTRACTORS") if settings else None
+            self._extractors = load_extractors(paths)
+        return self._extractors
+
+    def extract_product_fields(self, response: scrapy.http.Response) -> dict:
+        """Returns the raw product information of a product page"""
+        with Metrics.for_spider(self).time("spider", "extract_product_fields"):
+            return extract_product(response, self.extractors)
+
+    def load_item(
+        self, fields: dict, response: scrapy.http.Response
+    ) -> Optional[LegoItem]:
+        """Returns the LegoItem of a product page or None without product id"""
+        with Metrics.for_spider(self).time("spider", "load_product_item"):
+            item = load_product_item(fields, response)
+        if item is None and getattr(self, "crawler", None) is not None:
+            self.crawler.stats.inc_value("items/no_product_id")
+        return item
+
+
+class AvailabilitySpider(ProductPageMixin, scrapy.Spider):
+    """A scrapy spider to extract the availabilities of crawled Lego products
+
+    Optional spider arguments for partial refresh runs:
+        - max_age_hours: only crawl products not seen within the last hours
+        - availability: comma separated availability codes, e.g. "2,3" to only crawl
+          products which are currently not available
+
+        - shard, shards: only crawl the products of shard number shard (0 to
+          shards - 1), see lego/crawl_shards.py
+
+    Example: scrapy crawl availability -a availability=2,3 -a max_age_hours=6
+
+    With AVAILABILITY_SCHEDULER_ENABLED only products due for a check are crawled,
+    ordered by their priority computed by the AvailabilityScheduler.
+
+    With AVAILABILITY_CONDITIONAL_REQUESTS product pages are requested conditionally.
+    If the page is not modified or the hash of its product information did not
+    change, only a HeartbeatItem is emitted instead of parsing the page
+    """
 
     name = "availability"
+    handle_httpstatus_list = [304]
     custom_settings = {
         "ITEM_PIPELINES": {
+            "lego.pipelines.TransitionPipeline": 100,
+            "lego.pipelines.QuarantinePipeline": 150,
             "lego.pipelines.AvailabilityPipeline": 200,
             "lego.pipelines.UpdatePricePipeline": 300,
         }
     }
 
+    def __init__(  # pylint: disable=R0913
+        self,
+        name=None,
+        max_age_hours=None,
+        availability=None,
+        shard=None,
+        shards=None,
+        **kwargs,
+    ):
+        super().__init__(name=name, **kwargs)
+        self.max_age = None
+        if max_age_hours is not None:
+            self.max_age = datetime.timedelta(hours=float(max_age_hours))
+        self.availabilities = None
+        if availability is not None:
+            self.availabilities = [int(code) for code in str(availability).split(",")]
+        self.shard = None
+        if shards is not None:
+            self.shard = (int(shard or 0), int(shards))
+            if not 0 <= self.shard[0] < self.shard[1]:
+                raise ValueError(f"Invalid shard {shard} of {shards} shards")
+
     def start_requests(self):
-        urls = load_product_urls(db_connect())
-        for url in urls:
-            yield scrapy.Request(url=url, callback=self.parse)
+        scheduler = None
+        if self.settings.getbool("AVAILABILITY_SCHEDULER_ENABLED"):
+            scheduler = AvailabilityScheduler.from_settings(self.settings)
+        now = datetime.datetime.utcnow()
+        entries = iter_product_schedule(
+            db_connect(self.settings),
+            since=scheduler.history_start(now) if scheduler else now,
+            max_age=self.max_age,
+            availabilities=self.availabilities,
+            shard=self.shard,
+        )
+        if scheduler is None:
+            for entry in entries:
+                yield self.product_request(entry)
+        else:
+            for entry, priority in scheduler.schedule(entries, now):
+                yield self.product_request(entry, priority)
+
+    def product_request(self, entry: dict, priority: int = 0) -> scrapy.Request:
+        """Returns the request for a product page
+
+        If the current availability of the product is known, the request is sent
+        conditionally with the validators of the previous response
+        """
+        headers = {}
+        if (
+            self.settings.getbool("AVAILABILITY_CONDITIONAL_REQUESTS")
+            and entry["availability"] is not None
+        ):
+            if entry["etag"]:
+                headers["If-None-Match"] = entry["etag"]
+            if entry["last_modified"]:
+                headers["If-Modified-Since"] = entry["last_modified"]
+        return scrapy.Request(
+            url=entry["url"],
+            callback=self.parse,
+            priority=priority,
+            headers=headers,
+            meta={"product": entry},
+        )
 
     def parse(self, response: scrapy.http.Response, **kwargs):
         page = response.url
         self.log(page)
+        product = response.meta.get("product")
+
+        if response.status == 304:
+            yield HeartbeatItem(product_id=product["product_id"], url=product["url"])
+            return
+
         if "de-de/product" in page:
-            if response.css(".eqJexe .hlipzx::text").get():
+            fields = self.extract_product_fields(response)
+            if fields["name"]:
                 self.log("############# Product page: " + page + " #############")
 
-                if not "Altes Produkt" in response.css(".ejRirH .hlipzx::text").get():
-                    loader = ItemLoader(item=LegoItem(), response=response)
-                    loader.add_css("name", ".eqJexe .hlipzx::text")
-                    loader.add_css("price", ".eGdbAY::text")
-                    loader.add_css(
-                        "product_id",
-                        ".ProductDetailsstyles__ProductID-sc-16lgx7x-10.bIKuiP::text",
+                # Pages with an unknown availability are parsed again by every crawl,
+                # so the QuarantinePipeline counts each sighting of the status
+                known = (
+                    availability_str_to_int(fields["availability"] or "")
+                    != UNKNOWN_AVAILABILITY
+                )
+                content_hash = hash_product_fields(fields)
+                fingerprint = None
+                if known:
+                    fingerprint = PageFingerprintItem(
+                        url=product["url"] if product else page,
+                        etag=response.headers.get("ETag", b"").decode() or None,
+                        last_modified=response.headers.get(
+                            "Last-Modified", b""
+                        ).decode()
+                        or None,
+                        content_hash=content_hash,
+                    )
+                if (
+                    known
+                    and product
+                    and product["availability"] is not None
+                    and product["content_hash"] == content_hash
+                ):
+                    yield HeartbeatItem(
+                        product_id=product["product_id"],
+                        url=product["url"],
+                        fingerprint=fingerprint,
                     )
-                    loader.add_css("availability", ".ejRirH .hlipzx::text")
-                    loader.add_value("url", response.url)
-                    yield loader.load_item()
+                    return
+
+                if RETIRED_STATUS not in (fields["availability"] or ""):
+                    item = self.load_item(fields, response)
+                    if item is not None:
+                        item["fingerprint"] = fingerprint
+                        yield item
 
 
-class LegoProductSpider(scrapy.Spider):
-    """A scrapy spider to search for Lego products in the Lego shop page"""
+class LegoProductSpider(ProductPageMixin, scrapy.Spider):
+    """A scrapy spider to search for Lego products in the Lego shop page
+
+    The crawl starts at the themes page of SHOP_URL and follows all links of the shop.
+    Links are followed by their canonical url, see lego/urls.py
+
+    With FRONTIER_ENABLED the discovered pages are kept in the CrawlFrontier. An
+    interrupted crawl is resumed and later crawls only follow links to new pages
+    """
 
     name = "products"
     custom_settings = {
@@ -61,34 +272,89 @@ class LegoProductSpider(scrapy.Spider):
 
     def __init__(self, name=None, **kwargs):
         super().__init__(name=name, **kwargs)
-        self.link_extractor = LinkExtractor(
-            allow=[r".*lego\.com/de-de.*"],
-            deny=[r".*lego\.com(.*)(\.\w{1,3})$", r".*@lego\.com.*"],
-        )
+        self.link_extractor = shop_link_extractor(DEFAULT_SHOP_URL)
+        self.frontier = None
 
     def start_requests(self):
-        urls = ["https://www.lego.com/de-de/themes"]
-        for url in urls:
-            yield scrapy.Request(url=url, callback=self.parse)
+        shop_url = self.settings.get("SHOP_URL", DEFAULT_SHOP_URL)
+        self.link_extractor = shop_link_extractor(shop_url)
+        urls = [self.canonical_url(shop_url + "/themes")]
+        if not self.settings.getbool("FRONTIER_ENABLED"):
+            for url in urls:
+                yield scrapy.Request(url=url, callback=self.parse)
+            return
+
+        self.frontier = CrawlFrontier.from_settings(
+            self.settings, db_connect(self.settings)
+        )
+        for page in self.frontier.start(urls):
+            yield self.frontier_request(page.url)
+        if self.frontier.resumed:
+            self.crawler.stats.set_value("frontier/resumed", True)
+
+    def frontier_request(self, url: str) -> scrapy.Request:
+        """Returns the request for a page of the frontier"""
+        return scrapy.Request(
+            url=url,
+            callback=self.parse,
+            errback=self.frontier_error,
+            meta={"frontier_url": url},
+        )
+
+    def frontier_error(self, failure):
+        """Marks a page of the frontier as crawled if its request failed"""
+        self.frontier.crawled_page(failure.request.meta["frontier_url"])
 
     def parse(self, response: scrapy.http.Response, **kwargs):
         page = response.url
         self.log(page)
-        if "de-de/product" in page:
-            if response.css(".eqJexe .hlipzx::text").get():
+        is_product_page = "de-de/product" in page
+        if is_product_page:
+            fields = self.extract_product_fields(response)
+            if fields["name"]:
                 self.log("############# Found product page: " + page + " #############")
 
-                if not "Altes Produkt" in response.css(".ejRirH .hlipzx::text").get():
-                    loader = ItemLoader(item=LegoItem(), response=response)
-                    loader.add_css("name", ".eqJexe .hlipzx::text")
-                    loader.add_css("price", ".eGdbAY::text")
-                    loader.add_css(
-                        "product_id",
-                        ".ProductDetailsstyles__ProductID-sc-16lgx7x-10.bIKuiP::text",
-                    )
-                    loader.add_css("availability", ".ejRirH .hlipzx::text")
-                    loader.add_value("url", response.url)
-                    yield loader.load_item()
+                if RETIRED_STATUS not in (fields["availability"] or ""):
+                    item = self.load_item(fields, response)
+                    if item is not None:
+                        yield item
+
+        urls = sorted(
+            {
+                self.canonical_url(link.url)
+                for link in self.link_extractor.extract_links(response)
+            }
+        )
+        if self.frontier is None:
+            for url in urls:
+                yield scrapy.Request(url=url, callback=self.parse)
+            return
+
+        for url in urls:
+            if self.frontier.discover(url, "de-de/product" not in url):
+                self.crawler.stats.inc_value("frontier/discovered")
+                yield self.frontier_request(url)
+        self.frontier.crawled_page(
+            response.meta.get("frontier_url", page),
+            None if is_product_page else urls,
+        )
+
+    def canonical_url(self, url: str) -> str:
+        """Returns the canonical url of a page, see lego/urls.py"""
+        return canonicalize_url(
+            url,
+            self.settings.getlist(
+                "CANONICAL_QUERY_PARAMETERS", CANONICAL_QUERY_PARAMETERS
+            ),
+        )
 
-        for next_page in self.link_extractor.extract_links(response):
-            yield response.follow(next_page, self.parse)
+    def closed(self, reason):
+        """Ends the discovery run of the frontier if the crawl finished.
+        Otherwise the pending pages are resumed by the next crawl
+        """
+        if self.frontier is None:
+            return
+        if reason == "finished":
+            self.frontier.finish()
+        else:
+            self.frontier.flush()
@@ -1,20 +1,43 @@
 # pylint: disable=R0201
-""" Contains a LegoRestockBot class to create and send Telegram messages for product updates """
+""" Contains a LegoRestockBot class to create and send Telegram messages for product updates
 
+The NotificationDispatcher sends many messages concurrently with one bot and its
+connection pool. It keeps to a rate limit per chat and in total, waits as long as
+Telegram asks for on flood control (RetryAfter), retries network errors with
+exponential backoff and reports the delivery latency of every message.
+"""
+
+import logging
+import random
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, Iterable, List, Optional, Tuple
 import telegram
+from telegram.error import BadRequest, NetworkError, RetryAfter, TelegramError
+from telegram.utils.request import Request
+
+logger = logging.getLogger(__name__)
 
 
-def price_cents_to_str(cents: int) -> str:
+def price_cents_to_str(cents: Optional[int]) -> str:
     """Helper to convert cents to a decimal representation in Euro"""
-    return f"{float(cents) / 100.0:.2f}".replace(".", ",")
+    if cents is None:
+        return "?"
+    return f"{cents // 100},{cents % 100:02d}"
 
 
 class LegoRestockBot:
     """Class to create and send Lego update messages"""
 
-    def __init__(self, token: str, channel_id: str) -> None:
-        """Instantiante the telegram.Bot with the Telegram bot token"""
-        self.bot = telegram.Bot(token=token)
+    def __init__(self, token: str, channel_id: str, con_pool_size: int = 1) -> None:
+        """Instantiante the telegram.Bot with the Telegram bot token
+
+        con_pool_size is the number of connections the bot can use at the same time
+        """
+        self.bot = telegram.Bot(
+            token=token, request=Request(con_pool_size=con_pool_size)
+        )
         self.channel_id = channel_id
 
     def create_message_available(
@@ -65,6 +88,187 @@ class LegoRestockBot:
             + f'Zum Lego Shop <a href="{product_url}">#{product_id}: {product_name}</a>'
         )
 
+    def create_message_price_drop(  # pylint: disable=R0913
+        self,
+        product_id: int,
+        product_name: str,
+        product_url: str,
+        old_price_cents: int,
+        new_price_cents: int,
+    ) -> str:
+        """Create a message about a product whose price dropped"""
+        discount = round(100 * (old_price_cents - new_price_cents) / old_price_cents)
+        return (
+            f"💶 <b>{product_name}</b> #{product_id} 💶\n\n <b>{product_name}</b> kostet \
+jetzt {price_cents_to_str(new_price_cents)}€ statt \
+{price_cents_to_str(old_price_cents)}€ (-{discount}%)!\n\n➡️➡️ "
+            + f'Zum Lego Shop <a href="{product_url}">#{product_id}: {product_name}</a>'
+        )
+
     def send_html_message_to_channel(self, html_str: str):
         """Sends a message to the telegram channel in HTML mode"""
         self.bot.send_message(text=html_str, chat_id=self.channel_id, parse_mode="html")
+
+
+class RateLimiter:
+    """Thread-safe token bucket allowing rate messages per second and bursts of burst"""
+
+    def __init__(self, rate: float, burst: int = 1) -> None:
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self) -> float:
+        """Waits for the next free slot. Returns the time waited in seconds"""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(
+                self.burst, self.tokens + (now - self.updated) * self.rate
+            )
+            self.updated = now
+            self.tokens -= 1
+            wait = max(-self.tokens / self.rate, self.paused_until - now, 0.0)
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def pause(self, seconds: float):
+        """Sends nothing for the next seconds, e.g. when Telegram asks to retry later"""
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = min(self.tokens, 0.0)
+
+
+class DeliveryReport:
+    """Result of sending one message"""
+
+    def __init__(self, chat_id: str, queued_at: float) -> None:
+        self.chat_id = chat_id
+        self.queued_at = queued_at
+        self.delivered_at = None
+        self.attempts = 0
+        self.error = None
+
+    @property
+    def delivered(self) -> bool:
+        """True if the message was sent"""
+        return self.delivered_at is not None
+
+    @property
+    def latency(self) -> Optional[float]:
+        """Seconds between queueing and delivering the message"""
+        if self.delivered_at is None:
+            return None
+        return self.delivered_at - self.queued_at
+
+
+class NotificationDispatcher:  # pylint: disable=R0902
+    """Sends messages concurrently within the Telegram rate limits
+
+    By default at most one message per second is sent to a chat, with bursts of up to
+    chat_burst messages, and at most 30 messages per second in total
+    """
+
+    def __init__(  # pylint: disable=R0913
+        self,
+        bot: telegram.Bot,
+        *,
+        max_workers: int = 4,
+        chat_rate: float = 1.0,
+        chat_burst: int = 3,
+        max_retries: int = 5,
+        backoff: float = 1.0,
+    ) -> None:
+        self.bot = bot
+        self.executor = ThreadPoolExecutor(max_workers, "telegram-dispatcher")
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.global_limiter = RateLimiter(30.0, 30)
+        self.chat_limiters: Dict[str, RateLimiter] = {}
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_settings(cls, settings, bot: telegram.Bot):
+        """Instantiate the dispatcher with the TELEGRAM_* settings"""
+        return cls(
+            bot,
+            max_workers=settings.getint("TELEGRAM_MAX_WORKERS", 4),
+            chat_rate=settings.getfloat("TELEGRAM_CHAT_RATE", 1.0),
+            chat_burst=settings.getint("TELEGRAM_CHAT_BURST", 3),
+            max_retries=settings.getint("TELEGRAM_MAX_RETRIES", 5),
+            backoff=settings.getfloat("TELEGRAM_RETRY_BACKOFF", 1.0),
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def chat_limiter(self, chat_id: str) -> RateLimiter:
+        """Returns the rate limiter of a chat"""
+        with self.lock:
+            if chat_id not in self.chat_limiters:
+                self.chat_limiters[chat_id] = RateLimiter(
+                    self.chat_rate, self.chat_burst
+                )
+            return self.chat_limiters[chat_id]
+
+    def send(self, chat_id: str, html_str: str) -> Future:
+        """Queues a message in HTML mode. Returns a Future of its DeliveryReport"""
+        report = DeliveryReport(chat_id, time.monotonic())
+        return self.executor.submit(self.deliver, report, html_str)
+
+    def send_all(self, messages: Iterable[Tuple[str, str]]) -> List[DeliveryReport]:
+        """Sends (chat_id, html_str) messages and waits until all are handled"""
+        futures = [self.send(chat_id, html_str) for chat_id, html_str in messages]
+        return [future.result() for future in futures]
+
+    def deliver(self, report: DeliveryReport, html_str: str) -> DeliveryReport:
+        """Sends a message, retrying flood control and network errors"""
+        limiter = self.chat_limiter(report.chat_id)
+        while True:
+            limiter.acquire()
+            self.global_limiter.acquire()
+            report.attempts += 1
+            try:
+                self.bot.send_message(
+                    text=html_str, chat_id=report.chat_id, parse_mode="html"
+                )
+            except RetryAfter as error:
+                logger.warning("Flood control, retrying in %.1fs", error.retry_after)
+                limiter.pause(error.retry_after)
+                report.error = error
+            except BadRequest as error:
+                report.error = error
+                break
+            except NetworkError as error:
+                report.error = error
+                delay = self.backoff * 2 ** (report.attempts - 1)
+                time.sleep(delay * random.uniform(0.5, 1.5))
+            except TelegramError as error:
+                report.error = error
+                break
+            else:
+                report.delivered_at = time.monotonic()
+                report.error = None
+                logger.info(
+                    "Delivered message to %s in %.2fs", report.chat_id, report.latency
+                )
+                break
+            if report.attempts > self.max_retries:
+                break
+        if not report.delivered:
+            logger.error(
+                "Sending message to %s failed: %s", report.chat_id, report.error
+            )
+        return report
+
+    def close(self):
+        """Waits for the queued messages and stops the worker threads"""
+        self.executor.shutdown(wait=True)
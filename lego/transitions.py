@@ -0,0 +1,80 @@
+"""Sinks for the availability transitions detected while crawling
+
+The TransitionPipeline compares the availability of every item with the cached
+current availability of the product as soon as the item arrives. Each transition is
+passed to the sinks configured with TRANSITION_SINKS in settings.py and announced
+with the transition_detected signal.
+
+A transition is a dict of format:
+{
+    "product_id": <lego product id>,
+    "name": <product name>,
+    "url": <url to lego product page>,
+    "price": <price in cents>,
+    "old_availability": <integer code for availability before the transition>,
+    "new_availability": <integer code for availability after the transition>,
+    "observed_at": <timestamp of the item>
+}
+"""
+
+import logging
+from typing import Optional
+from twisted.internet import defer
+from lego.database import notification_entry, queue_notifications
+
+logger = logging.getLogger(__name__)
+
+# Sent with the arguments transition and spider after the sinks handled a transition
+transition_detected = object()
+
+
+class TransitionSink:
+    """Base class of the sinks receiving transitions from the TransitionPipeline"""
+
+    @classmethod
+    def from_pipeline(cls, pipeline):  # pylint: disable=W0613
+        """Instantiate the sink for a TransitionPipeline"""
+        return cls()
+
+    def emit(self, transition: dict) -> Optional[defer.Deferred]:
+        """Handles a transition. May return a Deferred firing once it is handled"""
+        raise NotImplementedError
+
+
+class LogSink(TransitionSink):
+    """Logs the transitions"""
+
+    def emit(self, transition: dict) -> Optional[defer.Deferred]:
+        logger.info(
+            "Availability of %s changed from %s to %s",
+            transition["product_id"],
+            transition["old_availability"],
+            transition["new_availability"],
+        )
+
+
+class OutboxSink(TransitionSink):
+    """Queues the transitions in the notification outbox right away
+
+    The notification has the same idempotency key as the one queued when the
+    AvailabilityPipeline writes the item, so it is only queued once
+    """
+
+    def __init__(self, pipeline) -> None:
+        self.pipeline = pipeline
+
+    @classmethod
+    def from_pipeline(cls, pipeline):
+        return cls(pipeline)
+
+    def emit(self, transition: dict) -> Optional[defer.Deferred]:
+        notification = notification_entry(
+            "availability",
+            transition["product_id"],
+            transition["old_availability"],
+            transition["new_availability"],
+            transition["observed_at"],
+        )
+        return self.pipeline.timed_write(
+            queue_notifications, [notification], self.pipeline.engine
+        )
@@ -0,0 +1,48 @@
+"""Canonicalization of the urls of the Lego shop
+
+The shop links the same page with many url variants: tracking, sort and filter
+parameters, fragments, parameters in different orders and the first page of a listing
+with and without page=1. canonicalize_url maps all variants of a product or listing
+page to one url, which is requested, stored in the crawl frontier and used as the key
+of the dupefilter.
+"""
+
+import re
+from typing import Iterable
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+from w3lib.url import canonicalize_url as w3lib_canonicalize_url
+
+# Query parameters which select a different page. All others are dropped
+CANONICAL_QUERY_PARAMETERS = ("page",)
+
+# Query parameters which are dropped if they have their default value
+DEFAULT_QUERY_VALUES = {"page": "1"}
+
+DEFAULT_PORTS = {"http": 80, "https": 443}
+
+
+def canonicalize_url(
+    url: str, query_parameters: Iterable[str] = CANONICAL_QUERY_PARAMETERS
+) -> str:
+    """Returns the canonical url of a page of the shop
+
+    Lowercases the scheme and host, drops the default port, the fragment, duplicate
+    and trailing slashes and all query parameters except query_parameters. Product
+    pages keep no query parameters at all
+    """
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    netloc = (parts.hostname or "").lower()
+    if parts.port and parts.port != DEFAULT_PORTS.get(scheme):
+        netloc += f":{parts.port}"
+    path = re.sub(r"/{2,}", "/", parts.path).rstrip("/") or "/"
+
+    query = []
+    if "/product/" not in path:
+        query = [
+            (key, value)
+            for key, value in parse_qsl(parts.query)
+            if key in query_parameters and DEFAULT_QUERY_VALUES.get(key) != value
+        ]
+    canonical = urlunsplit((scheme, netloc, path, urlencode(query), ""))
+    return w3lib_canonicalize_url(canonical)
@@ -0,0 +1,87 @@
+"""Database writes off the Twisted reactor thread
+
+The DatabaseWriter runs the database write functions of the pipelines in one
+dedicated thread, so downloading and parsing continue while SQLite commits. One thread
+keeps SQLite's single writer free of lock contention and the writes in order.
+
+At most DB_WRITER_MAX_PENDING writes are queued or running. Further writes wait for a
+free slot, and so do the items whose processing triggered them. This stalls the item
+processing of the crawl until the database caught up, which in turn limits the number
+of responses Scrapy downloads ahead.
+"""
+
+import logging
+import time
+from twisted.internet import defer, threads
+from twisted.python.threadpool import ThreadPool
+
+logger = logging.getLogger(__name__)
+
+
+def _timed(func, *args) -> float:
+    """Calls a function and returns its duration in seconds"""
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+
+class DatabaseWriter:
+    """A dedicated writer thread with a bounded queue of writes
+
+    The writer is shared by all pipelines of a spider and runs while one of them is open
+    """
+
+    def __init__(self, max_pending: int = 4, reactor=None) -> None:
+        self.pool = ThreadPool(minthreads=1, maxthreads=1, name="database-writer")
+        self.slots = defer.DeferredSemaphore(max(max_pending, 1))
+        self.pending = set()
+        self.users = 0
+        # The reactor firing the Deferreds of the writes, the global one by default
+        self.reactor = reactor
+
+    @classmethod
+    def for_spider(cls, spider, settings):
+        """Returns the writer shared by all pipelines of the spider"""
+        writer = getattr(spider, "database_writer", None)
+        if writer is None:
+            writer = cls(settings.getint("DB_WRITER_MAX_PENDING", 4))
+            spider.database_writer = writer
+        return writer
+
+    def open(self):
+        """Start the writer thread for the first pipeline using it"""
+        if self.users == 0:
+            self.pool.start()
+        self.users += 1
+
+    def write(self, func, *args) -> defer.Deferred:
+        """Queues a call of a database write function
+
+        Returns a Deferred firing with the duration of the write in seconds once the
+        write is done
+        """
+        reactor = self.reactor
+        if reactor is None:
+            # pylint: disable=import-outside-toplevel
+            from twisted.internet import reactor
+
+        deferred = self.slots.run(
+            threads.deferToThreadPool, reactor, self.pool, _timed, func, *args
+        )
+        self.pending.add(deferred)
+        deferred.addBoth(self._done, deferred)
+        return deferred
+
+    def _done(self, result, deferred: defer.Deferred):
+        """Forget a finished write"""
+        self.pending.discard(deferred)
+        return result
+
+    @defer.inlineCallbacks
+    def close(self):
+        """Wait for all pending writes and stop the thread after the last pipeline"""
+        self.users -= 1
+        if self.users > 0:
+            return
+        yield defer.DeferredList(list(self.pending))
+        self.pool.stop()
@@ -1,16 +1,93 @@
+# pylint: disable=C0302
 """ This module contains the unit tests for the lego scraping functionalities.
     Tests are implemented for conversions, preprocessors, database operations, telegram operations
 """
 
 import datetime
+import queue
+import shutil
+import sys
+import threading
 import unittest
+from unittest import mock
 import os
+from types import SimpleNamespace
 from dotenv import dotenv_values
+import numpy as np
+from scrapy.http import HtmlResponse, Request
+from scrapy.settings import Settings
+from scrapy.utils.test import get_crawler
+from sqlalchemy import inspect
 from sqlalchemy.engine import create_engine
+from telegram.error import BadRequest, RetryAfter, TimedOut
+from twisted.internet import defer, task
+from benchmarks.shop import SyntheticShop
+from lego import analytics
+from lego import crawl_shards
 from lego import database
+from lego import migrations
 from lego import telegram_message
-from lego.items import availability_int_to_str, availability_str_to_int
-from lego.telegram_message import LegoRestockBot
+from lego.daemon import AvailabilityDaemon
+from lego.export import export_history
+from lego.extractors import (
+    CssExtractor,
+    extract_product,
+    JsonLdExtractor,
+    load_extractors,
+    RETIRED_STATUS,
+)
+from lego.crawl_shards import merge_results
+from lego.dupefilter import CanonicalDupeFilter, ScalableBloomFilter
+from lego.frontier import CrawlFrontier
+from lego.metrics import (
+    CallbackTimingMiddleware,
+    CrawlMetrics,
+    Metrics,
+    render_prometheus,
+)
+from lego.outbox import OutboxSender
+from lego.retention import RetentionJob
+from lego.pipelines import (
+    AvailabilityPipeline,
+    ProductIndex,
+    QuarantinePipeline,
+    TransitionPipeline,
+    UnknownProduct,
+    UpdatePricePipeline,
+)
+from lego.shards import read_shard_results, ShardResults
+from lego.scheduler import AvailabilityScheduler, MAX_PRIORITY
+from lego.spiders.product_spider import (
+    AvailabilitySpider,
+    hash_product_fields,
+    load_product_item,
+)
+from lego.items import (
+    availability_int_to_str,
+    availability_str_to_int,
+    HeartbeatItem,
+    LegoItem,
+    PageFingerprintItem,
+    process_price,
+    str_to_int,
+    UNKNOWN_AVAILABILITY,
+)
+from lego.telegram_message import LegoRestockBot, NotificationDispatcher
+from lego.urls import canonicalize_url
+from lego.writer import DatabaseWriter
+
+PRODUCT_PAGE = """<html><body>
+<h1 class="eqJexe"><span class="hlipzx">Safari-Geländewagen</span></h1>
+<span class="eGdbAY">59,00\xa0€</span>
+<span class="ProductDetailsstyles__ProductID-sc-16lgx7x-10 bIKuiP">60267</span>
+<p class="ejRirH"><span class="hlipzx">Jetzt verfügbar</span></p>
+</body></html>"""
+PRODUCT_URL = "https://www.lego.com/de-de/product/safari-off-roader-60267"
+PRODUCT_JSON_LD = """<script type="application/ld+json">
+{"@context": "https://schema.org", "@type": "Product", "name": "Safari-Geländewagen",
+"sku": "60267", "offers": {"@type": "Offer", "price": "19.99",
+"priceCurrency": "EUR", "availability": "http://schema.org/BackOrder"}}
+</script>"""
 
 
 class AvailabilityCodeTest(unittest.TestCase):
@@ -22,6 +99,28 @@ class AvailabilityCodeTest(unittest.TestCase):
         self.assertEqual(availability_str_to_int("Vorübergehend nicht auf Lager"), 2)
         self.assertEqual(availability_str_to_int("Ausverkauft"), 3)
 
+    def test_unknown_str(self):
+        """Test that variants are normalized and unknown strings don't raise"""
+        self.assertEqual(availability_str_to_int(" jetzt\xa0 verfügbar "), 1)
+        self.assertEqual(
+            availability_str_to_int(
+                "Nachbestellungen möglich. Versand zum 12. Oktober 2021"
+            ),
+            4,
+        )
+        self.assertEqual(availability_str_to_int("Bald erhältlich"), -1)
+
+    def test_process_price(self):
+        """Test parsing prices into exact cents"""
+        self.assertEqual(process_price("19,99\xa0€"), 1999)
+        self.assertEqual(process_price("19.99"), 1999)
+        self.assertEqual(process_price("1.299,99\xa0€"), 129999)
+        self.assertEqual(process_price("59"), 5900)
+        self.assertEqual(process_price("4,5 €"), 450)
+        self.assertIsNone(process_price("Preis folgt"))
+        self.assertEqual(str_to_int(" 60267 "), 60267)
+        self.assertIsNone(str_to_int("unknown"))
+
     def test_int_to_str(self):
         """Test conversion from availability integer representation to strings"""
         self.assertEqual(availability_int_to_str(1), "Jetzt verfügbar")
@@ -29,7 +128,7 @@ class AvailabilityCodeTest(unittest.TestCase):
         self.assertEqual(availability_int_to_str(3), "Ausverkauft")
 
 
-class DataBaseTest(unittest.TestCase):
+class DataBaseTest(unittest.TestCase):  # pylint: disable=R0904
     """Test the database functions"""
 
     def setUp(self) -> None:
@@ -63,6 +162,7 @@ class DataBaseTest(unittest.TestCase):
 
     def tearDown(self) -> None:
         """Remove the temporary SQLite database"""
+        database.dispose_engines()
         if os.path.exists(self.database_filename):
             os.remove(self.database_filename)
 
@@ -82,6 +182,353 @@ class DataBaseTest(unittest.TestCase):
         ids = database.load_product_urls(self.engine)
         self.assertEqual(ids, ["url1", "url2"])
 
+    def test_load_product_prices(self):
+        """Test loading the mapping of product ids to prices"""
+        self.assertEqual(database.load_product_prices(self.engine), {1: 1000, 2: 2000})
+
+    def test_product_index(self):
+        """Test that the product index is loaded once and shared per spider"""
+        spider = SimpleNamespace()
+        index = ProductIndex.for_spider(spider, self.engine)
+        self.assertIn(1, index)
+        self.assertNotIn(999, index)
+        self.assertEqual(index.get_price(2), 2000)
+
+        index.set_price(999, 500)
+        self.assertIs(ProductIndex.for_spider(spider, self.engine), index)
+        self.assertIn(999, ProductIndex.for_spider(spider, self.engine))
+
+    def test_iter_product_urls(self):
+        """Test streaming the product urls with and without filters"""
+        urls = database.iter_product_urls(self.engine, chunk_size=1)
+        self.assertEqual(list(urls), ["url1", "url2"])
+
+        urls = database.iter_product_urls(self.engine, availabilities=[1])
+        self.assertEqual(list(urls), ["url1"])
+        urls = database.iter_product_urls(self.engine, availabilities=[2, 3])
+        self.assertEqual(list(urls), [])
+
+        database.add_availabilities(
+            [
+                {
+                    "product_id": 1,
+                    "availability": 1,
+                    "timestamp": datetime.datetime.utcnow(),
+                }
+            ],
+            self.engine,
+        )
+        urls = database.iter_product_urls(
+            self.engine, max_age=datetime.timedelta(hours=1)
+        )
+        self.assertEqual(list(urls), ["url2"])
+
+    def test_iter_product_schedule(self):
+        """Test loading the scheduling information of the products"""
+        entries = list(
+            database.iter_product_schedule(
+                self.engine, since=datetime.datetime(2020, 1, 1)
+            )
+        )
+        self.assertEqual([e["product_id"] for e in entries], [1, 2])
+        self.assertEqual(entries[0]["availability"], 1)
+        self.assertEqual(entries[0]["transitions"], 0)
+        self.assertIsNone(entries[1]["last_seen"])
+        self.assertEqual(entries[1]["transitions"], 0)
+
+    def test_iter_product_schedule_transitions(self):
+        """Test that only changes of the availability after since are counted"""
+        start = datetime.datetime(2020, 1, 1)
+        codes = [3] * 120 + [2, 2, 1, 1, 3]
+        database.add_availabilities(
+            [
+                {
+                    "product_id": 2,
+                    "availability": code,
+                    "timestamp": start + datetime.timedelta(hours=hour),
+                }
+                for hour, code in enumerate(codes)
+            ]
+            + [
+                {
+                    "product_id": 1,
+                    "availability": 1,
+                    "timestamp": start + datetime.timedelta(hours=121.5),
+                }
+            ],
+            self.engine,
+        )
+
+        def transitions(since):
+            entries = database.iter_product_schedule(self.engine, since=since)
+            return [e["transitions"] for e in entries if e["product_id"] == 2][0]
+
+        self.assertEqual(transitions(start), 3)
+        self.assertEqual(transitions(start + datetime.timedelta(hours=120)), 3)
+        self.assertEqual(transitions(start + datetime.timedelta(hours=121)), 2)
+        self.assertEqual(transitions(start + datetime.timedelta(hours=122)), 2)
+        self.assertEqual(transitions(start + datetime.timedelta(hours=125)), 0)
+
+    def test_db_connect(self):
+        """Test that engines are shared and open connections with the PRAGMAs"""
+        settings = Settings(
+            {
+                "CONNECTION_STRING": "sqlite:///" + self.database_filename,
+                "SQLITE_PRAGMAS": {"cache_size": -1000},
+            }
+        )
+        engine = database.db_connect(settings)
+        self.assertIs(database.db_connect(settings), engine)
+        with engine.connect() as connection:
+            pragma = connection.exec_driver_sql
+            self.assertEqual(pragma("PRAGMA journal_mode").scalar(), "wal")
+            self.assertEqual(pragma("PRAGMA synchronous").scalar(), 1)
+            self.assertEqual(pragma("PRAGMA cache_size").scalar(), -1000)
+
+    def test_sharded_results(self):
+        """Test splitting the products into shards and merging the worker results"""
+        shards = [
+            list(database.iter_product_urls(self.engine, shard=(shard, 2)))
+            for shard in range(2)
+        ]
+        self.assertEqual(shards, [["url2"], ["url1"]])
+
+        path = "test_shard.jsonl"
+        with open(path, "w", encoding="utf-8") as file:
+            file.write('{"kind": "price", "entries": [[1, 100, null]]}\n')
+        timestamp = datetime.datetime(2022, 1, 1, 12)
+        spider = SimpleNamespace()
+        results = ShardResults.for_spider(spider, path)
+        self.assertIs(ShardResults.for_spider(spider, path), results)
+        results.append(
+            "availability",
+            [{"product_id": 2, "availability": 2, "timestamp": timestamp}],
+        )
+        results.close()
+        results.append("price", [(2, 2500, timestamp)])
+        results.close()
+        self.assertTrue(results.file.closed)
+        batches = list(read_shard_results(path))
+        self.assertEqual([kind for kind, _ in batches], ["availability", "price"])
+        self.assertEqual(batches[0][1][0]["timestamp"], timestamp)
+
+        migrations.stamp(self.engine)
+        settings = Settings(
+            {"CONNECTION_STRING": "sqlite:///" + self.database_filename}
+        )
+        self.assertEqual(merge_results([path], settings), 2)
+        os.remove(path + ".merged")
+        self.assertEqual(
+            database.get_product_status(2, self.engine).last_seen, timestamp
+        )
+        self.assertEqual(database.get_product(2, self.engine).price, 2500)
+        self.assertEqual(
+            database.get_price_history(2, self.engine)[0]["changed_at"], timestamp
+        )
+
+    def test_run_workers(self):
+        """Test that stale results are truncated and failed workers are merged"""
+        directory = "test_shards"
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, "shard-0.jsonl")
+        with open(path, "w", encoding="utf-8") as file:
+            file.write('{"kind": "price", "entries": [[1, 100, null]]}\n')
+        command = [sys.executable, "-c", "raise SystemExit(1)"]
+        try:
+            with mock.patch.object(
+                crawl_shards, "worker_command", return_value=command
+            ):
+                self.assertEqual(crawl_shards.run_workers(1, directory), [path])
+            self.assertEqual(list(read_shard_results(path)), [])
+        finally:
+            os.remove(path)
+            os.rmdir(directory)
+
+    def test_availability_pipeline(self):
+        """Test buffering items and returning them after the batch is written"""
+        migrations.stamp(self.engine)
+        settings = Settings(
+            {
+                "CONNECTION_STRING": "sqlite:///" + self.database_filename,
+                "DB_BATCH_SIZE": 2,
+                "DB_WRITER_ENABLED": False,
+            }
+        )
+        pipeline = AvailabilityPipeline(settings)
+        spider = SimpleNamespace()
+        pipeline.open_spider(spider)
+        item = LegoItem(product_id=2, url="url2", availability=2)
+        self.assertIs(pipeline.process_item(item, spider), item)
+        self.assertIsNone(database.get_product_status(2, self.engine))
+
+        item = LegoItem(
+            product_id=2,
+            url="url2",
+            availability=2,
+            fingerprint=PageFingerprintItem(url="url2", content_hash="hash2"),
+        )
+        results = []
+        pipeline.process_item(item, spider).addCallback(results.append)
+        self.assertEqual(results, [item])
+        self.assertEqual(database.get_product_status(2, self.engine).availability, 2)
+        fingerprint = database.get_page_fingerprint("url2", self.engine)
+        self.assertEqual(fingerprint.content_hash, "hash2")
+        self.assertIsNotNone(fingerprint.checked_at)
+        pipeline.close_spider(spider)
+
+    def test_pipeline_timing(self):
+        """Test timing the items of the pipelines, including dropped items"""
+        migrations.stamp(self.engine)
+        settings = Settings(
+            {
+                "CONNECTION_STRING": "sqlite:///" + self.database_filename,
+                "DB_BATCH_SIZE": 1,
+                "DB_WRITER_ENABLED": False,
+            }
+        )
+        pipeline = AvailabilityPipeline(settings)
+        spider = SimpleNamespace()
+        pipeline.open_spider(spider)
+        results = []
+        pipeline.process_item(
+            LegoItem(product_id=2, url="url2", availability=2), spider
+        ).addCallback(results.append)
+        self.assertEqual(len(results), 1)
+        with self.assertRaises(UnknownProduct):
+            pipeline.process_item(
+                LegoItem(product_id=999, url="url999", availability=2), spider
+            )
+        pipeline.close_spider(spider)
+
+        summary = spider.metrics.summary()
+        self.assertEqual(summary["pipeline"]["AvailabilityPipeline"]["count"], 2)
+        self.assertEqual(summary["database"]["add_availabilities"]["count"], 1)
+
+    def test_periodic_flush_error(self):
+        """Test logging a failed write without the writer and flushing again"""
+        migrations.stamp(self.engine)
+        settings = Settings(
+            {
+                "CONNECTION_STRING": "sqlite:///" + self.database_filename,
+                "DB_BATCH_SIZE": 10,
+                "DB_WRITER_ENABLED": False,
+            }
+        )
+        pipeline = AvailabilityPipeline(settings)
+        spider = SimpleNamespace()
+        pipeline.open_spider(spider)
+        flush_loop = task.LoopingCall(pipeline.periodic_flush)
+        flush_loop.clock = task.Clock()
+        flush_loop.start(1, now=False)
+        pipeline.process_item(
+            LegoItem(product_id=2, url="url2", availability=2), spider
+        )
+        with mock.patch(
+            "lego.pipelines.add_availabilities", side_effect=RuntimeError("locked")
+        ), self.assertLogs("lego.pipelines", "ERROR"):
+            flush_loop.clock.advance(1)
+        self.assertTrue(flush_loop.running)
+        self.assertIsNone(database.get_product_status(2, self.engine))
+
+        pipeline.process_item(
+            LegoItem(product_id=2, url="url2", availability=3), spider
+        )
+        flush_loop.clock.advance(1)
+        self.assertEqual(database.get_product_status(2, self.engine).availability, 3)
+        flush_loop.stop()
+        pipeline.close_spider(spider)
+
+    def test_update_price_pipeline_error(self):
+        """Test writing a price again after its batch failed"""
+        migrations.stamp(self.engine)
+        settings = Settings(
+            {
+                "CONNECTION_STRING": "sqlite:///" + self.database_filename,
+                "DB_BATCH_SIZE": 1,
+                "DB_WRITER_ENABLED": False,
+            }
+        )
+        pipeline = UpdatePricePipeline(settings)
+        spider = SimpleNamespace()
+        pipeline.open_spider(spider)
+        item = LegoItem(product_id=1, name="Product 1", url="url1", price=900)
+        with mock.patch(
+            "lego.pipelines.update_product_prices", side_effect=RuntimeError("locked")
+        ), self.assertRaises(RuntimeError):
+            pipeline.process_item(item, spider)
+        self.assertEqual(pipeline.products.get_price(1), 1000)
+
+        pipeline.process_item(item, spider)
+        self.assertEqual(pipeline.products.get_price(1), 900)
+        self.assertEqual(database.get_product(1, self.engine).price, 900)
+        self.assertEqual(len(database.get_price_history(1, self.engine)), 1)
+        pipeline.close_spider(spider)
+
+    def test_transition_pipeline(self):
+        """Test queueing a transition when the item arrives and only once"""
+        migrations.stamp(self.engine)
+        settings = Settings(
+            {
+                "CONNECTION_STRING": "sqlite:///" + self.database_filename,
+                "DB_BATCH_SIZE": 10,
+                "DB_WRITER_ENABLED": False,
+                "TRANSITION_SINKS": ["lego.transitions.OutboxSink"],
+            }
+        )
+        spider = SimpleNamespace()
+        transitions = TransitionPipeline(settings)
+        availabilities = AvailabilityPipeline(settings)
+        transitions.open_spider(spider)
+        availabilities.open_spider(spider)
+        for product_id, availability in [(1, 1), (2, 1), (1, 2)]:
+            item = LegoItem(
+                product_id=product_id,
+                name=f"Product {product_id}",
+                url=f"url{product_id}",
+                price=1000,
+                availability=availability,
+            )
+            transitions.process_item(item, spider)
+            availabilities.process_item(item, spider)
+        self.assertEqual(database.count_notifications(self.engine), {"pending": 1})
+        self.assertEqual(database.get_product_status(1, self.engine).availability, 1)
+
+        availabilities.close_spider(spider)
+        transitions.close_spider(spider)
+        self.assertEqual(database.count_notifications(self.engine), {"pending": 1})
+        self.assertEqual(database.get_product_status(1, self.engine).availability, 2)
+
+    def test_quarantine_pipeline(self):
+        """Test quarantining unknown availability strings"""
+        migrations.stamp(self.engine)
+        settings = Settings(
+            {
+                "CONNECTION_STRING": "sqlite:///" + self.database_filename,
+                "DB_WRITER_ENABLED": False,
+            }
+        )
+        spider = SimpleNamespace()
+        quarantine = QuarantinePipeline(settings)
+        availabilities = AvailabilityPipeline(settings)
+        quarantine.open_spider(spider)
+        availabilities.open_spider(spider)
+        for _ in range(2):
+            item = load_product_item(
+                {"product_id": "1", "availability": "Bald erhältlich"},
+                HtmlResponse("https://www.lego.com/de-de/product/1", body=b""),
+            )
+            self.assertEqual(item["availability"], -1)
+            quarantine.process_item(item, spider)
+            availabilities.process_item(item, spider)
+        quarantine.close_spider(spider)
+        availabilities.close_spider(spider)
+
+        statuses = database.load_quarantined_statuses(self.engine)
+        self.assertEqual(
+            [(s.text, s.count) for s in statuses], [("Bald erhältlich", 2)]
+        )
+        self.assertEqual(database.get_product_status(1, self.engine).availability, 1)
+
     def test_get_product(self):
         """Test selecting a product name for a given product id"""
         self.assertEqual(database.get_product_name(1, self.engine), "Product 1")
@@ -119,6 +566,241 @@ class DataBaseTest(unittest.TestCase):
         self.assertEqual(product_get_updated.product_id, product_id)
         self.assertEqual(product_get_updated.price, 2000)
 
+    def test_update_product_prices(self):
+        """Test updating the prices of several products in one transaction"""
+        database.update_product_prices({1: 1500, 2: 2500}, self.engine)
+        self.assertEqual(database.get_product(1, self.engine).price, 1500)
+        self.assertEqual(database.get_product(2, self.engine).price, 2500)
+
+    def test_price_history(self):
+        """Test recording only price changes and queueing price drops"""
+        for prices in ({1: 1000, 2: 1800}, {1: 1000, 2: 1800}, {1: 900, 2: 1900}):
+            database.update_product_prices(prices, self.engine, min_drop=0.05)
+        self.assertEqual(database.get_price_history(1, self.engine)[0]["price"], 900)
+        self.assertEqual(
+            [
+                entry["previous_price"]
+                for entry in database.get_price_history(2, self.engine)
+            ],
+            [2000, 1800],
+        )
+        notifications = database.claim_notifications(self.engine)
+        self.assertEqual(
+            [
+                (n["kind"], n["product_id"], n["old_value"], n["new_value"])
+                for n in notifications
+            ],
+            [("price", 2, 2000, 1800), ("price", 1, 1000, 900)],
+        )
+
+    def test_add_availabilities(self):
+        """Test adding several availability entries in one transaction"""
+        availability_count_initial = len(database.get_availabilities(1, self.engine))
+        database.add_availabilities(
+            [
+                {
+                    "product_id": 1,
+                    "availability": 2,
+                    "timestamp": datetime.datetime(2022, 1, 1),
+                },
+                {
+                    "product_id": 2,
+                    "availability": 3,
+                    "timestamp": datetime.datetime(2022, 1, 1),
+                },
+            ],
+            self.engine,
+        )
+        self.assertEqual(
+            availability_count_initial + 1,
+            len(database.get_availabilities(1, self.engine)),
+        )
+        self.assertEqual(
+            database.get_availabilities(2, self.engine)[-1]["availability"], 3
+        )
+
+    def test_notification_outbox(self):
+        """Test queueing availability changes once and sending them once"""
+
+        class FakeBot:  # pylint: disable=R0903
+            """Records the messages, fails while down"""
+
+            def __init__(self):
+                self.down = True
+                self.sent = []
+
+            def send_message(self, text, chat_id, parse_mode):
+                """Raise a network error or record the message"""
+                if self.down:
+                    raise BadRequest("Service unavailable")
+                self.sent.append((chat_id, text, parse_mode))
+
+        now = datetime.datetime.now()
+        entries = [
+            {"product_id": 1, "availability": 2, "timestamp": now},
+            {"product_id": 2, "availability": 2, "timestamp": now},
+            {
+                "product_id": 1,
+                "availability": 1,
+                "timestamp": now + datetime.timedelta(hours=1),
+            },
+        ]
+        database.add_availabilities(entries, self.engine)
+        database.add_availabilities(entries, self.engine)
+        self.assertEqual(database.count_notifications(self.engine), {"pending": 2})
+
+        bot = FakeBot()
+        restock_bot = LegoRestockBot("123456:TEST", "channel")
+        with NotificationDispatcher(bot) as dispatcher:
+            sender = OutboxSender(self.engine, restock_bot, dispatcher)
+            self.assertEqual(sender.drain(), {"sent": 0, "failed": 1, "skipped": 1})
+            bot.down = False
+            self.assertEqual(sender.drain(), {"sent": 1, "failed": 0, "skipped": 0})
+            self.assertEqual(sender.drain(), {"sent": 0, "failed": 0, "skipped": 0})
+        self.assertEqual(len(bot.sent), 1)
+        self.assertIn("Product 1", bot.sent[0][1])
+        self.assertEqual(
+            database.count_notifications(self.engine), {"sent": 1, "skipped": 1}
+        )
+
+    def test_product_status(self):
+        """Test that the ProductStatus table follows the availability entries"""
+        status = database.get_product_status(1, self.engine)
+        self.assertEqual(status.availability, 1)
+        self.assertIsNone(status.previous_availability)
+        self.assertIsNone(database.get_product_status(2, self.engine))
+
+        timestamp = datetime.datetime.now() + datetime.timedelta(hours=1)
+        database.add_availabilities(
+            [{"product_id": 1, "availability": 3, "timestamp": timestamp}],
+            self.engine,
+        )
+        database.add_availabilities(
+            [
+                {
+                    "product_id": 1,
+                    "availability": 3,
+                    "timestamp": timestamp + datetime.timedelta(hours=1),
+                },
+                {
+                    "product_id": 1,
+                    "availability": 2,
+                    "timestamp": datetime.datetime(2020, 1, 1),
+                },
+            ],
+            self.engine,
+        )
+        status = database.get_product_status(1, self.engine)
+        self.assertEqual(status.availability, 3)
+        self.assertEqual(status.previous_availability, 1)
+        self.assertEqual(status.last_changed, timestamp)
+        self.assertEqual(status.last_seen, timestamp + datetime.timedelta(hours=1))
+
+    def test_run_length_encoding(self):
+        """Test that unchanged availabilities only extend the current entry"""
+        start = datetime.datetime.now() + datetime.timedelta(hours=1)
+        timestamps = [start + datetime.timedelta(hours=i) for i in range(5)]
+        for timestamp, availability in zip(timestamps, [1, 1, 2, 2, 2]):
+            database.add_availabilities(
+                [
+                    {
+                        "product_id": 1,
+                        "availability": availability,
+                        "timestamp": timestamp,
+                    }
+                ],
+                self.engine,
+                run_length_encoding=True,
+            )
+        database.add_availabilities(
+            [
+                {"product_id": 2, "availability": 3, "timestamp": timestamps[0]},
+                {"product_id": 2, "availability": 3, "timestamp": timestamps[1]},
+            ],
+            self.engine,
+            run_length_encoding=True,
+        )
+
+        availabilities = database.get_availabilities(1, self.engine)
+        self.assertEqual([a["availability"] for a in availabilities], [1, 2])
+        self.assertEqual(availabilities[0]["last_seen"], timestamps[1])
+        self.assertEqual(availabilities[1]["timestamp"], timestamps[2])
+        self.assertEqual(availabilities[1]["last_seen"], timestamps[4])
+
+        availabilities = database.get_availabilities(2, self.engine)
+        self.assertEqual(len(availabilities), 1)
+        self.assertEqual(availabilities[0]["last_seen"], timestamps[1])
+
+        status = database.get_product_status(1, self.engine)
+        self.assertEqual(status.last_changed, timestamps[2])
+        self.assertEqual(status.last_seen, timestamps[4])
+
+    def test_heartbeat_availabilities(self):
+        """Test that entries without availability confirm the current availability"""
+        timestamp = datetime.datetime.now() + datetime.timedelta(hours=1)
+        database.add_availabilities(
+            [
+                {"product_id": 1, "availability": None, "timestamp": timestamp},
+                {"product_id": 2, "availability": None, "timestamp": timestamp},
+            ],
+            self.engine,
+            run_length_encoding=True,
+        )
+        availabilities = database.get_availabilities(1, self.engine)
+        self.assertEqual(len(availabilities), 1)
+        self.assertEqual(availabilities[0]["availability"], 1)
+        self.assertEqual(availabilities[0]["last_seen"], timestamp)
+        self.assertEqual(database.get_availabilities(2, self.engine), [])
+
+    def test_save_page_fingerprints(self):
+        """Test inserting and replacing page fingerprints"""
+        fingerprint = {
+            "url": "url1",
+            "etag": '"abc"',
+            "last_modified": None,
+            "content_hash": "hash1",
+            "checked_at": datetime.datetime(2022, 1, 1),
+        }
+        database.save_page_fingerprints([fingerprint], self.engine)
+        database.save_page_fingerprints(
+            [{**fingerprint, "etag": None, "content_hash": "hash2"}], self.engine
+        )
+        saved = database.get_page_fingerprint("url1", self.engine)
+        self.assertIsNone(saved.etag)
+        self.assertEqual(saved.content_hash, "hash2")
+
+        entries = database.iter_product_schedule(
+            self.engine, since=datetime.datetime(2020, 1, 1)
+        )
+        self.assertEqual([e["content_hash"] for e in entries], ["hash2", None])
+
+    def test_add_availabilities_fingerprints(self):
+        """Test that page fingerprints are only saved with their availability entry"""
+        entry = {
+            "product_id": 2,
+            "availability": 3,
+            "timestamp": datetime.datetime(2022, 1, 1),
+            "fingerprint": {
+                "url": "url2",
+                "etag": None,
+                "last_modified": None,
+                "content_hash": "hash2",
+                "checked_at": datetime.datetime(2022, 1, 1),
+            },
+        }
+        with mock.patch.object(
+            database, "add_notifications", side_effect=RuntimeError
+        ), self.assertRaises(RuntimeError):
+            database.add_availabilities([entry], self.engine)
+        self.assertIsNone(database.get_page_fingerprint("url2", self.engine))
+        self.assertEqual(database.get_availabilities(2, self.engine), [])
+
+        database.add_availabilities([entry], self.engine)
+        self.assertEqual(
+            database.get_page_fingerprint("url2", self.engine).content_hash, "hash2"
+        )
+        self.assertEqual(len(database.get_availabilities(2, self.engine)), 1)
+
     def test_delete_old_availibility_entries(self):
         """Test removing old availability entries from the Availability table"""
         availability_count_initial = len(database.get_availabilities(1, self.engine))
@@ -148,6 +830,796 @@ class DataBaseTest(unittest.TestCase):
             len(database.get_availabilities(1, self.engine)),
         )
 
+    def test_downsample_availability_entries(self):
+        """Test merging runs of the same availability in chunks"""
+        days = [datetime.datetime(2020, 1, day) for day in range(1, 6)]
+        database.add_availabilities(
+            [
+                {"product_id": 2, "availability": availability, "timestamp": day}
+                for availability, day in zip([1, 1, 2, 2, 1], days)
+            ],
+            self.engine,
+        )
+        merged = database.downsample_availability_entries(
+            datetime.datetime(2021, 1, 1), self.engine, chunk_size=2
+        )
+        self.assertEqual(merged, 2)
+        availabilities = database.get_availabilities(2, self.engine)
+        self.assertEqual([a["availability"] for a in availabilities], [1, 2, 1])
+        self.assertEqual(
+            [a["last_seen"] for a in availabilities], [days[1], days[3], days[4]]
+        )
+
+        deleted = database.delete_old_availability_entries(
+            datetime.datetime(2021, 1, 1), self.engine, chunk_size=1
+        )
+        self.assertEqual(deleted, 2)
+        availabilities = database.get_availabilities(2, self.engine)
+        self.assertEqual([a["timestamp"] for a in availabilities], [days[4]])
+
+    def test_retention_job(self):
+        """Test that the retention job frees the pages of deleted entries"""
+        settings = Settings(
+            {
+                "CONNECTION_STRING": "sqlite:///test_retention.db",
+                "AVAILABILITY_RETENTION_DAYS": 30,
+                "RETENTION_CHUNK_PAUSE": 0,
+                "RETENTION_VACUUM_PAGES": 10,
+            }
+        )
+        engine = database.db_connect(settings)
+        try:
+            database.Base.metadata.create_all(engine)
+            start = datetime.datetime(2020, 1, 1)
+            database.add_availabilities(
+                [
+                    {
+                        "product_id": 1,
+                        "availability": i % 2,
+                        "timestamp": start + datetime.timedelta(minutes=i),
+                    }
+                    for i in range(5000)
+                ],
+                engine,
+            )
+            job = RetentionJob.from_settings(settings, engine)
+            counts = job.run(start + datetime.timedelta(days=60))
+            self.assertEqual(counts["merged"], 0)
+            self.assertEqual(counts["deleted"], 4999)
+            self.assertGreater(counts["freed_pages"], 10)
+            with engine.connect() as connection:
+                pragma = connection.exec_driver_sql
+                self.assertEqual(pragma("PRAGMA auto_vacuum").scalar(), 2)
+                self.assertEqual(pragma("PRAGMA freelist_count").scalar(), 0)
+        finally:
+            database.dispose_engines()
+            for suffix in ("", "-wal", "-shm"):
+                if os.path.exists("test_retention.db" + suffix):
+                    os.remove("test_retention.db" + suffix)
+
+    def test_export_history(self):
+        """Test exporting the history and the analytics of the export"""
+        days = [datetime.datetime(2022, 1, day) for day in (3, 5, 6, 7)]
+        database.add_availabilities(
+            [
+                {"product_id": 2, "availability": availability, "timestamp": day}
+                for availability, day in zip([2, 1, 3, 1], days)
+            ],
+            self.engine,
+        )
+        # A later entry of product 1 with a higher id than the entries of product 2
+        later = datetime.datetime.now() + datetime.timedelta(hours=1)
+        database.add_availabilities(
+            [{"product_id": 1, "availability": 2, "timestamp": later}], self.engine
+        )
+        path = "test_history"
+        try:
+            self.assertEqual(export_history(path, self.engine, chunk_size=2), 6)
+            history = analytics.load_history(path)
+            self.assertEqual(
+                sorted(os.listdir(path)),
+                sorted(name + ".npy" for name in history),
+            )
+        finally:
+            shutil.rmtree(path)
+        self.assertEqual(list(history["product_id"]), [1, 1, 2, 2, 2, 2])
+        self.assertEqual(list(history["availability"]), [1, 2, 2, 1, 3, 1])
+        self.assertEqual(history["timestamp"][4], np.datetime64("2022-01-06"))
+        self.assertEqual(list(history["product_names"]), ["Product 1", "Product 2"])
+
+        restocks = analytics.time_to_restock(history)
+        self.assertEqual(list(restocks["product_id"]), [2])
+        self.assertEqual(list(restocks["count"]), [2])
+        self.assertEqual(list(restocks["median"]), [36 * 3600])
+        self.assertEqual(list(restocks["max"]), [48 * 3600])
+        counts = analytics.restocks_by_weekday_hour(history)
+        # 2022-01-05 was a Wednesday, 2022-01-07 a Friday
+        self.assertEqual(counts[2, 0], 1)
+        self.assertEqual(counts[4, 0], 1)
+        self.assertEqual(counts.sum(), 2)
+        ratios = analytics.availability_ratios(history, end=np.datetime64("2022-01-08"))
+        self.assertEqual(ratios, {1: 0.25, 2: 0.5, 3: 0.25})
+
+    def test_crawl_run(self):
+        """Test recording the summary of a crawl in the crawl_runs table"""
+        migrations.stamp(self.engine)
+        crawler = get_crawler(
+            AvailabilitySpider,
+            {"CONNECTION_STRING": "sqlite:///" + self.database_filename},
+        )
+        extension = CrawlMetrics.from_crawler(crawler)
+        spider = AvailabilitySpider()
+        extension.metrics = Metrics.for_spider(spider)
+        extension.metrics.observe("callback", "parse", 0.002)
+        crawler.stats.set_value("item_scraped_count", 3)
+        crawler.stats.set_value("item_dropped_count", 1)
+        crawler.stats.set_value("item_dropped_reasons_count/UnknownProduct", 1)
+        extension.spider_closed(spider, "finished")
+
+        run = database.get_crawl_runs(self.engine)[0]
+        self.assertEqual(run.spider, "availability")
+        self.assertEqual(run.finish_reason, "finished")
+        self.assertEqual((run.items_scraped, run.items_dropped), (3, 1))
+        self.assertEqual(run.stats["item_dropped_reasons_count/UnknownProduct"], 1)
+        self.assertEqual(run.metrics["callback"]["parse"]["count"], 1)
+
+
+class AvailabilitySpiderTest(unittest.TestCase):
+    """Test parsing product pages with the AvailabilitySpider"""
+
+    def setUp(self) -> None:
+        self.spider = AvailabilitySpider()
+        self.product = {
+            "product_id": 60267,
+            "url": PRODUCT_URL,
+            "availability": 1,
+            "etag": None,
+            "last_modified": None,
+            "content_hash": None,
+        }
+
+    def response(self, status=200, body=PRODUCT_PAGE):
+        """Create a response for the product page"""
+        request = Request(PRODUCT_URL, meta={"product": self.product})
+        return HtmlResponse(
+            PRODUCT_URL, status=status, body=body, encoding="utf-8", request=request
+        )
+
+    def test_parse_product_page(self):
+        """Test extracting the product information and the page fingerprint"""
+        (item,) = list(self.spider.parse(self.response()))
+        fingerprint = item["fingerprint"]
+        self.assertIsInstance(fingerprint, PageFingerprintItem)
+        self.assertIsInstance(item, LegoItem)
+        self.assertEqual(item["name"], "Safari-Geländewagen")
+        self.assertEqual(item["price"], 5900)
+        self.assertEqual(item["product_id"], 60267)
+        self.assertEqual(item["availability"], 1)
+        self.assertEqual(item["url"], PRODUCT_URL)
+
+        self.product["content_hash"] = fingerprint["content_hash"]
+        (heartbeat,) = list(self.spider.parse(self.response()))
+        self.assertIsInstance(heartbeat, HeartbeatItem)
+        self.assertEqual(heartbeat["product_id"], 60267)
+        self.assertEqual(heartbeat["fingerprint"], fingerprint)
+
+    def test_parse_unknown_availability(self):
+        """Test that no fingerprint is saved for a page with an unknown availability"""
+        body = PRODUCT_PAGE.replace("Jetzt verfügbar", "Bald erhältlich")
+        for _ in range(2):
+            items = list(self.spider.parse(self.response(body=body)))
+            self.assertEqual(len(items), 1)
+            self.assertEqual(items[0]["availability"], UNKNOWN_AVAILABILITY)
+            self.assertIsNone(items[0]["fingerprint"])
+            self.product["content_hash"] = hash_product_fields(
+                self.spider.extract_product_fields(self.response(body=body))
+            )
+
+    def test_parse_retired_product(self):
+        """Test that the page of a retired product results in no item"""
+        body = PRODUCT_PAGE.replace("Jetzt verfügbar", RETIRED_STATUS)
+        self.assertEqual(list(self.spider.parse(self.response(body=body))), [])
+
+        body = PRODUCT_PAGE.replace(
+            '<p class="ejRirH"><span class="hlipzx">Jetzt verfügbar</span></p>',
+            PRODUCT_JSON_LD.replace("BackOrder", "Discontinued"),
+        )
+        self.assertEqual(list(self.spider.parse(self.response(body=body))), [])
+
+    def test_parse_not_modified(self):
+        """Test that a 304 response results in a heartbeat only"""
+        items = list(self.spider.parse(self.response(status=304, body="")))
+        self.assertEqual(len(items), 1)
+        self.assertIsInstance(items[0], HeartbeatItem)
+
+
+class ExtractorTest(unittest.TestCase):
+    """Test extracting the raw product information from product pages"""
+
+    @staticmethod
+    def response(body):
+        """Create a response for a product page"""
+        return HtmlResponse(PRODUCT_URL, body=body, encoding="utf-8")
+
+    def test_css_extractor(self):
+        """Test extracting with the CSS selectors"""
+        fields = CssExtractor().extract(self.response(PRODUCT_PAGE))
+        self.assertEqual(fields["name"], "Safari-Geländewagen")
+        self.assertEqual(fields["price"], "59,00\xa0€")
+        self.assertEqual(fields["product_id"], "60267")
+        self.assertEqual(fields["availability"], "Jetzt verfügbar")
+
+    def test_json_ld_extractor(self):
+        """Test extracting from the embedded JSON-LD data"""
+        page = PRODUCT_PAGE.replace("<body>", "<body>" + PRODUCT_JSON_LD)
+        fields = JsonLdExtractor().extract(self.response(page))
+        self.assertEqual(fields["name"], "Safari-Geländewagen")
+        self.assertEqual(fields["price"], "19.99")
+        self.assertEqual(fields["product_id"], "60267")
+        self.assertEqual(fields["availability"], "Nachbestellungen möglich")
+
+        fields = JsonLdExtractor().extract(self.response(PRODUCT_PAGE))
+        self.assertEqual(set(fields.values()), {None})
+
+        page = PRODUCT_PAGE.replace(
+            "<body>",
+            "<body>" + PRODUCT_JSON_LD.replace("BackOrder", "Discontinued"),
+        )
+        fields = JsonLdExtractor().extract(self.response(page))
+        self.assertEqual(fields["availability"], RETIRED_STATUS)
+
+    def test_extract_product(self):
+        """Test the fallback to the next extractor for missing fields"""
+        extractors = load_extractors()
+        fields = extract_product(self.response(PRODUCT_PAGE), extractors)
+        self.assertEqual(fields["price"], "59,00\xa0€")
+
+        page = PRODUCT_PAGE.replace(
+            "<body>",
+            "<body>" + PRODUCT_JSON_LD.replace("http://schema.org/BackOrder", ""),
+        )
+        fields = extract_product(self.response(page), extractors)
+        self.assertEqual(fields["price"], "19.99")
+        self.assertEqual(fields["availability"], "Jetzt verfügbar")
+
+    def test_extract_availability(self):
+        """Test that the status text wins over the JSON-LD availability"""
+        extractors = load_extractors()
+        page = PRODUCT_PAGE.replace("<body>", "<body>" + PRODUCT_JSON_LD)
+        fields = extract_product(self.response(page), extractors)
+        self.assertEqual(fields["price"], "19.99")
+        self.assertEqual(fields["availability"], "Jetzt verfügbar")
+
+        page = page.replace("Jetzt verfügbar", "Bald erhältlich")
+        fields = extract_product(self.response(page), extractors)
+        self.assertEqual(fields["availability"], "Bald erhältlich")
+
+        page = page.replace(
+            '<p class="ejRirH"><span class="hlipzx">Bald erhältlich</span></p>', ""
+        )
+        fields = extract_product(self.response(page), extractors)
+        self.assertEqual(fields["availability"], "Nachbestellungen möglich")
+
+    def test_synthetic_shop_page(self):
+        """Test that the extractors find the products of the benchmark shop"""
+        shop = SyntheticShop(products=20)
+        shop.server.server_close()
+        for product_id in shop.product_ids:
+            page = shop.render(f"/de-de/product/set-{product_id}", {})
+            json_ld = JsonLdExtractor().extract(self.response(page))
+            css = CssExtractor().extract(self.response(page))
+            self.assertEqual(json_ld["product_id"], str(product_id))
+            self.assertEqual(css["product_id"], str(product_id))
+            self.assertEqual(
+                availability_str_to_int(json_ld["availability"]),
+                availability_str_to_int(css["availability"]),
+            )
+        self.assertIsNone(shop.render("/de-de/product/set-1", {}))
+
+
+class MetricsTest(unittest.TestCase):
+    """Test the latency metrics of the crawls"""
+
+    def test_histogram(self):
+        """Test the summary and the Prometheus format of a histogram"""
+        metrics = Metrics()
+        for seconds in (0.002, 0.002, 0.004, 0.2):
+            metrics.observe("database", "add_product", seconds)
+        summary = metrics.summary()["database"]["add_product"]
+        self.assertEqual(summary["count"], 4)
+        self.assertAlmostEqual(summary["sum"], 0.208)
+        self.assertTrue(0.001 <= summary["p50"] <= 0.0025)
+        self.assertEqual(summary["max"], 0.2)
+
+        text = render_prometheus({"products": (metrics, {"item_scraped_count": 4})})
+        labels = 'source="products",stage="database",name="add_product"'
+        self.assertIn(f'lego_latency_seconds_bucket{{{labels},le="0.0025"}} 2', text)
+        self.assertIn(f'lego_latency_seconds_bucket{{{labels},le="+Inf"}} 4', text)
+        self.assertIn(f"lego_latency_seconds_count{{{labels}}} 4", text)
+        self.assertIn(
+            'lego_crawl_stat{source="products",name="item_scraped_count"} 4', text
+        )
+
+    def test_callback_timing(self):
+        """Test timing a callback"""
+        spider = SimpleNamespace()
+        request = Request(PRODUCT_URL, callback=lambda response: None)
+        response = HtmlResponse(PRODUCT_URL, body=b"", request=request)
+        output = CallbackTimingMiddleware().process_spider_output(
+            response, iter([1, 2]), spider
+        )
+        self.assertEqual(list(output), [1, 2])
+        summary = spider.metrics.summary()
+        self.assertEqual(summary["callback"]["<lambda>"]["count"], 1)
+
+
+class ThreadReactor:
+    """Collects the calls of other threads until the test runs them"""
+
+    def __init__(self) -> None:
+        self.calls = queue.Queue()
+
+    def callFromThread(self, func, *args, **kwargs):  # pylint: disable=C0103
+        """Queue a call for the test thread"""
+        self.calls.put((func, args, kwargs))
+
+    def run_calls(self, count: int):
+        """Wait for and run count calls in the test thread"""
+        for _ in range(count):
+            func, args, kwargs = self.calls.get(timeout=5)
+            func(*args, **kwargs)
+
+
+class DatabaseWriterTest(unittest.TestCase):
+    """Test the dedicated writer thread of the pipelines"""
+
+    def setUp(self) -> None:
+        self.reactor = ThreadReactor()
+        self.writer = DatabaseWriter(max_pending=2, reactor=self.reactor)
+        self.release = threading.Event()
+        self.calls = []
+        self.writer.open()
+
+    def tearDown(self) -> None:
+        self.release.set()
+        if not self.writer.pool.joined:
+            self.writer.pool.stop()
+
+    def write(self, value):
+        """A write recording its value and thread, blocking until released"""
+        self.calls.append((value, threading.get_ident()))
+        self.release.wait(5)
+
+    def test_write_order(self):
+        """Test that the writes run in order in one thread off the test thread"""
+        self.release.set()
+        results = []
+        for value in range(5):
+            self.writer.write(self.write, value).addCallback(results.append)
+        self.reactor.run_calls(5)
+        self.assertEqual([value for value, _ in self.calls], list(range(5)))
+        threads = {thread for _, thread in self.calls}
+        self.assertEqual(len(threads), 1)
+        self.assertNotIn(threading.get_ident(), threads)
+        self.assertEqual(len(results), 5)
+        self.assertFalse(self.writer.pending)
+
+    def test_backpressure(self):
+        """Test that writes beyond DB_WRITER_MAX_PENDING wait for a free slot"""
+        results = []
+        for value in range(4):
+            self.writer.write(self.write, value).addCallback(results.append)
+        self.assertEqual(len(self.writer.pending), 4)
+        self.assertEqual(self.writer.slots.tokens, 0)
+        self.assertEqual(len(self.writer.slots.waiting), 2)
+
+        self.release.set()
+        self.reactor.run_calls(1)
+        self.assertEqual(len(results), 1)
+        self.assertEqual(len(self.writer.slots.waiting), 1)
+        self.reactor.run_calls(3)
+        self.assertEqual(len(results), 4)
+        self.assertEqual(self.writer.slots.tokens, 2)
+
+    def test_close(self):
+        """Test that the last close waits for the pending writes to stop the thread"""
+        self.writer.open()
+        self.writer.write(self.write, 1)
+        closed = []
+        self.writer.close().addCallback(closed.append)  # pylint: disable=E1101
+        self.assertEqual(closed, [None])
+        self.writer.close().addCallback(closed.append)  # pylint: disable=E1101
+        self.assertEqual(len(closed), 1)
+        self.assertFalse(self.writer.pool.joined)
+
+        self.release.set()
+        self.reactor.run_calls(1)
+        self.assertEqual(len(closed), 2)
+        self.assertTrue(self.writer.pool.joined)
+        self.assertEqual(len(self.calls), 1)
+
+
+class ThreadClock(task.Clock):
+    """A Clock whose thread pool runs the calls when the test runs them"""
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.threads = []
+
+    def getThreadPool(self):  # pylint: disable=C0103
+        """Use the clock as thread pool"""
+        return self
+
+    def callInThreadWithCallback(self, on_result, func):  # pylint: disable=C0103
+        """Queue a call of the thread pool"""
+        self.threads.append((on_result, func))
+
+    def callFromThread(self, func, *args):  # pylint: disable=C0103,R0201
+        """Run a call of a thread right away"""
+        func(*args)
+
+    def run_threads(self):
+        """Run the queued calls and the calls they queue"""
+        while self.threads:
+            on_result, func = self.threads.pop(0)
+            on_result(True, func())
+
+
+class FakeSender:  # pylint: disable=R0903
+    """An OutboxSender counting the drains"""
+
+    def __init__(self) -> None:
+        self.drains = 0
+
+    def drain(self) -> dict:
+        """Count the drain"""
+        self.drains += 1
+        return {"sent": 0, "failed": 0}
+
+
+class DaemonTest(unittest.TestCase):
+    """Test the loops of the availability daemon"""
+
+    def setUp(self) -> None:
+        self.database_filename = "test_daemon.db"
+        self.clock = ThreadClock()
+        self.sender = FakeSender()
+        self.daemon = AvailabilityDaemon(
+            Settings(
+                {
+                    "CONNECTION_STRING": "sqlite:///" + self.database_filename,
+                    "DAEMON_MIN_SLEEP": 60.0,
+                    "DAEMON_MAX_SLEEP": 3600.0,
+                    "DAEMON_DRAIN_INTERVAL": 1.0,
+                }
+            ),
+            self.sender,
+            self.clock,
+        )
+
+    def tearDown(self) -> None:
+        database.dispose_engines()
+        if os.path.exists(self.database_filename):
+            os.remove(self.database_filename)
+
+    def test_drain_coalescing(self):
+        """Test that drains requested while draining result in one more drain"""
+        for _ in range(3):
+            self.daemon.on_transition({}, None)
+        self.assertEqual(len(self.clock.threads), 1)
+        self.assertTrue(self.daemon.drain_again)
+
+        self.clock.run_threads()
+        self.assertEqual(self.sender.drains, 2)
+        self.assertFalse(self.daemon.drain_again)
+        self.assertIsNone(self.daemon.draining)
+
+    def test_sweep_delay(self):
+        """Test that the delay until the next due product is clamped"""
+        self.assertEqual(self.daemon.sweep_delay(), 3600.0)
+        now = datetime.datetime(2022, 1, 1)
+        due = {}
+        self.daemon.scheduler = SimpleNamespace(
+            history_start=lambda now: now, next_due=lambda entries, now: due["at"]
+        )
+        for seconds, delay in [(None, 3600), (-30, 60), (10, 60), (600, 600)]:
+            due["at"] = None
+            if seconds is not None:
+                due["at"] = now + datetime.timedelta(seconds=seconds)
+            self.assertEqual(self.daemon.sweep_delay(now), delay)
+        due["at"] = now + datetime.timedelta(days=1)
+        self.assertEqual(self.daemon.sweep_delay(now), 3600)
+
+    def test_stop(self):
+        """Test that stop cancels the sleep and sends the pending notifications"""
+        crawler = SimpleNamespace(
+            signals=SimpleNamespace(connect=lambda *_, **__: None)
+        )
+        self.daemon.runner = SimpleNamespace(
+            create_crawler=lambda spider: crawler,
+            crawl=lambda crawler: defer.succeed(None),
+            stop=lambda: defer.succeed(None),
+        )
+        finished = []
+        self.daemon.run().addCallback(finished.append)  # pylint: disable=E1101
+        self.clock.run_threads()
+        self.assertEqual(self.sender.drains, 2)
+        self.assertIsNotNone(self.daemon.sleeping)
+        self.clock.advance(1.0)
+        self.clock.run_threads()
+        self.assertEqual(self.sender.drains, 3)
+
+        stopped = []
+        self.daemon.stop().addCallback(stopped.append)  # pylint: disable=E1101
+        self.assertEqual(finished, [None])
+        self.assertIsNone(self.daemon.sleeping)
+        self.assertEqual(stopped, [])
+        self.clock.run_threads()
+        self.assertEqual(stopped, [None])
+        self.assertEqual(self.sender.drains, 4)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+class SchedulerTest(unittest.TestCase):
+    """Test the check intervals and priorities of the AvailabilityScheduler"""
+
+    def setUp(self) -> None:
+        self.scheduler = AvailabilityScheduler()
+        self.now = datetime.datetime(2022, 1, 10, 12)
+
+    def entry(self, availability, hours_since_seen, days_since_change, transitions=0):
+        """Create a schedule entry"""
+        return {
+            "product_id": availability,
+            "url": "url",
+            "availability": availability,
+            "last_changed": self.now - datetime.timedelta(days=days_since_change),
+            "last_seen": self.now - datetime.timedelta(hours=hours_since_seen),
+            "transitions": transitions,
+        }
+
+    def test_check_interval(self):
+        """Test that volatile products are checked more often"""
+        sold_out = self.entry(3, 1, 10)
+        out_of_stock = self.entry(2, 1, 10)
+        volatile = self.entry(2, 1, 10, transitions=3)
+        self.assertGreater(
+            self.scheduler.check_interval(sold_out, self.now),
+            self.scheduler.check_interval(out_of_stock, self.now),
+        )
+        self.assertGreaterEqual(
+            self.scheduler.check_interval(out_of_stock, self.now),
+            self.scheduler.check_interval(volatile, self.now),
+        )
+        self.assertEqual(
+            self.scheduler.check_interval(self.entry(3, 1, 100), self.now),
+            datetime.timedelta(hours=48),
+        )
+
+    def test_schedule(self):
+        """Test that only due products are scheduled with their priority"""
+        new_product = {
+            "product_id": 0,
+            "url": "url",
+            "availability": None,
+            "last_changed": None,
+            "last_seen": None,
+            "transitions": 0,
+        }
+        entries = [new_product, self.entry(3, 2, 10), self.entry(2, 2, 10)]
+        scheduled = list(self.scheduler.schedule(entries, self.now))
+        self.assertEqual([e["product_id"] for e, _ in scheduled], [0, 2])
+        self.assertEqual(scheduled[0][1], MAX_PRIORITY)
+        self.assertEqual(scheduled[1][1], 40)
+
+    def test_next_due(self):
+        """Test that the next sweep is due with the first due product"""
+        entries = [self.entry(3, 2, 10), self.entry(2, 0.5, 10)]
+        self.assertEqual(
+            self.scheduler.next_due(entries, self.now),
+            self.now + datetime.timedelta(minutes=30),
+        )
+        self.assertIsNone(self.scheduler.next_due([], self.now))
+
+
+class CrawlFrontierTest(unittest.TestCase):
+    """Test resuming and scheduling discovery runs with the crawl frontier"""
+
+    def setUp(self) -> None:
+        """Setup a temporary SQLite database for the frontier"""
+        self.database_filename = "test_frontier_db.db"
+        self.engine = create_engine("sqlite:///" + self.database_filename)
+        database.Base.metadata.create_all(self.engine)
+
+    def tearDown(self) -> None:
+        """Remove the temporary SQLite database"""
+        database.dispose_engines()
+        if os.path.exists(self.database_filename):
+            os.remove(self.database_filename)
+
+    def test_resume(self):
+        """Test that an interrupted run is resumed with the pending pages"""
+        frontier = CrawlFrontier(self.engine)
+        pages = [page.url for page in frontier.start(["themes"])]
+        self.assertEqual(pages, ["themes"])
+        self.assertTrue(frontier.discover("theme-1", True))
+        self.assertTrue(frontier.discover("product-1", False))
+        self.assertFalse(frontier.discover("theme-1", True))
+        frontier.crawled_page("themes", ["theme-1", "product-1"])
+        frontier.flush()
+
+        frontier = CrawlFrontier(self.engine)
+        pages = [page.url for page in frontier.start(["themes"])]
+        self.assertTrue(frontier.resumed)
+        self.assertEqual(pages, ["product-1", "theme-1"])
+        self.assertFalse(frontier.discover("themes", True))
+
+    def test_delta_run(self):
+        """Test that a new run only schedules new, changed or outdated listings"""
+        frontier = CrawlFrontier(self.engine, revisit_days=3, changed_days=7)
+        list(frontier.start(["themes"]))
+        for url, is_listing in (("theme-1", True), ("theme-2", True), ("p-1", False)):
+            frontier.discover(url, is_listing)
+        frontier.crawled_page("themes", ["theme-1", "theme-2"])
+        frontier.crawled_page("theme-1", ["p-1"])
+        frontier.crawled_page("theme-2", [])
+        frontier.crawled_page("p-1")
+        frontier.finish()
+
+        frontier = CrawlFrontier(self.engine, revisit_days=3, changed_days=7)
+        pages = [page.url for page in frontier.start(["themes"])]
+        self.assertFalse(frontier.resumed)
+        self.assertEqual(pages, ["themes"])
+        frontier.crawled_page("themes", ["theme-1", "theme-2"])
+        frontier.crawled_page("theme-1", ["p-1", "p-2"])
+        frontier.finish()
+
+        frontier = CrawlFrontier(self.engine, revisit_days=3, changed_days=7)
+        pages = [page.url for page in frontier.start(["themes"])]
+        self.assertEqual(pages, ["theme-1", "themes"])
+        frontier.finish()
+
+        later = datetime.datetime.utcnow() + datetime.timedelta(days=4)
+        frontier = CrawlFrontier(self.engine, revisit_days=3, changed_days=7)
+        pages = [page.url for page in frontier.start(["themes"], now=later)]
+        self.assertEqual(pages, ["theme-1", "theme-2", "themes"])
+
+
+class DupeFilterTest(unittest.TestCase):
+    """Test the url canonicalization and the Bloom filter dupefilter"""
+
+    def test_canonicalize_url(self):
+        """Test that url variants of a page have the same canonical url"""
+        theme = "https://www.lego.com/de-de/themes/star-wars"
+        for variant in (
+            "https://WWW.LEGO.com:443/de-de/themes/star-wars/",
+            "https://www.lego.com/de-de/themes/star-wars?page=1#filter",
+            "https://www.lego.com/de-de/themes/star-wars?sort=price&icmp=HP",
+        ):
+            self.assertEqual(canonicalize_url(variant), theme)
+        self.assertEqual(
+            canonicalize_url(theme + "?sort=price&page=2"), theme + "?page=2"
+        )
+        self.assertEqual(
+            canonicalize_url(PRODUCT_URL + "?page=2&icmp=LP#details"), PRODUCT_URL
+        )
+
+    def test_scalable_bloom_filter(self):
+        """Test that the filter grows and finds all added keys"""
+        seen = ScalableBloomFilter(initial_capacity=100, error_rate=1e-4)
+        keys = [f"url{i}".encode() for i in range(1000)]
+        self.assertFalse(any(seen.add(key) for key in keys))
+        self.assertTrue(all(seen.add(key) for key in keys))
+        self.assertGreater(len(seen.filters), 1)
+        self.assertEqual(len(seen), 1000)
+        self.assertNotIn(b"other", seen)
+
+    def test_request_seen(self):
+        """Test filtering variants and persisting the state in JOBDIR"""
+        path = "test_dupefilter.bloom"
+        try:
+            dupefilter = CanonicalDupeFilter(path=path)
+            self.assertFalse(dupefilter.request_seen(Request(PRODUCT_URL)))
+            self.assertTrue(dupefilter.request_seen(Request(PRODUCT_URL + "#x")))
+            self.assertFalse(
+                dupefilter.request_seen(Request(PRODUCT_URL, method="POST"))
+            )
+            dupefilter.close("shutdown")
+
+            dupefilter = CanonicalDupeFilter(path=path)
+            self.assertTrue(dupefilter.request_seen(Request(PRODUCT_URL + "?a=b")))
+        finally:
+            if os.path.exists(path):
+                os.remove(path)
+
+
+class MigrationTest(unittest.TestCase):
+    """Test upgrading databases created with older schema versions"""
+
+    def setUp(self) -> None:
+        """Setup a temporary SQLite database with the initial schema"""
+        self.database_filename = "test_migration_db.db"
+        self.engine = create_engine("sqlite:///" + self.database_filename)
+        with self.engine.begin() as connection:
+            connection.exec_driver_sql(
+                """CREATE TABLE products (
+                    id INTEGER NOT NULL, name VARCHAR(256), price INTEGER,
+                    product_id INTEGER, url VARCHAR(512), PRIMARY KEY (id),
+                    UNIQUE (product_id), UNIQUE (url))"""
+            )
+            connection.exec_driver_sql(
+                """CREATE TABLE availability (
+                    id INTEGER NOT NULL, availability INTEGER, product_id INTEGER,
+                    timestamp DATETIME DEFAULT (CURRENT_TIMESTAMP), PRIMARY KEY (id),
+                    FOREIGN KEY(product_id) REFERENCES products (id))"""
+            )
+            connection.exec_driver_sql(
+                "INSERT INTO products (name, price, product_id, url) "
+                "VALUES ('Product 1', 1000, 10001, 'url1')"
+            )
+            connection.exec_driver_sql(
+                "INSERT INTO availability (availability, product_id, timestamp) "
+                "VALUES (2, 10001, '2021-01-01 00:00:00'), "
+                "(1, 10001, '2021-01-02 00:00:00')"
+            )
+
+    def tearDown(self) -> None:
+        """Remove the temporary SQLite database"""
+        self.engine.dispose()
+        if os.path.exists(self.database_filename):
+            os.remove(self.database_filename)
+
+    def test_upgrade(self):
+        """Test that upgrading keeps the history and fixes the schema"""
+        self.assertEqual(migrations.get_schema_version(self.engine), 0)
+        database.create_table(self.engine)
+        self.assertEqual(
+            migrations.get_schema_version(self.engine), migrations.SCHEMA_VERSION
+        )
+
+        inspector = inspect(self.engine)
+        foreign_keys = inspector.get_foreign_keys("availability")
+        self.assertEqual(foreign_keys[0]["referred_columns"], ["product_id"])
+        index_names = [i["name"] for i in inspector.get_indexes("availability")]
+        self.assertIn("ix_availability_product_id_timestamp", index_names)
+        self.assertIn("ix_availability_timestamp", index_names)
+
+        availabilities = database.get_availabilities(10001, self.engine)
+        self.assertEqual([a["availability"] for a in availabilities], [2, 1])
+
+        status = database.get_product_status(10001, self.engine)
+        self.assertEqual(status.availability, 1)
+        self.assertEqual(status.previous_availability, 2)
+        self.assertEqual(status.last_changed, datetime.datetime(2021, 1, 2))
+        self.assertEqual(status.last_seen, datetime.datetime(2021, 1, 2))
+        self.assertEqual(availabilities[1]["last_seen"], datetime.datetime(2021, 1, 2))
+
+        database.add_availabilities(
+            [
+                {
+                    "product_id": 10001,
+                    "availability": 1,
+                    "timestamp": datetime.datetime(2021, 1, 3),
+                }
+            ],
+            self.engine,
+            run_length_encoding=True,
+        )
+        availabilities = database.get_availabilities(10001, self.engine)
+        self.assertEqual(len(availabilities), 2)
+        self.assertEqual(availabilities[1]["last_seen"], datetime.datetime(2021, 1, 3))
+
+        database.create_table(self.engine)
+        self.assertEqual(len(database.get_availabilities(10001, self.engine)), 2)
+
+    def test_new_database_is_stamped(self):
+        """Test that new databases are created with the latest schema version"""
+        engine = create_engine("sqlite://")
+        database.create_table(engine)
+        self.assertEqual(
+            migrations.get_schema_version(engine), migrations.SCHEMA_VERSION
+        )
+
 
 class TelegramBotTest(unittest.TestCase):
     """Test sending Telegram messages using the LegoRestockBot class"""
@@ -180,6 +1652,44 @@ class TelegramBotTest(unittest.TestCase):
             print(html_message_2)
             # self.bot.send_html_message_to_channel(html_message_1)
 
+    def test_dispatcher(self):
+        """Test retrying flood control and network errors and reporting latency"""
+
+        class FakeBot:  # pylint: disable=R0903
+            """Fails the first attempts of sending a message"""
+
+            def __init__(self, failures):
+                self.failures = list(failures)
+                self.sent = []
+
+            def send_message(self, text, chat_id, parse_mode):
+                """Raise the next failure or record the message"""
+                if self.failures:
+                    raise self.failures.pop(0)
+                self.sent.append((chat_id, text, parse_mode))
+
+        bot = FakeBot([RetryAfter(0.05), TimedOut()])
+        with NotificationDispatcher(bot, chat_rate=100, backoff=0.01) as dispatcher:
+            reports = dispatcher.send_all([("channel", "<b>1</b>"), ("channel", "2")])
+        self.assertEqual(len(bot.sent), 2)
+        self.assertTrue(all(report.delivered for report in reports))
+        self.assertEqual(sum(report.attempts for report in reports), 4)
+        self.assertGreaterEqual(max(report.latency for report in reports), 0.05)
+
+        bot = FakeBot([BadRequest("Chat not found")])
+        with NotificationDispatcher(bot) as dispatcher:
+            report = dispatcher.send("channel", "1").result()
+        self.assertFalse(report.delivered)
+        self.assertIsNone(report.latency)
+        self.assertEqual(report.attempts, 1)
+
+    def test_rate_limiter(self):
+        """Test that bursts are limited to the rate"""
+        limiter = telegram_message.RateLimiter(rate=50, burst=2)
+        waited = [limiter.acquire() for _ in range(4)]
+        self.assertEqual(waited[:2], [0.0, 0.0])
+        self.assertGreater(waited[3], 0.01)
+
     def test_format_price(self):
         """Test the currency formating from cents to a string"""
 